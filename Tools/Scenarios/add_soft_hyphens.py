@@ -2,6 +2,7 @@
 
 import re
 
+import profiling
 from hyphen import Hyphenator
 from nova_script_parser import parse_chapters
 
@@ -77,4 +78,5 @@ def main():
 
 
 if __name__ == "__main__":
+    profiling.init()
     main()
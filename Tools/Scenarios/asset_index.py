@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Index of the assets referenced by the scenarios, joined with the files in
+# Assets/Resources
+# The scenarios are walked once to record the first and last occurrence and the
+# counts per node of each asset, and the resource folders are scanned once, then
+# missing assets and unreferenced files are found by comparing the two sets of
+# resource paths
+#
+# Composite sprites (standings and CG) reference the parts of their poses, so
+# an unreferenced part is not used by any pose shown in the scenarios
+
+import json
+import os
+import re
+import struct
+
+import profiling
+from lua_parser import walk_functions
+from scenario_loader import load_files
+from scenario_visitor import Visitor, run_visitors
+
+in_dir = "../../Assets/Resources/Scenarios/"
+template_filename = "template.txt"
+resources_dir = "../../Assets/Resources/"
+pose_filename = "../../Assets/Nova/Lua/pose.lua"
+out_filename = "asset_index.json"
+
+image_extensions = {".png", ".jpg", ".jpeg"}
+audio_extensions = {".ogg", ".wav", ".mp3", ".aiff", ".aif"}
+video_extensions = {".mp4", ".webm", ".mov"}
+prefab_extensions = {".prefab"}
+# Decoded images are RGBA32 textures
+bytes_per_pixel = 4
+
+# Kind -> (folder in resources_dir, extensions of the files in the folder)
+# Folders are the same as imageFolder, audioFolder, prefabFolder and videoFolder
+# in Assets/Nova/Prefabs and Assets/Scenes/Main.unity
+asset_folders = {
+    "bg": ("Backgrounds", image_extensions),
+    "fg": ("Foregrounds", image_extensions),
+    "cg": ("CG", image_extensions),
+    "standing": ("Standings", image_extensions),
+    "bgm": ("BGM", audio_extensions),
+    "sound": ("Sounds", audio_extensions),
+    "video": ("Videos", video_extensions),
+    "prefab": ("Prefabs", prefab_extensions),
+}
+# Generated from other assets, so they are not referenced by the scenarios
+ignored_dirs = {"Snapshots"}
+
+# Lua name of the object -> (kind, folder)
+# __Nova is __Nova.prefabLoader or __Nova.uiPrefabLoader, because walk_functions
+# only keeps the name before the dot
+objects = {
+    "bg": ("bg", "Backgrounds"),
+    "fg": ("fg", "Foregrounds"),
+    "cg": ("cg", "CG"),
+    "ergong": ("standing", "Standings/Ergong"),
+    "qianye": ("standing", "Standings/Qianye"),
+    "xiben": ("standing", "Standings/Xiben"),
+    "gaotian": ("standing", "Standings/Gaotian"),
+    "bgm": ("bgm", "BGM"),
+    "bgs": ("sound", "Sounds"),
+    "__Nova": ("prefab", "Prefabs"),
+}
+# Objects that show poses of composite sprites
+composite_objects = {"cg", "ergong", "qianye", "xiben", "gaotian"}
+
+# Functions with the object as args[0] and the resource name as args[1], the same
+# as the functions with add_preload_pattern in Assets/Nova/Lua
+obj_func_names = [
+    "show",
+    "show_no_fade",
+    "trans",
+    "trans2",
+    "trans_fade",
+    "trans_left",
+    "trans_right",
+    "trans_up",
+    "trans_down",
+    "trans_fade_in",
+    "play",
+    "fade_in",
+    "preload",
+]
+# Functions with the prefab loader as args[0] and the prefab name as args[1]
+prefab_func_names = ["minigame"]
+# Functions with the resource name as args[0] -> (kind, folder)
+name_funcs = {
+    "sound": ("sound", "Sounds"),
+    "video": ("video", "Videos"),
+    "timeline": ("prefab", "Prefabs"),
+}
+
+
+# Returns {obj_name: {pose_name: pose}} from the poses table in pose.lua
+def load_poses(filename=pose_filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        text = f.read()
+    match = re.search(r"^local poses = (\{.*?^\})", text, re.M | re.S)
+    if not match:
+        raise ValueError(f"Poses not found in {filename}")
+    _, args, _ = next(walk_functions(f"f({match.group(1)})"))
+    return args[0]
+
+
+class AssetRef:
+    __slots__ = ["kind", "count", "first", "last", "node_counts"]
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.count = 0
+        # (filename, line_num), and line_num is None in eager code
+        self.first = None
+        self.last = None
+        # {node_name: count}, in the order of the first occurrence
+        self.node_counts = {}
+
+
+class AssetRefVisitor(Visitor):
+    func_names = obj_func_names + prefab_func_names + ["show_loop"] + list(name_funcs)
+
+    def __init__(self, poses):
+        self.poses = poses
+        # Set before running on each file
+        self.filename = None
+        # {resource path: AssetRef}
+        self.refs = {}
+        # List of (filename, line_num, message)
+        self.errors = []
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        self.chapter_name = chapter_name
+        self.line_num = None
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        self.line_num = line_num
+
+    def add_error(self, message):
+        self.errors.append((self.filename, self.line_num, message))
+
+    def add_ref(self, kind, path):
+        ref = self.refs.get(path)
+        if ref is None:
+            ref = AssetRef(kind)
+            ref.first = (self.filename, self.line_num)
+            self.refs[path] = ref
+        ref.count += 1
+        ref.last = (self.filename, self.line_num)
+        ref.node_counts[self.chapter_name] = (
+            ref.node_counts.get(self.chapter_name, 0) + 1
+        )
+
+    # Like get_pose_by_name in pose.lua, and returns the list of parts
+    def get_pose_parts(self, obj_name, pose_name):
+        if isinstance(pose_name, list):
+            return pose_name
+        if "+" not in pose_name:
+            pose = self.poses.get(obj_name, {}).get(pose_name)
+            if pose is None:
+                self.add_error(f"Unknown pose {pose_name} for {obj_name}")
+            else:
+                pose_name = pose
+        return pose_name.split("+")
+
+    def add_resource(self, obj_name, resource_name):
+        kind, folder = objects[obj_name]
+        if obj_name in composite_objects:
+            for part in self.get_pose_parts(obj_name, resource_name):
+                self.add_ref(kind, f"{folder}/{part}")
+        elif isinstance(resource_name, str):
+            self.add_ref(kind, f"{folder}/{resource_name}")
+
+    def visit_call(self, func_name, args, env):
+        if func_name in name_funcs:
+            if args and isinstance(args[0], str):
+                kind, folder = name_funcs[func_name]
+                self.add_ref(kind, f"{folder}/{args[0]}")
+            return
+
+        if len(args) < 2 or args[0] not in objects:
+            return
+        if func_name in prefab_func_names:
+            if objects[args[0]][0] == "prefab" and isinstance(args[1], str):
+                self.add_resource(args[0], args[1])
+            return
+        if func_name == "show_loop":
+            for resource_name in args[1]:
+                self.add_resource(args[0], resource_name)
+        elif isinstance(args[1], (str, list)):
+            self.add_resource(args[0], args[1])
+
+
+# Returns {resource path: (kind, filename)} of the files in the folders of
+# asset_folders, where resource paths are without extension, like the argument of
+# AssetLoader.Load
+def scan_assets(resources_dir=resources_dir):
+    assets = {}
+    for kind, (folder, extensions) in asset_folders.items():
+        for dirpath, dirnames, filenames in os.walk(
+            os.path.join(resources_dir, folder)
+        ):
+            dirnames[:] = sorted(x for x in dirnames if x not in ignored_dirs)
+            rel_dir = os.path.relpath(dirpath, resources_dir).replace(os.sep, "/")
+            for filename in filenames:
+                stem, ext = os.path.splitext(filename)
+                if ext.lower() in extensions:
+                    assets[f"{rel_dir}/{stem}"] = (
+                        kind,
+                        os.path.join(dirpath, filename),
+                    )
+    return assets
+
+
+# Returns (width, height) from the header of a PNG or JPEG file, so the image is
+# not decoded
+def get_image_size(filename):
+    with open(filename, "rb") as f:
+        data = f.read(24)
+        if data.startswith(b"\x89PNG"):
+            return struct.unpack(">II", data[16:24])
+
+        if not data.startswith(b"\xff\xd8"):
+            raise ValueError(f"Unknown image format: {filename}")
+        f.seek(2)
+        while True:
+            marker, length = struct.unpack(">HH", f.read(4))
+            # SOF markers, except DHT, JPG and DAC
+            if 0xFFC0 <= marker <= 0xFFCF and marker not in (0xFFC4, 0xFFC8, 0xFFCC):
+                height, width = struct.unpack(">xHH", f.read(5))
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+# Size of the decoded texture in memory
+def get_image_bytes(filename):
+    width, height = get_image_size(filename)
+    return width * height * bytes_per_pixel
+
+
+# All files in in_dir are walked, not only the ones in the template, because the
+# game loads all of them, so assets used only by the test scenarios are referenced
+def get_asset_refs(template_filename=template_filename, in_dir=in_dir):
+    visitor = AssetRefVisitor(load_poses())
+    for filename, chapters in load_files(template_filename, in_dir, all_files=True):
+        visitor.filename = filename
+        run_visitors(chapters, [visitor])
+    return visitor
+
+
+# Returns (paths of referenced assets that are missing, paths of files that are
+# not referenced)
+def check_assets(refs, assets):
+    missing = [x for x in refs if x not in assets]
+    unreferenced = sorted(assets.keys() - refs.keys())
+    return missing, unreferenced
+
+
+def format_location(location):
+    filename, line_num = location
+    return f"{filename}:{line_num}"
+
+
+# The index is saved in both directions, from assets to nodes and from nodes to
+# assets
+def save_index(refs, missing, unreferenced, out_filename=out_filename):
+    node_assets = {}
+    for path, ref in refs.items():
+        for node_name, count in ref.node_counts.items():
+            node_assets.setdefault(node_name, {})[path] = count
+
+    index = {
+        "assets": {
+            path: {
+                "kind": ref.kind,
+                "count": ref.count,
+                "first": format_location(ref.first),
+                "last": format_location(ref.last),
+                "nodes": ref.node_counts,
+            }
+            for path, ref in refs.items()
+        },
+        "nodes": node_assets,
+        "missing": missing,
+        "unreferenced": unreferenced,
+    }
+    with open(out_filename, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    visitor = get_asset_refs()
+    assets = scan_assets()
+    missing, unreferenced = check_assets(visitor.refs, assets)
+    save_index(visitor.refs, missing, unreferenced)
+
+    for filename, line_num, message in visitor.errors:
+        print(f"{filename}:{line_num}: {message}")
+    if visitor.errors:
+        print()
+
+    print(f"Missing assets: {len(missing)}")
+    for path in missing:
+        ref = visitor.refs[path]
+        print(f"{format_location(ref.first)}: {ref.kind} {path}")
+    print()
+
+    print(f"Unreferenced assets: {len(unreferenced)}")
+    for path in unreferenced:
+        print(f"{assets[path][0]} {path}")
+    print()
+
+    print(f"{len(visitor.refs)} referenced assets, {len(assets)} asset files")
+
+
+if __name__ == "__main__":
+    profiling.init()
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Simulate the images held in memory by Nova.AssetLoader and the sprites at each
+# entry of the scenario, to find where the decoded textures exceed the memory of
+# a device
+#
+# The model follows AssetLoader.cs and garbage_collection.lua:
+#   Showing an image loads it, and preload loads it into the LRU cache of its
+#   type, with a reference count
+#   unpreload and eviction from the cache only release the reference, and the
+#   texture stays in memory until force_gc unloads the ones not shown or cached
+#   schedule_gc does not unload at present, unless gc_on_schedule is True
+#   The preloads added by DialogueEntryPreprocessor.cs are replayed as well,
+#   after the code of each entry
+#
+# Every route from a start node is replayed with its own state, then the peak and
+# the timeline of the peak memory in each entry are reported per node and per
+# route
+
+import json
+from collections import OrderedDict
+
+import profiling
+from asset_index import get_image_bytes, load_poses, objects, scan_assets
+from nova_script_parser import is_start
+from preload_planner import (
+    PlanVisitor,
+    image_kinds,
+    preload_func_names,
+    preload_steps,
+)
+from scenario_loader import load_files
+from scenario_visitor import run_visitors
+
+in_dir = "../../Assets/Resources/Scenarios/"
+template_filename = "template.txt"
+out_filename = "asset_residency.json"
+
+# Decoded textures allowed on the device
+device_budget = 256 * 1024 * 1024
+# Same as the caches in AssetLoader.Awake
+cache_sizes = {"Image": 20, "Standing": 20}
+# If True, schedule_gc unloads unused assets after the entry, like the code
+# commented out in garbage_collection.lua
+gc_on_schedule = False
+gc_func_names = {"schedule_gc", "force_gc"}
+# Functions that do not match the preload patterns
+no_auto_preload_func_names = {"show_loop"}
+max_routes = 1000
+
+
+def get_cache_type(obj_name):
+    return "Standing" if objects[obj_name][0] == "standing" else "Image"
+
+
+class ResidencyVisitor(PlanVisitor):
+    func_names = PlanVisitor.func_names + ["unpreload"] + list(gc_func_names)
+
+    def __init__(self, poses):
+        super().__init__(poses)
+        self.start_names = []
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        super().begin_chapter(chapter_name, head_eager_code, tail_eager_code)
+        if is_start(head_eager_code):
+            self.start_names.append(chapter_name)
+
+    def visit_call(self, func_name, args, env):
+        if func_name in gc_func_names:
+            self.node.events.append(
+                (len(self.node.line_nums) - 1, func_name, None, None, [])
+            )
+            return
+        super().visit_call(func_name, args, env)
+
+
+# Returns the list of events in each entry of the node, with the preload and
+# unpreload added by DialogueEntryPreprocessor after the code of the entry, in
+# the order of the entries that generate them
+def get_entry_events(node):
+    entry_events = [[] for _ in node.line_nums]
+    for event in node.events:
+        entry_events[event[0]].append(event)
+
+    generated_events = [[] for _ in node.line_nums]
+    for event in node.events:
+        index, func_name, obj_name, resource_name, paths = event
+        if (
+            func_name not in preload_func_names
+            and func_name not in no_auto_preload_func_names
+            and func_name not in gc_func_names
+            and func_name != "hide"
+            # The patterns only match string literals
+            and isinstance(resource_name, str)
+        ):
+            start = max(index - preload_steps, 0)
+            generated_events[start].append((start, "preload", obj_name, None, paths))
+            generated_events[index].append((index, "unpreload", obj_name, None, paths))
+
+    for events, generated in zip(entry_events, generated_events):
+        events += generated
+    return entry_events
+
+
+class AssetCache:
+    def __init__(self, sizes):
+        self.sizes = sizes
+        # Paths of the textures in memory
+        self.loaded = set()
+        # {cache_type: OrderedDict of path -> count}, and the last is the most
+        # recently used
+        self.caches = {x: OrderedDict() for x in cache_sizes}
+        # {obj_name: paths}
+        self.shown = {}
+        self.gc_scheduled = False
+        # Paths unpreloaded when not in the cache, which are usually evicted
+        self.unpreload_misses = []
+
+    def get_memory(self):
+        return sum(self.sizes.get(x, 0) for x in self.loaded)
+
+    def preload(self, cache_type, paths):
+        cache = self.caches[cache_type]
+        for path in paths:
+            if path in cache:
+                cache[path] += 1
+                cache.move_to_end(path)
+            else:
+                if len(cache) == cache_sizes[cache_type]:
+                    cache.popitem(last=False)
+                cache[path] = 1
+                self.loaded.add(path)
+
+    def unpreload(self, cache_type, paths):
+        cache = self.caches[cache_type]
+        for path in paths:
+            if path not in cache:
+                self.unpreload_misses.append(path)
+                continue
+            cache[path] -= 1
+            if cache[path] <= 0:
+                del cache[path]
+
+    def show(self, obj_name, paths):
+        self.shown[obj_name] = paths
+        self.loaded.update(paths)
+
+    def hide(self, obj_name):
+        self.shown.pop(obj_name, None)
+        self.gc_scheduled = True
+
+    # Resources.UnloadUnusedAssets, which keeps the textures referenced by the
+    # sprites and the cache
+    def gc(self):
+        used = {x for y in self.shown.values() for x in y}
+        for cache in self.caches.values():
+            used.update(cache)
+        self.loaded &= used
+        self.gc_scheduled = False
+
+    def run_event(self, event):
+        _, func_name, obj_name, _, paths = event
+        if func_name == "preload":
+            self.preload(get_cache_type(obj_name), paths)
+        elif func_name == "unpreload":
+            self.unpreload(get_cache_type(obj_name), paths)
+        elif func_name == "hide":
+            self.hide(obj_name)
+        elif func_name == "schedule_gc":
+            self.gc_scheduled = True
+        elif func_name == "force_gc":
+            self.gc()
+        else:
+            self.show(obj_name, paths)
+
+    # Like the action after lazy block in garbage_collection.lua
+    def end_entry(self):
+        if self.gc_scheduled:
+            if gc_on_schedule:
+                self.gc()
+            self.gc_scheduled = False
+
+
+# Returns the lists of node names from each start node until the end, and a node
+# is not visited twice in a route
+def get_routes(nodes, start_names):
+    routes = []
+    stack = [(x,) for x in reversed(start_names)]
+    while stack and len(routes) < max_routes:
+        route = stack.pop()
+        successors = [
+            x for x in nodes[route[-1]].successors if x in nodes and x not in route
+        ]
+        if not successors:
+            routes.append(list(route))
+        for name in reversed(successors):
+            stack.append(route + (name,))
+    if stack:
+        print(f"More than {max_routes} routes, only the first ones are simulated")
+    return routes
+
+
+# Returns the peak memory in each entry of the route, as a list for each node
+# The memory is sampled after each event, because an image shown then unloaded by
+# force_gc in the same entry is still in memory for a while
+def simulate_route(route, nodes, entry_events, sizes):
+    asset_cache = AssetCache(sizes)
+    timeline = []
+    for name in route:
+        node_timeline = []
+        for events in entry_events[name]:
+            peak = asset_cache.get_memory()
+            for event in events:
+                asset_cache.run_event(event)
+                peak = max(peak, asset_cache.get_memory())
+            asset_cache.end_entry()
+            node_timeline.append(peak)
+        timeline.append(node_timeline)
+    return timeline, asset_cache.unpreload_misses
+
+
+def format_mib(size):
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+def main():
+    visitor = ResidencyVisitor(load_poses())
+    for filename, chapters in load_files(template_filename, in_dir):
+        visitor.filename = filename
+        run_visitors(chapters, [visitor])
+    nodes = visitor.nodes
+    for node in nodes.values():
+        for name in node.successors:
+            if name in nodes:
+                nodes[name].predecessors.append(node.name)
+
+    sizes = {
+        path: get_image_bytes(filename)
+        for path, (kind, filename) in scan_assets().items()
+        if kind in image_kinds
+    }
+    entry_events = {name: get_entry_events(node) for name, node in nodes.items()}
+
+    start_names = visitor.start_names or [
+        name for name, node in nodes.items() if not node.predecessors
+    ]
+    routes = get_routes(nodes, start_names)
+
+    # Max memory after each entry of each node in all routes
+    node_timelines = {name: [0] * len(node.line_nums) for name, node in nodes.items()}
+    route_results = []
+    unpreload_misses = set()
+    for route in routes:
+        timeline, misses = simulate_route(route, nodes, entry_events, sizes)
+        unpreload_misses.update(misses)
+
+        peak = 0
+        peak_at = None
+        for name, node_timeline in zip(route, timeline):
+            max_timeline = node_timelines[name]
+            for index, memory in enumerate(node_timeline):
+                max_timeline[index] = max(max_timeline[index], memory)
+                if memory > peak:
+                    peak = memory
+                    peak_at = f"{name}[{index}]"
+        route_results.append(
+            {"nodes": route, "peak": peak, "peak_at": peak_at, "timeline": timeline}
+        )
+
+    with open(out_filename, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(
+            {
+                "device_budget": device_budget,
+                "routes": route_results,
+                "nodes": {
+                    name: {"peak": max(x, default=0), "timeline": x}
+                    for name, x in node_timelines.items()
+                },
+            },
+            f,
+            ensure_ascii=False,
+        )
+
+    print(f"Peak texture memory of {len(routes)} routes:")
+    for result in route_results:
+        print(
+            f"{format_mib(result['peak'])} at {result['peak_at']}: "
+            + " -> ".join(result["nodes"])
+        )
+    print()
+
+    print("Peak texture memory per node:")
+    for name, timeline in node_timelines.items():
+        print(f"{name} {format_mib(max(timeline, default=0))}")
+    print()
+
+    over_budget = [
+        (memory, name, index)
+        for name, timeline in node_timelines.items()
+        for index, memory in enumerate(timeline)
+        if memory > device_budget
+    ]
+    print(f"Entries over the budget of {format_mib(device_budget)}: {len(over_budget)}")
+    for memory, name, index in sorted(over_budget, key=lambda x: -x[0]):
+        node = nodes[name]
+        print(
+            f"{node.filename}:{node.line_nums[index]}: {name}[{index}] "
+            f"{format_mib(memory)}"
+        )
+
+    if unpreload_misses:
+        print()
+        print(
+            f"Unpreloaded when not cached, maybe the cache is too small: "
+            f"{len(unpreload_misses)}"
+        )
+        for path in sorted(unpreload_misses):
+            print(path)
+
+
+if __name__ == "__main__":
+    profiling.init()
+    main()
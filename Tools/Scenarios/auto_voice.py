@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+# Compute the voice of every dialogue entry like Assets/Nova/Lua/auto_voice.lua and
+# AutoVoice.cs, then check them against the voice files
+# The voice directory is scanned once, and voices are compared with a set of
+# resource paths, so it does not check the file of each voice
+#
+# Auto voice states are kept across nodes in the order of the scenario files, and
+# they are reset when a chapter begins, like starting the chapter in the game
+
+import os
+
+import profiling
+from nova_script_parser import is_chapter
+from scenario_loader import load_files
+from scenario_visitor import Visitor, run_visitors
+
+in_dir = "../../Assets/Resources/Scenarios/"
+template_filename = "template.txt"
+resources_dir = "../../Assets/Resources/"
+voices_dir = "Voices"
+audio_extensions = {".ogg", ".wav", ".mp3", ".aiff", ".aif"}
+
+# Same as autoVoiceConfigs and padWidth of AutoVoice in Assets/Scenes/Main.unity
+# characterName -> Lua name of the character controller
+auto_voice_charas = {
+    "王二宫": "ergong",
+    "张浅野": "qianye",
+    "孙西本": "xiben",
+    "陈高天": "gaotian",
+}
+pad_width = 6
+# Lua name of the character controller -> voiceFolder
+voice_folders = {
+    "ergong": "Voices/Ergong",
+    "qianye": "Voices/Qianye",
+    "xiben": "Voices/Xiben",
+    "gaotian": "Voices/Gaotian",
+}
+
+
+class Voice:
+    __slots__ = [
+        "filename",
+        "chapter_name",
+        "line_num",
+        "obj_name",
+        "voice_folder",
+        "audio_name",
+        "index",
+        "auto",
+    ]
+
+    def __init__(
+        self,
+        filename,
+        chapter_name,
+        line_num,
+        obj_name,
+        voice_folder,
+        audio_name,
+        index,
+    ):
+        self.filename = filename
+        self.chapter_name = chapter_name
+        self.line_num = line_num
+        # Lua name of the character controller, for both auto voice and say
+        self.obj_name = obj_name
+        self.voice_folder = voice_folder
+        self.audio_name = audio_name
+        # Index of auto voice, or None for say
+        self.index = index
+        self.auto = index is not None
+
+    # Resource path without extension, like the argument of AssetLoader.Load
+    @property
+    def path(self):
+        return f"{self.voice_folder}/{self.audio_name}"
+
+
+class AutoVoiceEngine(Visitor):
+    func_names = [
+        "auto_voice_on",
+        "auto_voice_off",
+        "auto_voice_off_all",
+        "auto_voice_skip",
+        "say",
+    ]
+
+    def __init__(self):
+        # Set before running on each file
+        self.filename = None
+        self.voices = []
+        # List of (filename, line_num, message)
+        self.errors = []
+        self.reset()
+
+    def reset(self):
+        self.enabled = {}
+        self.index = {}
+        self.prefix = {}
+        self.overridden = False
+
+    def add_error(self, message):
+        self.errors.append((self.filename, self.line_num, message))
+
+    def add_voice(self, obj_name, voice_folder, audio_name, index=None):
+        self.voices.append(
+            Voice(
+                self.filename,
+                self.chapter_name,
+                self.line_num,
+                obj_name,
+                voice_folder,
+                audio_name,
+                index,
+            )
+        )
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        if is_chapter(head_eager_code):
+            self.reset()
+        self.chapter_name = chapter_name
+        self.line_num = None
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        self.line_num = line_num
+
+    def visit_call(self, func_name, args, env):
+        if func_name == "auto_voice_on":
+            name, index = args[0], args[1]
+            if name not in auto_voice_charas:
+                self.add_error(f"No auto voice config for {name}")
+            if isinstance(index, list):
+                self.prefix[name] = index[0]
+                index = index[1]
+            self.enabled[name] = True
+            self.index[name] = int(index)
+        elif func_name == "auto_voice_off":
+            self.enabled[args[0]] = False
+        elif func_name == "auto_voice_off_all":
+            for name in self.enabled:
+                self.enabled[name] = False
+        elif func_name == "auto_voice_skip":
+            self.overridden = True
+        elif func_name == "say":
+            obj = args[0]
+            override_auto_voice = len(args) < 4 or args[3] is not False
+            voice_folder = voice_folders.get(obj)
+            if voice_folder is None:
+                self.add_error(f"No voice folder for {obj}")
+            else:
+                self.add_voice(obj, voice_folder, args[1])
+            if override_auto_voice:
+                self.overridden = True
+
+    # Like the action after lazy block in auto_voice.lua
+    def end_entry(self, code, chara_name, dialogue, line_num):
+        if self.overridden:
+            self.overridden = False
+            return
+        if not chara_name or not self.enabled.get(chara_name, False):
+            return
+
+        obj = auto_voice_charas.get(chara_name)
+        voice_folder = voice_folders.get(obj)
+        if voice_folder is None:
+            self.add_error(f"No voice folder for {chara_name}")
+        else:
+            index = self.index[chara_name]
+            audio_name = self.prefix.get(chara_name, "") + str(index).rjust(
+                pad_width, "0"
+            )
+            self.add_voice(obj, voice_folder, audio_name, index)
+        self.index[chara_name] += 1
+
+
+# Returns the set of resource paths of audio files in resources_dir/voices_dir,
+# without extension
+def scan_voice_files(resources_dir=resources_dir, voices_dir=voices_dir):
+    paths = set()
+    for dirpath, _, filenames in os.walk(os.path.join(resources_dir, voices_dir)):
+        rel_dir = os.path.relpath(dirpath, resources_dir).replace(os.sep, "/")
+        for filename in filenames:
+            stem, ext = os.path.splitext(filename)
+            if ext.lower() in audio_extensions:
+                paths.add(f"{rel_dir}/{stem}")
+    return paths
+
+
+def get_voices(template_filename=template_filename, in_dir=in_dir):
+    engine = AutoVoiceEngine()
+    for filename, chapters in load_files(template_filename, in_dir):
+        engine.filename = filename
+        run_visitors(chapters, [engine])
+    return engine
+
+
+# Returns (voices whose files are missing, paths of files that are not used)
+def check_voices(voices, voice_files):
+    missing = [x for x in voices if x.path not in voice_files]
+    used = {x.path for x in voices}
+    orphans = sorted(voice_files - used)
+    return missing, orphans
+
+
+# say with override_auto_voice = false keeps the auto voice of the entry
+def test_say_override():
+    engine = AutoVoiceEngine()
+    entries = [
+        ("auto_voice_on('王二宫', 1)", "王二宫", "", 1),
+        ("say(ergong, 'a', 0, false)", "王二宫", "", 2),
+        ("say(ergong, 'b')", "王二宫", "", 3),
+        ("say(ergong, 'c', 0, nil)", "王二宫", "", 4),
+        (None, "王二宫", "", 5),
+    ]
+    run_visitors([("n", entries, "", "")], [engine])
+    voices = [(x.audio_name, x.auto) for x in engine.voices]
+    assert voices == [
+        ("000001", True),
+        ("a", False),
+        ("000002", True),
+        ("b", False),
+        ("c", False),
+        ("000003", True),
+    ], voices
+
+
+def main():
+    engine = get_voices()
+    voice_files = scan_voice_files()
+    missing, orphans = check_voices(engine.voices, voice_files)
+
+    for filename, line_num, message in engine.errors:
+        print(f"{filename}:{line_num}: {message}")
+    if engine.errors:
+        print()
+
+    print(f"Missing voices: {len(missing)}")
+    for voice in missing:
+        kind = "auto" if voice.auto else "say"
+        print(
+            f"{voice.filename}:{voice.line_num}: {voice.obj_name} {kind} {voice.path}"
+        )
+    print()
+
+    print(f"Unused voice files: {len(orphans)}")
+    for path in orphans:
+        print(path)
+    print()
+
+    print(f"{len(engine.voices)} voices, {len(voice_files)} voice files")
+
+
+if __name__ == "__main__":
+    profiling.init()
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the hot paths in Tools/Scenarios on generated corpora
+#   benchmark.py run [--sizes 1000 10000 100000] [--out results.json]
+#   benchmark.py compare baseline.json results.json [--threshold 0.1]
+# compare exits with 1 if any benchmark is slower than the baseline by the threshold
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import lua_parser
+import node_parser
+import nova_script_parser
+import profiling
+import split_chara
+from generate_sample_script import write_corpus
+from lint import LintVisitor
+from lua_parser import walk_functions
+from nova_script_parser import normalize_dialogue, parse_chapters
+from scenario_loader import get_include_filenames
+from scenario_visitor import run_visitors
+
+corpus_dir = ".cache/benchmark"
+default_sizes = [1000, 10000, 100000]
+seed = 0
+# Each benchmark is repeated until it takes this long in total, or max_repeat times
+min_total_time = 1.0
+max_repeat = 10
+default_threshold = 0.1
+
+
+def get_corpus(n_entries):
+    out_dir = os.path.join(corpus_dir, f"corpus_{n_entries}_{seed}")
+    template_filename = os.path.join(out_dir, "template.txt")
+    if not os.path.exists(template_filename):
+        write_corpus(out_dir, n_entries, max(1, n_entries // 5000), seed)
+
+    texts = []
+    for filename in get_include_filenames(
+        template_filename, os.path.join(out_dir, "Scenarios")
+    ):
+        with open(filename, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    return "\n".join(texts)
+
+
+@contextlib.contextmanager
+def no_caches():
+    old = (
+        nova_script_parser.use_parse_cache,
+        nova_script_parser.use_incremental_parse,
+        lua_parser.use_call_cache,
+    )
+    nova_script_parser.use_parse_cache = False
+    nova_script_parser.use_incremental_parse = False
+    lua_parser.use_call_cache = False
+    try:
+        yield
+    finally:
+        (
+            nova_script_parser.use_parse_cache,
+            nova_script_parser.use_incremental_parse,
+            lua_parser.use_call_cache,
+        ) = old
+
+
+def time_func(func):
+    times = []
+    total_time = 0
+    while len(times) < max_repeat and (not times or total_time < min_total_time):
+        start_time = time.perf_counter()
+        func()
+        t = time.perf_counter() - start_time
+        times.append(t)
+        total_time += t
+
+    times.sort()
+    return {
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "repeat": len(times),
+    }
+
+
+def get_benchmarks(text):
+    chapters = nova_script_parser.nodes_to_chapters(node_parser.parse_nodes(text))
+    codes = [code for _, entries, _, _ in chapters for code, _, _, _ in entries if code]
+    dialogues = [
+        dialogue for _, entries, _, _ in chapters for _, _, dialogue, _ in entries
+    ]
+
+    def bench_parse_nodes():
+        node_parser.parse_nodes(text)
+
+    def bench_parse_chapters():
+        parse_chapters(io.StringIO(text))
+
+    def bench_normalize_dialogue():
+        for dialogue in dialogues:
+            normalize_dialogue(dialogue)
+
+    def bench_walk_functions():
+        for code in codes:
+            for _ in walk_functions(code):
+                pass
+
+    def bench_lint():
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_visitors(chapters, [LintVisitor()])
+
+    def bench_split_chara():
+        with contextlib.redirect_stdout(io.StringIO()):
+            split_chara.split_all(chapters)
+
+    benchmarks = {
+        "parse_nodes": bench_parse_nodes,
+        "parse_chapters": bench_parse_chapters,
+        "normalize_dialogue": bench_normalize_dialogue,
+        "walk_functions": bench_walk_functions,
+        "lint": bench_lint,
+        "split_chara": bench_split_chara,
+    }
+
+    # visualize needs imageio and scipy
+    try:
+        from visualize import TapeVisitor, tapes_to_img
+    except ImportError as e:
+        print(f"Skip visualize: {e}")
+    else:
+        tape_visitors = []
+
+        def bench_tape():
+            visitor = TapeVisitor(out_filename=None)
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_visitors(chapters, [visitor])
+            tape_visitors[:] = [visitor]
+
+        def bench_tapes_to_img():
+            visitor = tape_visitors[0]
+            tapes_to_img(visitor.get_tapes(), visitor.palette.to_array())
+
+        benchmarks["tape"] = bench_tape
+        benchmarks["tapes_to_img"] = bench_tapes_to_img
+
+    return benchmarks
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = {}
+    with no_caches(), tempfile.TemporaryDirectory() as tmp_dir:
+        old_split_chara_filename = split_chara.in_filename
+        split_chara.in_filename = os.path.join(tmp_dir, "scenario.txt")
+        try:
+            for size in args.sizes:
+                print(f"Size {size}")
+                text = get_corpus(size)
+                for name, func in get_benchmarks(text).items():
+                    if args.filter and args.filter not in name:
+                        continue
+                    result = time_func(func)
+                    results[f"{name}/{size}"] = result
+                    print(f"{name:24} {result['min'] * 1000:10.2f} ms")
+                print()
+        finally:
+            split_chara.in_filename = old_split_chara_filename
+
+    out = {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": get_git_commit(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "seed": seed,
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(out, f, indent=2)
+    print(f"Results saved to {args.out}")
+
+
+def compare(args):
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    print(f"{'benchmark':32} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for name in sorted(baseline.keys() & current.keys()):
+        t_baseline = baseline[name]["min"]
+        t_current = current[name]["min"]
+        ratio = t_current / t_baseline if t_baseline > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + args.threshold):
+            flag = " faster"
+        print(
+            f"{name:32} {t_baseline * 1000:10.2f}ms {t_current * 1000:10.2f}ms "
+            f"{ratio:8.3f}{flag}"
+        )
+
+    for name in sorted(baseline.keys() - current.keys()):
+        print(f"{name:32} missing in current results")
+
+    if regressions:
+        print(f"{len(regressions)} regressions")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="run benchmarks")
+    parser_run.add_argument("--sizes", type=int, nargs="+", default=default_sizes)
+    parser_run.add_argument("--out", default="benchmark_results.json")
+    parser_run.add_argument("--filter", help="only run benchmarks containing this")
+
+    parser_compare = subparsers.add_parser("compare", help="compare with baseline")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("current")
+    parser_compare.add_argument("--threshold", type=float, default=default_threshold)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+
+
+if __name__ == "__main__":
+    profiling.init()
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# SQLite index of nodes, entries and Lua calls in the scenario
+# The index is updated incrementally: only the nodes whose text changed are parsed
+#
+# Example query:
+# SELECT n.name, e.line, c.args FROM calls c
+# JOIN entries e ON e.node_id = c.node_id AND e.entry_index = c.entry_index
+# JOIN nodes n ON n.id = c.node_id
+# WHERE c.func_name = 'play' AND c.arg0 = 'bgm'
+# ORDER BY n.position, c.entry_index, c.call_index
+
+import json
+import os
+import sqlite3
+import sys
+
+import profiling
+from lua_parser import NIL, walk_functions
+from nova_script_parser import (
+    IncrementalParseFailed,
+    get_node_text_hash,
+    iter_line_offsets,
+    node_parser,
+    parse_node_text_cached,
+    split_node_texts,
+)
+
+in_filename = "scenario.txt"
+index_filename = ".cache/call_index.sqlite"
+index_version = "2"
+tracked_env = {"anim", "anim_hold", "named_anim_hold"}
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    hash TEXT,
+    position INTEGER,
+    line_offset INTEGER,
+    name TEXT,
+    head_eager_code TEXT,
+    tail_eager_code TEXT
+);
+CREATE TABLE IF NOT EXISTS entries (
+    node_id INTEGER,
+    entry_index INTEGER,
+    line INTEGER,
+    chara_name TEXT,
+    dialogue TEXT,
+    code TEXT,
+    PRIMARY KEY (node_id, entry_index)
+);
+CREATE TABLE IF NOT EXISTS calls (
+    node_id INTEGER,
+    entry_index INTEGER,
+    call_index INTEGER,
+    func_name TEXT,
+    is_action INTEGER,
+    arg0,
+    args TEXT,
+    env TEXT,
+    PRIMARY KEY (node_id, entry_index, call_index)
+);
+CREATE INDEX IF NOT EXISTS nodes_position ON nodes (position);
+CREATE INDEX IF NOT EXISTS calls_func_name ON calls (func_name);
+CREATE INDEX IF NOT EXISTS calls_arg0 ON calls (arg0);
+"""
+
+
+# nil is stored as null
+def dump_args(args):
+    return json.dumps(args, ensure_ascii=False, default=lambda x: None)
+
+
+# null is loaded as nil
+# Keys of Lua tables are loaded as str
+def load_args(s):
+    return convert_null(json.loads(s))
+
+
+def convert_null(x):
+    if x is None:
+        return NIL()
+    if isinstance(x, list):
+        return [convert_null(y) for y in x]
+    if isinstance(x, dict):
+        return {k: convert_null(v) for k, v in x.items()}
+    return x
+
+
+def open_db(filename=index_filename):
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    db = sqlite3.connect(filename)
+    db.executescript(schema)
+
+    row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if row is None or row[0] != index_version:
+        clear_index(db)
+        db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (index_version,)
+        )
+        db.commit()
+
+    return db
+
+
+def clear_index(db):
+    db.execute("DELETE FROM nodes")
+    db.execute("DELETE FROM entries")
+    db.execute("DELETE FROM calls")
+
+
+def delete_node(db, node_id):
+    db.execute("DELETE FROM nodes WHERE id = ?", (node_id,))
+    db.execute("DELETE FROM entries WHERE node_id = ?", (node_id,))
+    db.execute("DELETE FROM calls WHERE node_id = ?", (node_id,))
+
+
+def insert_node(db, node, node_hash, position, line_offset):
+    cursor = db.execute(
+        "INSERT INTO nodes (hash, position, line_offset, name, head_eager_code, "
+        "tail_eager_code) VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            node_hash,
+            position,
+            line_offset,
+            node.name,
+            node.headEagerBlock.content,
+            node.tailEagerBlock.content,
+        ),
+    )
+    node_id = cursor.lastrowid
+
+    entry_rows = []
+    call_rows = []
+    for entry_index, entry in enumerate(node.dialogueEntries):
+        code = "\n".join(block.content for block in entry.codeBlocks)
+        entry_rows.append(
+            (
+                node_id,
+                entry_index,
+                entry.line,
+                entry.characterName,
+                entry.dialogue,
+                code,
+            )
+        )
+        if not code:
+            continue
+
+        for call_index, (func_name, args, env) in enumerate(
+            walk_functions(code, tracked_env=tracked_env)
+        ):
+            is_action = func_name == "action"
+            if is_action:
+                func_name = args[0]
+                args = args[1:]
+            arg0 = args[0] if args and isinstance(args[0], (str, float)) else None
+            call_rows.append(
+                (
+                    node_id,
+                    entry_index,
+                    call_index,
+                    func_name,
+                    is_action,
+                    arg0,
+                    dump_args(args),
+                    json.dumps(list(env)),
+                )
+            )
+
+    db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", entry_rows)
+    db.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?)", call_rows)
+
+
+def rebuild_index(db, text):
+    clear_index(db)
+    for position, node in enumerate(node_parser.parse_nodes(text)):
+        insert_node(db, node, None, position, 0)
+
+
+# Returns the number of parsed nodes, or -1 if the whole index is rebuilt
+def update_index(db, text):
+    prefix, node_texts = split_node_texts(text)
+    if prefix.strip() or not node_texts:
+        rebuild_index(db, text)
+        return -1
+
+    old_nodes = {}
+    for node_id, node_hash, line_offset in db.execute(
+        "SELECT id, hash, line_offset FROM nodes"
+    ):
+        old_nodes.setdefault(node_hash, []).append((node_id, line_offset))
+
+    parsed_count = 0
+    try:
+        for position, ((_, node_text), line_offset) in enumerate(
+            zip(node_texts, iter_line_offsets(text, node_texts))
+        ):
+            node_hash = get_node_text_hash(node_text)
+            old = old_nodes.get(node_hash)
+            if old:
+                node_id, old_line_offset = old.pop()
+                db.execute(
+                    "UPDATE nodes SET position = ?, line_offset = ? WHERE id = ?",
+                    (position, line_offset, node_id),
+                )
+                if line_offset != old_line_offset:
+                    db.execute(
+                        "UPDATE entries SET line = line + ? WHERE node_id = ?",
+                        (line_offset - old_line_offset, node_id),
+                    )
+                continue
+
+            node = parse_node_text_cached(node_text, line_offset)
+            insert_node(db, node, node_hash, position, line_offset)
+            parsed_count += 1
+    except IncrementalParseFailed:
+        rebuild_index(db, text)
+        return -1
+
+    for old in old_nodes.values():
+        for node_id, _ in old:
+            delete_node(db, node_id)
+
+    return parsed_count
+
+
+def open_index(filename=in_filename, db_filename=index_filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    db = open_db(db_filename)
+    try:
+        with profiling.stage("update_index"):
+            update_index(db, text)
+            db.commit()
+    except Exception:
+        db.rollback()
+        db.close()
+        raise
+    return db
+
+
+def iter_node_names(db):
+    for (name,) in db.execute("SELECT name FROM nodes ORDER BY position"):
+        yield name
+
+
+# Yields (node position, node name, func_name, args) in the order of the scenario
+def iter_calls(db, func_names, arg0=None):
+    sql = (
+        "SELECT n.position, n.name, c.func_name, c.args FROM calls c "
+        "JOIN nodes n ON n.id = c.node_id "
+        f"WHERE c.func_name IN ({', '.join('?' * len(func_names))})"
+    )
+    params = list(func_names)
+    if arg0 is not None:
+        sql += f" AND c.arg0 IN ({', '.join('?' * len(arg0))})"
+        params += list(arg0)
+    sql += " ORDER BY n.position, c.entry_index, c.call_index"
+
+    for position, name, func_name, args in db.execute(sql, params):
+        yield position, name, func_name, load_args(args)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <SQL query>")
+        return
+
+    db = open_index()
+    for row in db.execute(sys.argv[1]):
+        print("\t".join(str(x) for x in row))
+
+
+if __name__ == "__main__":
+    from utils import run_merge
+
+    profiling.init()
+    run_merge()
+    main()
@@ -0,0 +1,150 @@
+# Compact column store of the entries returned by parse_chapters
+# Dialogues of all chapters are stored in one shared text buffer with int32 offsets,
+# and codes and character names are interned
+
+from array import array
+
+
+class StringPool:
+    def __init__(self):
+        self.strings = [""]
+        self.ids = {"": 0}
+
+    def add(self, s):
+        idx = self.ids.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings.append(s)
+            self.ids[s] = idx
+        return idx
+
+    def __getitem__(self, idx):
+        return self.strings[idx]
+
+
+class CompactScenario:
+    __slots__ = [
+        "code_pool",
+        "chara_pool",
+        "code_ids",
+        "chara_ids",
+        "dialogue_buffer",
+        "dialogue_offsets",
+        "lines",
+    ]
+
+    def __init__(self):
+        self.code_pool = StringPool()
+        self.chara_pool = StringPool()
+        self.code_ids = array("i")
+        self.chara_ids = array("i")
+        self.dialogue_buffer = ""
+        # dialogue_offsets[i] and dialogue_offsets[i + 1] are the range of entry i
+        self.dialogue_offsets = array("i", [0])
+        self.lines = array("i")
+
+    def __len__(self):
+        return len(self.lines)
+
+    def get_code(self, idx):
+        return self.code_pool[self.code_ids[idx]]
+
+    def get_chara_name(self, idx):
+        return self.chara_pool[self.chara_ids[idx]]
+
+    def get_dialogue(self, idx):
+        offsets = self.dialogue_offsets
+        return self.dialogue_buffer[offsets[idx] : offsets[idx + 1]]
+
+    def get_entry(self, idx):
+        return (
+            self.get_code(idx),
+            self.get_chara_name(idx),
+            self.get_dialogue(idx),
+            self.lines[idx],
+        )
+
+
+# A view of the entries of one chapter in a CompactScenario
+# It can be iterated and indexed like the list of entry tuples
+class CompactEntries:
+    __slots__ = ["scenario", "start", "stop"]
+
+    def __init__(self, scenario, start, stop):
+        self.scenario = scenario
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return CompactEntries(self.scenario, self.start + start, self.start + stop)
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("entry index out of range")
+        return self.scenario.get_entry(self.start + key)
+
+    def __iter__(self):
+        scenario = self.scenario
+        codes = scenario.code_pool.strings
+        charas = scenario.chara_pool.strings
+        code_ids = scenario.code_ids
+        chara_ids = scenario.chara_ids
+        buffer = scenario.dialogue_buffer
+        offsets = scenario.dialogue_offsets
+        lines = scenario.lines
+        for i in range(self.start, self.stop):
+            yield (
+                codes[code_ids[i]],
+                charas[chara_ids[i]],
+                buffer[offsets[i] : offsets[i + 1]],
+                lines[i],
+            )
+
+    # Scan one column without creating the entry tuples
+    def iter_chara_names(self):
+        charas = self.scenario.chara_pool.strings
+        chara_ids = self.scenario.chara_ids
+        for i in range(self.start, self.stop):
+            yield charas[chara_ids[i]]
+
+    def iter_dialogues(self):
+        buffer = self.scenario.dialogue_buffer
+        offsets = self.scenario.dialogue_offsets
+        for i in range(self.start, self.stop):
+            yield buffer[offsets[i] : offsets[i + 1]]
+
+
+def compact_chapters(chapters):
+    scenario = CompactScenario()
+    dialogues = []
+    offset = 0
+    out = []
+    for chapter_name, entries, head_eager_code, tail_eager_code in chapters:
+        start = len(scenario.lines)
+        for code, chara_name, dialogue, line_num in entries:
+            scenario.code_ids.append(scenario.code_pool.add(code))
+            scenario.chara_ids.append(scenario.chara_pool.add(chara_name or ""))
+            dialogues.append(dialogue)
+            offset += len(dialogue)
+            scenario.dialogue_offsets.append(offset)
+            scenario.lines.append(line_num)
+        stop = len(scenario.lines)
+        out.append(
+            (
+                chapter_name,
+                CompactEntries(scenario, start, stop),
+                head_eager_code,
+                tail_eager_code,
+            )
+        )
+
+    scenario.dialogue_buffer = "".join(dialogues)
+    return out
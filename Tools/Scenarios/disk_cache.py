@@ -0,0 +1,122 @@
+import hashlib
+import marshal
+import os
+import pickle
+import tempfile
+
+cache_root = ".cache"
+
+
+def hash_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            part = ""
+        h.update(part.encode("utf-8"))
+        # Separator that cannot appear in UTF-8
+        h.update(b"\xff")
+    return h.hexdigest()
+
+
+# Values are stored with marshal, so they can only contain builtin types
+# Least recently used files are evicted when the total size exceeds max_size
+class DiskCache:
+    def __init__(self, name, max_size, dumps=marshal.dumps, loads=marshal.loads):
+        self.cache_dir = os.path.join(cache_root, name)
+        self.max_size = max_size
+        self.dumps = dumps
+        self.loads = loads
+        self.hits = 0
+        self.misses = 0
+        # Estimated total size of files, to avoid scanning the directory on every put
+        self.total_size = None
+
+    def get_filename(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        filename = self.get_filename(key)
+        try:
+            with open(filename, "rb") as f:
+                value = self.loads(f.read())
+        # A corrupt or outdated pickle can also raise UnpicklingError,
+        # AttributeError or ImportError
+        except (
+            OSError,
+            EOFError,
+            ValueError,
+            TypeError,
+            pickle.UnpicklingError,
+            AttributeError,
+            ImportError,
+        ):
+            self.misses += 1
+            return None
+
+        # Update mtime for LRU
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = self.dumps(value)
+        if len(data) > self.max_size:
+            return
+
+        fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_filename, self.get_filename(key))
+        except OSError:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return
+
+        if self.total_size is None:
+            self.evict()
+        else:
+            self.total_size += len(data)
+            if self.total_size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        files = []
+        total_size = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                # Another process may evict the file after scandir
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+        self.total_size = total_size
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    os.remove(entry.path)
+        self.total_size = 0
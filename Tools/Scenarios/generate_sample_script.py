@@ -1,36 +1,355 @@
 #!/usr/bin/env python3
 
+# Without --corpus, print the test_upgrade scenario with d random edits:
+#   generate_sample_script.py [d]
+# With --corpus, write a synthetic scenario of any size for benchmarks:
+#   generate_sample_script.py --corpus --entries 1000000 --seed 0 --out-dir corpus
+# The corpus only depends on the seed and the sizes, so benchmark numbers
+# are comparable across commits
+
+import argparse
+import os
+import random
 import sys
-from random import randrange
 
-sys.stdout.reconfigure(encoding="utf-8")
+import profiling
+from auto_voice import auto_voice_charas
+
+corpus_chara_names = {
+    "李竹内": "Zhunei",
+    "王二宫": "Ergong",
+    "张浅野": "Qianye",
+    "孙西本": "Xiben",
+    "陈高天": "Gaotian",
+    "班长": "Monitor",
+    "老师": "Teacher",
+}
+corpus_bg_names = ["room", "toilet", "corridor", "staff", "classroom", "roof", "street"]
+corpus_bg_suffixes = ["", "_day", "_sunset", "_night", "_blur"]
+corpus_bgm_names = ["prelude", "qianye", "gaotian", "xiben", "final", "black"]
+corpus_standing_names = ["qianye", "gaotian", "xiben", "ergong"]
+corpus_timeline_names = ["opening", "flashback", "ending"]
+corpus_sound_names = ["flap", "door", "step", "bell"]
+corpus_poses = ["normal", "smile", "angry", "sad", "surprised"]
+corpus_positions = ["pos_l", "pos_c", "pos_r"]
+corpus_phrases = [
+    "我",
+    "你",
+    "他",
+    "她们",
+    "今天",
+    "走廊",
+    "教室",
+    "学生会",
+    "镜子",
+    "墨镜",
+    "灯光",
+    "奶茶",
+    "北条先生",
+    "看着",
+    "想起了",
+    "没有说话",
+    "好像",
+    "什么",
+    "奇妙之物",
+    "时机到了",
+    "，",
+    "，",
+    "……",
+    "——",
+]
+corpus_rich_tags = [
+    ("<b>", "</b>"),
+    ("<i>", "</i>"),
+    ("<color=#ff8000>", "</color>"),
+    ("<size=120%>", "</size>"),
+]
+
+# Probabilities for each entry
+p_code = 0.3
+p_attr_code = 0.02
+p_named = 0.6
+p_multi_chara = 0.03
+p_disp_name = 0.05
+p_rich = 0.05
+p_todo = 0.01
+# Probability of say(obj, 'voice', 0, false), which keeps the auto voice
+p_say_keep_auto_voice = 0.2
+
+
+def print_upgrade(d):
+    sys.stdout.reconfigure(encoding="utf-8")
+
+    label = "test_upgrade"
+    n = 100
+    print("@<|")
+    print(f"label '{label}'")
+    print("is_debug()")
+    print("|>")
+    print("<|")
+    print("set_box()")
+    print("|>")
+
+    def diag(x):
+        return f"对话{x:3}"
+
+    a = list(map(diag, range(100)))
+
+    for _ in range(d):
+        if len(a) > 0 and random.randrange(2) == 0:
+            a.pop(random.randrange(len(a)))
+        else:
+            a.insert(random.randrange(len(a) + 1), diag(n))
+            n += 1
+
+    print("\n\n".join(a))
+    print("@<| is_end() |>")
+
+
+class ChapterGenerator:
+    def __init__(self, seed, chapter_idx, n_chapters, n_entries):
+        # Each chapter has its own random state, so chapters can be generated
+        # in any order with the same result
+        self.rng = random.Random(f"{seed}/{chapter_idx}")
+        self.chapter_idx = chapter_idx
+        self.n_chapters = n_chapters
+        self.n_entries = n_entries
+        self.anim_hold = False
+        self.bgm_playing = False
+        self.auto_voice = set()
+
+    def node_name(self, node_idx):
+        return f"c{self.chapter_idx}_n{node_idx}"
+
+    def gen_dialogue(self):
+        rng = self.rng
+        s = "".join(rng.choices(corpus_phrases, k=rng.randint(2, 20)))
+        if rng.random() < p_rich:
+            start, end = rng.choice(corpus_rich_tags)
+            i = rng.randint(0, len(s))
+            j = rng.randint(i, len(s))
+            s = s[:i] + start + s[i:j] + end + s[j:]
+        if rng.random() < p_todo:
+            s += f"（TODO：{rng.choice(['配音', '立绘', '校对'])}：{rng.choice(corpus_phrases)}）"
+        return s
+
+    def gen_chara_name(self):
+        rng = self.rng
+        names = list(corpus_chara_names)
+        if rng.random() < p_multi_chara:
+            return "&".join(rng.sample(names, 2))
+        return rng.choice(names)
+
+    def gen_call(self):
+        rng = self.rng
+        x = rng.random()
+        if x < 0.15:
+            bg = rng.choice(corpus_bg_names) + rng.choice(corpus_bg_suffixes)
+            return f"show(bg, '{bg}')"
+        elif x < 0.25:
+            bg = rng.choice(corpus_bg_names) + rng.choice(corpus_bg_suffixes)
+            trans = rng.choice(["trans", "trans2", "trans_left", "trans_right"])
+            return f"{trans}(bg, '{bg}', 'fade', {rng.randint(1, 3)})"
+        elif x < 0.3:
+            bg = rng.choice(corpus_bg_names)
+            return (
+                "anim:trans_fade(cam, function()\n"
+                f"        show(bg, '{bg}', {{0, 0, 1}})\n"
+                f"    end, {rng.randint(1, 3)})"
+            )
+        elif x < 0.45:
+            chara = rng.choice(corpus_standing_names)
+            pose = rng.choice(corpus_poses)
+            pos = rng.choice(corpus_positions)
+            return f"show({chara}, '{pose}', {pos})"
+        elif x < 0.5:
+            return f"hide({rng.choice(corpus_standing_names)})"
+        elif x < 0.6:
+            dx = rng.randint(-5, 5)
+            dy = rng.randint(-5, 5) / 10
+            return f"anim:move(cam, {{{dx}, {dy}, 1}}, 1):wait(0.5)"
+        elif x < 0.65:
+            if self.anim_hold:
+                self.anim_hold = False
+                return "anim_hold:stop()\nanim_hold_end()"
+            else:
+                self.anim_hold = True
+                return "anim_hold_begin()\nanim_hold:move(bg, {5, 0}, 10)"
+        elif x < 0.7:
+            if self.bgm_playing and rng.random() < 0.3:
+                self.bgm_playing = False
+                return "fade_out(bgm, 1)"
+            self.bgm_playing = True
+            return f"play(bgm, '{rng.choice(corpus_bgm_names)}')"
+        elif x < 0.75:
+            return f"sound('{rng.choice(corpus_sound_names)}', 0.5)"
+        elif x < 0.8:
+            # Only the characters with auto voice configs
+            chara = rng.choice(list(auto_voice_charas))
+            if chara in self.auto_voice:
+                self.auto_voice.remove(chara)
+                return f"auto_voice_off('{chara}')"
+            self.auto_voice.add(chara)
+            return f"auto_voice_on('{chara}', {rng.randint(1, 999999):06d})"
+        elif x < 0.83:
+            # The character controller object, like say(xiben, '003007')
+            obj = rng.choice(list(auto_voice_charas.values()))
+            voice = f"{rng.randint(1, 999999):06d}"
+            if rng.random() < p_say_keep_auto_voice:
+                return f"say({obj}, '{voice}', 0, false)"
+            return f"say({obj}, '{voice}')"
+        elif x < 0.86:
+            return f"timeline('{rng.choice(corpus_timeline_names)}')"
+        elif x < 0.88:
+            return "timeline_hide()"
+        elif x < 0.9:
+            return f"action(show, bg, '{rng.choice(corpus_bg_names)}')"
+        elif x < 0.93:
+            return "v_flag = (v_flag or 0) + 1"
+        else:
+            return f"wait({rng.randint(1, 20) / 10})"
+
+    def gen_code_block(self):
+        rng = self.rng
+        calls = [self.gen_call() for _ in range(rng.randint(1, 4))]
+        attrs = "[stage = before_checkpoint]" if rng.random() < p_attr_code else ""
+        return attrs + "<|\n" + "\n".join(calls) + "\n|>\n"
+
+    def gen_tail(self, node_idx, is_last_node):
+        rng = self.rng
+        if is_last_node:
+            if self.chapter_idx == self.n_chapters - 1:
+                return "@<| is_end() |>\n"
+            return f"@<| jump_to 'c{self.chapter_idx + 1}_n0' |>\n"
+
+        next_node = self.node_name(node_idx + 1)
+        if rng.random() < 0.7:
+            return f"@<| jump_to '{next_node}' |>\n"
+
+        branches = [f"    {{ dest = '{next_node}', text = '继续' }},"]
+        for i in range(rng.randint(1, 3)):
+            mode = rng.choice(["", "show", "enable", "jump"])
+            if mode:
+                branches.append(
+                    f"    {{ dest = '{next_node}', text = '选项{i}', "
+                    f"mode = '{mode}', cond = 'v_flag > {i}' }},"
+                )
+            else:
+                branches.append(f"    {{ dest = '{next_node}', text = '选项{i}' }},")
+        return "@<|\nbranch {\n" + "\n".join(branches) + "\n}\n|>\n"
+
+    # Writes the chapter and its localized copy
+    def write(self, f, f_localized):
+        rng = self.rng
+        entry_idx = 0
+        node_idx = 0
+        while entry_idx < self.n_entries:
+            node_entries = min(rng.randint(20, 200), self.n_entries - entry_idx)
+            is_last_node = entry_idx + node_entries >= self.n_entries
+            name = self.node_name(node_idx)
+
+            head = f"label('{name}', '第{self.chapter_idx}章第{node_idx}节')"
+            head_localized = (
+                f"label('{name}', 'Chapter {self.chapter_idx} Part {node_idx}')"
+            )
+            if node_idx == 0:
+                head += "\nis_start()" if self.chapter_idx == 0 else "\nis_chapter()"
+            f.write(f"@<|\n{head}\n|>\n")
+            f_localized.write(f"@<|\n{head_localized}\n|>\n")
+
+            for i in range(node_entries):
+                if rng.random() < p_code:
+                    f.write(self.gen_code_block())
+                # Close anim_hold in the last entry of the node
+                if i == node_entries - 1 and self.anim_hold:
+                    self.anim_hold = False
+                    f.write("<|\nanim_hold:stop()\nanim_hold_end()\n|>\n")
+
+                dialogue = self.gen_dialogue()
+                dialogue_localized = f"Line {entry_idx + i} of {name}."
+                if rng.random() < p_named:
+                    chara_name = self.gen_chara_name()
+                    chara_name_localized = "&".join(
+                        corpus_chara_names[x] for x in chara_name.split("&")
+                    )
+                    if rng.random() < p_disp_name:
+                        disp_name = "？？？//"
+                        disp_name_localized = "? ? ?//"
+                    else:
+                        disp_name = ""
+                        disp_name_localized = ""
+                    f.write(f"{disp_name}{chara_name}：：“{dialogue}”\n\n")
+                    f_localized.write(
+                        f"{disp_name_localized}{chara_name_localized}::"
+                        f"“{dialogue_localized}”\n\n"
+                    )
+                else:
+                    f.write(f"{dialogue}\n\n")
+                    f_localized.write(f"{dialogue_localized}\n\n")
+
+            tail = self.gen_tail(node_idx, is_last_node)
+            f.write(tail)
+            f_localized.write(tail)
+            f.write("\n")
+            f_localized.write("\n")
+
+            entry_idx += node_entries
+            node_idx += 1
+
+
+def write_corpus(out_dir, n_entries, n_chapters, seed, locale="English"):
+    scenario_dir = os.path.join(out_dir, "Scenarios")
+    localized_dir = os.path.join(out_dir, "LocalizedResources", locale, "Scenarios")
+    os.makedirs(scenario_dir, exist_ok=True)
+    os.makedirs(localized_dir, exist_ok=True)
+
+    with open(
+        os.path.join(out_dir, "template.txt"), "w", encoding="utf-8", newline="\n"
+    ) as f_template:
+        for chapter_idx in range(n_chapters):
+            # Distribute the remainder to the first chapters
+            chapter_entries = n_entries // n_chapters + (
+                chapter_idx < n_entries % n_chapters
+            )
+            filename = f"corpus_{chapter_idx:04d}.txt"
+            with open(
+                os.path.join(scenario_dir, filename),
+                "w",
+                encoding="utf-8",
+                newline="\n",
+            ) as f, open(
+                os.path.join(localized_dir, filename),
+                "w",
+                encoding="utf-8",
+                newline="\n",
+            ) as f_localized:
+                ChapterGenerator(seed, chapter_idx, n_chapters, chapter_entries).write(
+                    f, f_localized
+                )
 
-label = "test_upgrade"
-n = 100
-d = 0
-if len(sys.argv) > 1:
-    d = int(sys.argv[1])
-print("@<|")
-print(f"label '{label}'")
-print("is_debug()")
-print("|>")
-print("<|")
-print("set_box()")
-print("|>")
+            if chapter_idx > 0:
+                f_template.write("\n")
+            f_template.write(f"@include {filename}\n")
 
 
-def diag(x):
-    return f"对话{x:3}"
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("d", nargs="?", type=int, default=0)
+    parser.add_argument("--corpus", action="store_true")
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--chapters", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out-dir", default="corpus")
+    args = parser.parse_args()
 
+    if not args.corpus:
+        print_upgrade(args.d)
+        return
 
-a = list(map(diag, range(100)))
+    n_chapters = args.chapters or max(1, args.entries // 5000)
+    write_corpus(args.out_dir, args.entries, n_chapters, args.seed)
 
-for _ in range(d):
-    if len(a) > 0 and randrange(2) == 0:
-        a.pop(randrange(len(a)))
-    else:
-        a.insert(randrange(len(a) + 1), diag(n))
-        n += 1
 
-print("\n\n".join(a))
-print("@<| is_end() |>")
+if __name__ == "__main__":
+    profiling.init()
+    main()
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
-import os
 import re
 import unicodedata
 
+import profiling
 from lua_parser import is_nil, walk_functions
 from nova_script_parser import normalize_dialogue, parse_chapters
+from scenario_loader import load_files
+from scenario_visitor import Visitor, run_visitors
 
 in_dir = "../../Assets/Resources/Scenarios/"
 template_filename = "template.txt"
@@ -19,103 +21,138 @@ def is_special_char(c):
     return c != "\n" and unicodedata.category(c)[0] == "C"
 
 
-def check_code(code, line_num, anim_hold_tracked):
-    for c in code:
-        if is_special_char(c):
-            print_warn(line_num, f"special character U+{ord(c):04X} in code")
+class LintVisitor(Visitor):
+    func_names = None
+    unwrap_action = False
+    tracked_env = frozenset({"anim", "anim_hold", "named_anim_hold"})
 
-    if "TODO" in code:
-        print_warn(line_num, "TODO in code")
+    # Dialogue checks are for Chinese, and they are skipped for localized scenarios
+    def __init__(self, check_dialogues=True):
+        self.check_dialogues = check_dialogues
 
-    check_anim_hold_override = False
-    check_show = False
-    check_trans = False
-    wait_time = 0
-    is_immediate_step = False
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        print(chapter_name)
+        self.anim_hold_tracked = False
+        self.line_num = None
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        self.line_num = line_num
+        self.check_anim_hold_override = False
+        self.check_show = False
+        self.check_trans = False
+        self.wait_time = 0
+        self.is_immediate_step = False
+        self.code_error = False
+
+        for c in code:
+            if is_special_char(c):
+                print_warn(line_num, f"special character U+{ord(c):04X} in code")
+
+        if "TODO" in code:
+            print_warn(line_num, "TODO in code")
+
+    def visit_call(self, func_name, args, env):
+        # Stop checking the code after an error, and report the error once
+        if self.code_error:
+            return
+
+        try:
+            self.check_call(func_name, args, env)
+        except Exception as e:
+            self.visit_error(e)
+
+    def visit_error(self, e):
+        if not self.code_error:
+            self.code_error = True
+            print_warn(self.line_num, f"error when parsing code: {e}")
+
+    def check_call(self, func_name, args, env):
+        line_num = self.line_num
+
+        for name in (func_name,) + args:
+            if name == "anim_hold_begin":
+                if self.anim_hold_tracked:
+                    print_warn(line_num, "anim_hold_begin() not match")
+                else:
+                    self.anim_hold_tracked = True
 
-    try:
-        for func_name, args, env in walk_functions(
-            code, tracked_env={"anim", "anim_hold", "named_anim_hold"}
-        ):
-            for name in (func_name,) + args:
-                if name == "anim_hold_begin":
-                    if anim_hold_tracked:
-                        print_warn(line_num, "anim_hold_begin() not match")
-                    else:
-                        anim_hold_tracked = True
+                if env:
+                    self.check_anim_hold_override = True
 
-                    if env:
-                        check_anim_hold_override = True
+                if "anim_hold" in env or "named_anim_hold" in env:
+                    print_warn(line_num, "anim_hold_begin() in anim_hold")
 
-                    if "anim_hold" in env or "named_anim_hold" in env:
-                        print_warn(line_num, "anim_hold_begin() in anim_hold")
+            elif name == "anim_hold_end":
+                if self.anim_hold_tracked:
+                    self.anim_hold_tracked = False
+                else:
+                    print_warn(line_num, "anim_hold_end() not match")
 
-                elif name == "anim_hold_end":
-                    if anim_hold_tracked:
-                        anim_hold_tracked = False
-                    else:
-                        print_warn(line_num, "anim_hold_end() not match")
+                if env:
+                    self.check_anim_hold_override = True
 
-                    if env:
-                        check_anim_hold_override = True
+                if "anim_hold" in env or "named_anim_hold" in env:
+                    print_warn(line_num, "anim_hold_end() in anim_hold")
 
-                    if "anim_hold" in env or "named_anim_hold" in env:
-                        print_warn(line_num, "anim_hold_end() in anim_hold")
+        if func_name == "anim":
+            self.wait_time = 0
 
-            if func_name == "anim":
-                wait_time = 0
+            if env:
+                print_warn(line_num, "anim in anon function")
 
-                if env:
-                    print_warn(line_num, "anim in anon function")
+        elif func_name in ["anim_hold", "named_anim_hold"]:
+            self.wait_time = 0
 
-            elif func_name in ["anim_hold", "named_anim_hold"]:
-                wait_time = 0
+            if not self.anim_hold_tracked:
+                print_warn(line_num, "anim_hold not tracked")
 
-                if not anim_hold_tracked:
-                    print_warn(line_num, "anim_hold not tracked")
+            if self.check_anim_hold_override and not env:
+                print_warn(
+                    line_num,
+                    "anim_hold overridden by anim_hold_begin() or anim_hold_end()",
+                )
 
-                if check_anim_hold_override and not env:
-                    print_warn(
-                        line_num,
-                        "anim_hold overridden by anim_hold_begin() or anim_hold_end()",
-                    )
+            if "anim_hold" in env or "named_anim_hold" in env:
+                print_warn(line_num, "anim_hold in anim_hold")
 
-                if "anim_hold" in env or "named_anim_hold" in env:
-                    print_warn(line_num, "anim_hold in anim_hold")
-
-            elif func_name == "show":
-                if not env and not any(
-                    args[0].startswith(x) for x in ["bg", "fg", "ui_img"]
-                ):
-                    check_show = True
-
-            elif func_name.startswith("trans"):
-                if (
-                    len(args) >= 2
-                    and args[0].startswith("cam")
-                    and not is_nil(args[1])
-                    and wait_time <= 0.1
-                ):
-                    check_trans = True
-
-            elif func_name == "wait":
-                if isinstance(args[0], (int, float)):
-                    wait_time += args[0]
-
-            elif func_name == "move":
-                if len(args) >= 3 and isinstance(args[2], (int, float)):
-                    wait_time += args[2]
-
-            elif func_name == "immediate_step":
-                is_immediate_step = True
+        elif func_name == "show":
+            if not env and not any(
+                args[0].startswith(x) for x in ["bg", "fg", "ui_img"]
+            ):
+                self.check_show = True
 
-    except Exception as e:
-        print_warn(line_num, f"error when parsing code: {e}")
+        elif func_name.startswith("trans"):
+            if (
+                len(args) >= 2
+                and args[0].startswith("cam")
+                and not is_nil(args[1])
+                and self.wait_time <= 0.1
+            ):
+                self.check_trans = True
+
+        elif func_name == "wait":
+            if isinstance(args[0], (int, float)):
+                self.wait_time += args[0]
+
+        elif func_name == "move":
+            if len(args) >= 3 and isinstance(args[2], (int, float)):
+                self.wait_time += args[2]
+
+        elif func_name == "immediate_step":
+            self.is_immediate_step = True
+
+    def end_entry(self, code, chara_name, dialogue, line_num):
+        if self.check_show and self.check_trans:
+            print_warn(line_num, "show() outside of trans()")
+
+        if not self.is_immediate_step and not dialogue:
+            print_warn(line_num, "code block with empty dialogue")
 
-    if check_show and check_trans:
-        print_warn(line_num, "show() outside of trans()")
+        if dialogue and self.check_dialogues:
+            check_dialogue(chara_name, dialogue, line_num)
 
-    return anim_hold_tracked, is_immediate_step
+    def end_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        check_tail(tail_eager_code, self.line_num)
 
 
 def check_tail(code, line_num):
@@ -172,35 +209,16 @@ def lint_file(in_filename):
     with open(in_filename, "r", encoding="utf-8") as f:
         chapters = parse_chapters(f)
 
-    for chapter_name, entries, _, tail_eager_code in chapters:
-        print(chapter_name)
-
-        anim_hold_tracked = False
-        for code, chara_name, dialogue, line_num in entries:
-            is_immediate_step = False
-            if code:
-                anim_hold_tracked, is_immediate_step = check_code(
-                    code, line_num, anim_hold_tracked
-                )
-
-            if not is_immediate_step and not dialogue:
-                print_warn(line_num, "code block with empty dialogue")
-
-            if dialogue:
-                check_dialogue(chara_name, dialogue, line_num)
-
-        check_tail(tail_eager_code, line_num)
+    run_visitors(chapters, [LintVisitor()])
 
 
 def main():
-    with open(template_filename, "r", encoding="utf-8") as f_template:
-        for line in f_template:
-            if line.startswith("@include"):
-                in_filename = os.path.join(in_dir, line.strip().split()[1])
-                print(in_filename)
-                lint_file(in_filename)
-                print()
+    for in_filename, chapters in load_files(template_filename, in_dir):
+        print(in_filename)
+        run_visitors(chapters, [LintVisitor()])
+        print()
 
 
 if __name__ == "__main__":
+    profiling.init()
     main()
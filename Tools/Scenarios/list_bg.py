@@ -1,61 +1,63 @@
 #!/usr/bin/env python3
 
-from lua_parser import walk_functions
-from nova_script_parser import parse_chapters
+import profiling
+from call_index import iter_calls, iter_node_names, open_index
+from scenario_visitor import Visitor
 
 in_filename = "scenario.txt"
 
 
-def do_chapter(entries, bg_list):
-    for code, _, _, _ in entries:
-        if not code:
-            continue
-
-        for func_name, args, _ in walk_functions(code):
-            if func_name == "action":
-                func_name = args[0]
-                args = args[1:]
-
-            if (
-                func_name
-                in [
-                    "show",
-                    "trans",
-                    "trans2",
-                    "trans_fade",
-                    "trans_left",
-                    "trans_right",
-                    "trans_up",
-                    "trans_down",
-                ]
-                and args[0].startswith("bg")
-                and isinstance(args[1], str)
-            ):
-                bg_name = args[1]
-                if bg_name not in bg_list:
-                    bg_list.append(bg_name)
-            elif func_name == "show_loop" and args[0].startswith("bg"):
-                for bg_name in args[1]:
-                    if bg_name not in bg_list:
-                        bg_list.append(bg_name)
+class BgListVisitor(Visitor):
+    func_names = [
+        "show",
+        "trans",
+        "trans2",
+        "trans_fade",
+        "trans_left",
+        "trans_right",
+        "trans_up",
+        "trans_down",
+        "show_loop",
+    ]
+
+    def __init__(self):
+        # Used as an ordered set, so names are kept in the order of first use
+        self.bg_list = {}
+
+    def add_bg_name(self, bg_name):
+        self.bg_list[bg_name] = None
+
+    def visit_call(self, func_name, args, env):
+        if not (isinstance(args[0], str) and args[0].startswith("bg")):
+            return
+
+        if func_name == "show_loop":
+            for bg_name in args[1]:
+                self.add_bg_name(bg_name)
+        elif isinstance(args[1], str):
+            self.add_bg_name(args[1])
+
+    def end(self):
+        for x in self.bg_list:
+            print(x)
 
 
 def main():
-    with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+    db = open_index(in_filename)
 
-    bg_list = []
-    for chapter_name, entries, _, _ in chapters:
+    for chapter_name in iter_node_names(db):
         print(chapter_name)
-        do_chapter(entries, bg_list)
     print()
 
-    for x in bg_list:
-        print(x)
+    visitor = BgListVisitor()
+    for _, _, func_name, args in iter_calls(db, visitor.func_names):
+        visitor.visit_call(func_name, args, ())
+    visitor.end()
 
 
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
@@ -1,43 +1,44 @@
 #!/usr/bin/env python3
 
-from lua_parser import walk_functions
-from nova_script_parser import parse_chapters
+import profiling
+from call_index import iter_calls, iter_node_names, open_index
+from scenario_visitor import Visitor
 
 in_filename = "scenario.txt"
 
 
-def do_chapter(entries, bgm_list):
-    for code, _, _, _ in entries:
-        if not code:
-            continue
+class BgmListVisitor(Visitor):
+    func_names = ["play", "fade_in"]
 
-        for func_name, args, _ in walk_functions(code):
-            if func_name == "action":
-                func_name = args[0]
-                args = args[1:]
+    def __init__(self):
+        # Used as an ordered set, so names are kept in the order of first use
+        self.bgm_list = {}
 
-            if func_name in ["play", "fade_in"] and args[0] == "bgm":
-                bgm_name = args[1]
-                if bgm_name not in bgm_list:
-                    bgm_list.append(bgm_name)
+    def visit_call(self, func_name, args, env):
+        if args[0] == "bgm":
+            self.bgm_list[args[1]] = None
+
+    def end(self):
+        for x in self.bgm_list:
+            print(x)
 
 
 def main():
-    with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+    db = open_index(in_filename)
 
-    bgm_list = []
-    for chapter_name, entries, _, _ in chapters:
+    for chapter_name in iter_node_names(db):
         print(chapter_name)
-        do_chapter(entries, bgm_list)
     print()
 
-    for x in bgm_list:
-        print(x)
+    visitor = BgmListVisitor()
+    for _, _, func_name, args in iter_calls(db, visitor.func_names, arg0=["bgm"]):
+        visitor.visit_call(func_name, args, ())
+    visitor.end()
 
 
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-from lua_parser import is_nil, walk_functions
-from nova_script_parser import parse_chapters
+import profiling
+from call_index import iter_calls, iter_node_names, open_index
+from lua_parser import is_nil
+from scenario_visitor import Visitor
 
 in_filename = "scenario.txt"
 
@@ -75,7 +77,9 @@ def typed_sign(x):
 
 
 def typed_item(x):
-    if isinstance(x, (int, float)):
+    if isinstance(x, bool):
+        return 4, x
+    elif isinstance(x, (int, float)):
         return 0, typed_sign(x), abs(x)
     elif isinstance(x, str):
         return 1, x
@@ -87,83 +91,113 @@ def typed_item(x):
         raise ValueError(f"Unknown type: {type(x)}")
 
 
+class PosVisitor(Visitor):
+    func_names = [
+        "show",
+        "trans",
+        "trans2",
+        "trans_fade",
+        "trans_left",
+        "trans_right",
+        "trans_up",
+        "trans_down",
+        "show_loop",
+        "hide",
+        "move",
+    ]
+
+    def __init__(self):
+        self.bg_name_to_pos_set = {}
+        self.bg_name_to_cam_pos_set = {}
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        self.now_bg_name = None
+        self.now_bg_pos = ()
+        self.now_cam_pos = ()
+
+    def visit_call(self, func_name, args, env):
+        if func_name == "show" and args[0] == "bg" and isinstance(args[1], str):
+            self.now_bg_name = normalize_bg_name(args[1])
+            if len(args) >= 3:
+                self.now_bg_pos = update_pos(self.now_bg_pos, args[2], DEFAULT_BG_POS)
+            self.add_bg_pos()
+            self.add_cam_pos()
+
+        elif (
+            func_name
+            in [
+                "trans",
+                "trans2",
+                "trans_fade",
+                "trans_left",
+                "trans_right",
+                "trans_up",
+                "trans_down",
+            ]
+            and args[0] == "bg"
+            and isinstance(args[1], str)
+        ):
+            self.now_bg_name = normalize_bg_name(args[1])
+            self.add_bg_pos()
+            self.add_cam_pos()
+
+        elif func_name == "show_loop" and args[0] == "bg":
+            self.now_bg_name = normalize_bg_name(args[1][0])
+            self.add_bg_pos()
+            self.add_cam_pos()
+
+        elif func_name == "hide" and args[0] == "bg":
+            self.now_bg_name = None
+
+        elif func_name == "move" and args[0] == "bg":
+            self.now_bg_pos = update_pos(self.now_bg_pos, args[1], DEFAULT_BG_POS)
+            self.add_bg_pos()
+
+        elif func_name == "move" and args[0] == "cam":
+            self.now_cam_pos = update_pos(self.now_cam_pos, args[1], DEFAULT_CAM_POS)
+            self.add_cam_pos()
+
+    def add_bg_pos(self):
+        dict_set_add(self.bg_name_to_pos_set, self.now_bg_name, self.now_bg_pos)
+
+    def add_cam_pos(self):
+        dict_set_add(self.bg_name_to_cam_pos_set, self.now_bg_name, self.now_cam_pos)
+
+    def end(self):
+        keys = [x for x in self.bg_name_to_pos_set.keys() if x]
+        for k in sorted(keys):
+            print(k)
+            print("pos:")
+            for pos in sorted(self.bg_name_to_pos_set[k], key=typed_item):
+                print(pos)
+            print("cam_pos:")
+            for pos in sorted(self.bg_name_to_cam_pos_set[k], key=typed_item):
+                print(pos)
+            print()
+
+
 def main():
-    with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+    db = open_index(in_filename)
 
-    bg_name_to_pos_set = {}
-    bg_name_to_cam_pos_set = {}
-    for chapter_name, entries, _, _ in chapters:
+    for chapter_name in iter_node_names(db):
         print(chapter_name)
-        now_bg_name = None
-        now_bg_pos = ()
-        now_cam_pos = ()
-        for code, _, _, _ in entries:
-            if not code:
-                continue
-
-            for func_name, args, _ in walk_functions(code):
-                if func_name == "action":
-                    func_name = args[0]
-                    args = args[1:]
-
-                if func_name == "show" and args[0] == "bg" and isinstance(args[1], str):
-                    now_bg_name = normalize_bg_name(args[1])
-                    if len(args) >= 3:
-                        now_bg_pos = update_pos(now_bg_pos, args[2], DEFAULT_BG_POS)
-                    dict_set_add(bg_name_to_pos_set, now_bg_name, now_bg_pos)
-                    dict_set_add(bg_name_to_cam_pos_set, now_bg_name, now_cam_pos)
-
-                elif (
-                    func_name
-                    in [
-                        "trans",
-                        "trans2",
-                        "trans_fade",
-                        "trans_left",
-                        "trans_right",
-                        "trans_up",
-                        "trans_down",
-                    ]
-                    and args[0] == "bg"
-                    and isinstance(args[1], str)
-                ):
-                    now_bg_name = normalize_bg_name(args[1])
-                    dict_set_add(bg_name_to_pos_set, now_bg_name, now_bg_pos)
-                    dict_set_add(bg_name_to_cam_pos_set, now_bg_name, now_cam_pos)
-
-                elif func_name == "show_loop" and args[0] == "bg":
-                    now_bg_name = normalize_bg_name(args[1][0])
-                    dict_set_add(bg_name_to_pos_set, now_bg_name, now_bg_pos)
-                    dict_set_add(bg_name_to_cam_pos_set, now_bg_name, now_cam_pos)
-
-                elif func_name == "hide" and args[0] == "bg":
-                    now_bg_name = None
-
-                elif func_name == "move" and args[0] == "bg":
-                    now_bg_pos = update_pos(now_bg_pos, args[1], DEFAULT_BG_POS)
-                    dict_set_add(bg_name_to_pos_set, now_bg_name, now_bg_pos)
-
-                elif func_name == "move" and args[0] == "cam":
-                    now_cam_pos = update_pos(now_cam_pos, args[1], DEFAULT_CAM_POS)
-                    dict_set_add(bg_name_to_cam_pos_set, now_bg_name, now_cam_pos)
-
     print()
 
-    keys = [x for x in bg_name_to_pos_set.keys() if x]
-    for k in sorted(keys):
-        print(k)
-        print("pos:")
-        for pos in sorted(bg_name_to_pos_set[k], key=typed_item):
-            print(pos)
-        print("cam_pos:")
-        for pos in sorted(bg_name_to_cam_pos_set[k], key=typed_item):
-            print(pos)
-        print()
+    visitor = PosVisitor()
+    now_position = None
+    for position, chapter_name, func_name, args in iter_calls(
+        db, visitor.func_names, arg0=["bg", "cam"]
+    ):
+        if position != now_position:
+            now_position = position
+            visitor.begin_chapter(chapter_name, None, None)
+        visitor.visit_call(func_name, args, ())
+    visitor.end()
 
 
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
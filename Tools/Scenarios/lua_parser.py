@@ -1,6 +1,29 @@
+import atexit
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+
 from antlr4 import ParserRuleContext
 from speedy_antlr_lua_parser import LuaParser, parse_chunk
 
+# Calls extracted from a code block are cached by the exact code string
+use_call_cache = True
+call_cache_max_len = 65536
+# Optionally persist the cache in a SQLite database shared by all tools
+use_persistent_call_cache = False
+persistent_call_cache_filename = ".cache/lua_calls.sqlite"
+persistent_call_cache_max_len = 1048576
+# Change it when the extracted calls change, so old rows are not used
+call_cache_version = "2"
+# Flat calls with literal args are extracted without ANTLR
+use_fast_path = True
+# Walk the parse tree with an explicit stack instead of recursive generators
+use_iterative_walk = True
+
 
 class NIL:
     def __repr__(self):
@@ -120,13 +143,13 @@ def get_exp_content(node):
     if content:
         return NIL()
 
-    # content = node.FALSE()
-    # if content:
-    #     return False
-    #
-    # content = node.TRUE()
-    # if content:
-    #     return True
+    content = node.FALSE()
+    if content:
+        return False
+
+    content = node.TRUE()
+    if content:
+        return True
 
     content = node.number()
     if content:
@@ -227,20 +250,517 @@ def walk_functions_node(node, env, lazy_args, tracked_env):
                 yield from walk_functions_node(child, env, lazy_args, tracked_env)
 
 
-def walk_functions(code, *, lazy_args=False, tracked_env=None):
-    if tracked_env is None:
-        tracked_env = set()
+# Same as walk_functions_node, but env is an immutable tuple,
+# so the env of a statement can be restored without copying
+def walk_functions_node_iterative(node, lazy_args, tracked_env):
+    env = ()
+    # Items are nodes, or (is_call, x) markers:
+    # (True, node) yields the function call after walking all but its last child,
+    # and (False, env) restores env after walking a statement
+    stack = [node]
+    while stack:
+        item = stack.pop()
+
+        if item.__class__ is tuple:
+            is_call, x = item
+            if not is_call:
+                env = x
+                continue
+
+            name = get_function_name(x)
+            if isinstance(name, tuple):
+                before_name, name = name
+                yield before_name, (), env
+            else:
+                before_name = None
 
+            if lazy_args:
+                args = get_function_args_lazy(x.args())
+            else:
+                args = get_function_args(x.args())
+            yield name, args, env
+
+            if before_name in tracked_env:
+                env += (before_name,)
+            if name in tracked_env:
+                env += (name,)
+
+            stack.append(x.children[-1])
+            continue
+
+        children = item.children
+        if isinstance(item, LuaParser.FunctioncallContext):
+            stack.append((True, item))
+            children = children[:-1]
+        elif isinstance(item, LuaParser.StatContext):
+            stack.append((False, env))
+        if children:
+            for child in reversed(children):
+                if isinstance(child, ParserRuleContext):
+                    stack.append(child)
+
+
+def walk_functions_uncached(code, lazy_args, tracked_env):
     try:
         chunk = parse_chunk(code)
         for stat in chunk.block().stat():
-            yield from walk_functions_node(stat, [], lazy_args, tracked_env)
+            if use_iterative_walk:
+                yield from walk_functions_node_iterative(stat, lazy_args, tracked_env)
+            else:
+                yield from walk_functions_node(stat, [], lazy_args, tracked_env)
     except Exception as e:
         print(e)
         print(code)
         raise
 
 
+# Fast path for the common subset of Lua in scenarios:
+# statements are calls like `a.b(...)`, `a:b(...)`, `a:b(...):c(...)`,
+# and args are names, numbers, strings without escapes, nil, true, false, tables,
+# nested calls, and anonymous functions containing such statements
+# For anything else, the code is handed to ANTLR
+
+fast_path_token_pattern = re.compile(
+    r"""
+    (?P<space>[ \t\f\r\n]+)
+    |(?P<comment>--(?!\[)[^\n]*)
+    |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)(?![A-Za-z0-9_.])
+    |(?P<string>"[^"\\\n]*"|'[^'\\\n]*')
+    |(?P<punct>==|~=|<=|>=|\.\.|::|<<|>>|//|[-(){}\[\],;:.=+*/%^#&~|<>])
+    """,
+    re.VERBOSE,
+)
+
+lua_keywords = {
+    "and",
+    "break",
+    "continue",
+    "do",
+    "else",
+    "elseif",
+    "end",
+    "false",
+    "for",
+    "function",
+    "goto",
+    "if",
+    "in",
+    "local",
+    "nil",
+    "not",
+    "or",
+    "repeat",
+    "return",
+    "then",
+    "true",
+    "until",
+    "while",
+}
+
+
+class FastPathUnsupported(Exception):
+    pass
+
+
+def tokenize_fast_path(code):
+    tokens = []
+    pos = 0
+    end = len(code)
+    match = fast_path_token_pattern.match
+    while pos < end:
+        m = match(code, pos)
+        if not m:
+            raise FastPathUnsupported
+        kind = m.lastgroup
+        if kind == "name":
+            value = m.group()
+            if value in lua_keywords:
+                kind = value
+            tokens.append((kind, value))
+        elif kind == "number":
+            tokens.append((kind, float(m.group())))
+        elif kind == "string":
+            tokens.append((kind, m.group()[1:-1]))
+        elif kind == "punct":
+            tokens.append((m.group(), None))
+        pos = m.end()
+    tokens.append(("eof", None))
+    return tokens
+
+
+# A call is (inner_call, before_name, name, args, children),
+# and children are the calls and function bodies in args in source order
+# A function body is a list of calls, one for each statement
+class FastPathParser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset][0]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, kind):
+        token = self.next()
+        if token[0] != kind:
+            raise FastPathUnsupported
+        return token[1]
+
+    def parse_block(self, end_kind):
+        stats = []
+        while True:
+            kind = self.peek()
+            if kind == end_kind:
+                return stats
+            if kind == ";":
+                self.pos += 1
+            elif kind == "name":
+                stats.append(self.parse_call_chain())
+            else:
+                raise FastPathUnsupported
+
+    # Returns (call, None), or (None, value) if it is not a call
+    def parse_prefix(self):
+        names = [self.expect("name")]
+        while self.peek() == "." and self.peek(1) == "name":
+            self.pos += 1
+            names.append(self.next()[1])
+        if self.peek() == ":":
+            self.pos += 1
+            name = self.expect("name")
+            before_name = names[0]
+        elif self.peek() in ("(", "{", "string"):
+            name = names[0]
+            before_name = None
+        else:
+            return None, names[0]
+
+        args, children = self.parse_args()
+        call = (None, before_name, name, args, children)
+        while self.peek() == ":":
+            self.pos += 1
+            name = self.expect("name")
+            args, children = self.parse_args()
+            call = (call, None, name, args, children)
+        return call, None
+
+    def parse_call_chain(self):
+        call, _ = self.parse_prefix()
+        if call is None:
+            raise FastPathUnsupported
+        return call
+
+    def parse_args(self):
+        kind, value = self.next()
+        children = []
+        if kind == "(":
+            args = []
+            if self.peek() != ")":
+                args.append(self.parse_exp(children))
+                while self.peek() == ",":
+                    self.pos += 1
+                    args.append(self.parse_exp(children))
+            self.expect(")")
+            return tuple(args), children
+        elif kind == "{":
+            return (self.parse_table(children),), children
+        elif kind == "string":
+            return (value,), children
+        else:
+            raise FastPathUnsupported
+
+    def parse_table(self, children):
+        out_list = []
+        out_dict = {}
+        while self.peek() != "}":
+            if self.peek() == "name" and self.peek(1) == "=":
+                k = self.next()[1]
+                self.pos += 1
+                out_dict[k] = self.parse_exp(children)
+            elif self.peek() == "[":
+                self.pos += 1
+                k = self.parse_exp(children)
+                if not isinstance(k, (str, float)):
+                    raise FastPathUnsupported
+                self.expect("]")
+                self.expect("=")
+                out_dict[k] = self.parse_exp(children)
+            else:
+                out_list.append(self.parse_exp(children))
+
+            if self.peek() in (",", ";"):
+                self.pos += 1
+            elif self.peek() != "}":
+                raise FastPathUnsupported
+        self.pos += 1
+
+        if not out_dict:
+            return out_list
+        else:
+            for i, x in enumerate(out_list):
+                out_dict[i + 1] = x
+            return out_dict
+
+    def parse_exp(self, children):
+        kind, value = self.next()
+        if kind == "name":
+            self.pos -= 1
+            call, value = self.parse_prefix()
+            if call is not None:
+                children.append(call)
+                value = "?"
+        elif kind in ("string", "number"):
+            pass
+        elif kind == "nil":
+            value = NIL()
+        elif kind == "true":
+            value = True
+        elif kind == "false":
+            value = False
+        elif kind == "-":
+            value = -self.expect("number")
+        elif kind == "{":
+            value = self.parse_table(children)
+        elif kind == "function":
+            self.parse_params()
+            children.append(self.parse_block("end"))
+            self.pos += 1
+            value = "?"
+        else:
+            raise FastPathUnsupported
+
+        # Binary operators and other postfixes are not supported
+        if self.peek() not in (",", ")", "}", "]", ";"):
+            raise FastPathUnsupported
+        return value
+
+    def parse_params(self):
+        self.expect("(")
+        if self.peek() == "name":
+            self.pos += 1
+            while self.peek() == ",":
+                self.pos += 1
+                self.expect("name")
+        self.expect(")")
+
+
+def walk_fast_path_call(call, env, tracked_env, out):
+    inner_call, before_name, name, args, children = call
+    if inner_call is not None:
+        walk_fast_path_call(inner_call, env, tracked_env, out)
+
+    if before_name is not None:
+        out.append((before_name, (), tuple(env)))
+    out.append((name, args, tuple(env)))
+
+    if before_name in tracked_env:
+        env.append(before_name)
+    if name in tracked_env:
+        env.append(name)
+
+    for child in children:
+        if isinstance(child, list):
+            for stat in child:
+                last_env = list(env)
+                walk_fast_path_call(stat, env, tracked_env, out)
+                env[:] = last_env
+        else:
+            walk_fast_path_call(child, env, tracked_env, out)
+
+
+# Returns the calls in the same form as the call cache,
+# or None if the code is not supported
+def walk_functions_fast_path(code, tracked_env):
+    try:
+        parser = FastPathParser(tokenize_fast_path(code))
+        stats = parser.parse_block("eof")
+    except FastPathUnsupported:
+        return None
+
+    out = []
+    for stat in stats:
+        walk_fast_path_call(stat, [], tracked_env, out)
+    return out
+
+
+class CallCache:
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.db = None
+        self.db_pending = []
+
+    def open_db(self):
+        if self.db is not None:
+            return self.db
+
+        dirname = os.path.dirname(persistent_call_cache_filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(persistent_call_cache_filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS calls "
+            "(key TEXT PRIMARY KEY, value BLOB, used REAL)"
+        )
+        atexit.register(self.close_db)
+        return self.db
+
+    def close_db(self):
+        if self.db is None:
+            return
+
+        self.flush()
+        # Evict least recently used rows
+        self.db.execute(
+            "DELETE FROM calls WHERE key NOT IN "
+            "(SELECT key FROM calls ORDER BY used DESC LIMIT ?)",
+            (persistent_call_cache_max_len,),
+        )
+        self.db.commit()
+        self.db.close()
+        self.db = None
+
+    def flush(self):
+        if self.db is None or not self.db_pending:
+            return
+
+        self.db.executemany(
+            "INSERT OR REPLACE INTO calls VALUES (?, ?, ?)", self.db_pending
+        )
+        self.db.commit()
+        self.db_pending = []
+
+    @staticmethod
+    def get_db_key(key):
+        code, tracked_env = key
+        h = hashlib.sha256(call_cache_version.encode("utf-8") + b"\xff")
+        h.update(code.encode("utf-8"))
+        for name in sorted(tracked_env):
+            h.update(b"\xff" + name.encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        calls = self.data.get(key)
+        if calls is not None:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return calls
+
+        if use_persistent_call_cache:
+            db = self.open_db()
+            db_key = self.get_db_key(key)
+            row = db.execute(
+                "SELECT value FROM calls WHERE key = ?", (db_key,)
+            ).fetchone()
+            if row is not None:
+                calls = pickle.loads(row[0])
+                self.put_memory(key, calls)
+                db.execute(
+                    "UPDATE calls SET used = ? WHERE key = ?", (time.time(), db_key)
+                )
+                self.disk_hits += 1
+                return calls
+
+        self.misses += 1
+        return None
+
+    def put_memory(self, key, calls):
+        self.data[key] = calls
+        while len(self.data) > self.max_len:
+            self.data.popitem(last=False)
+
+    def put(self, key, calls):
+        self.put_memory(key, calls)
+        if use_persistent_call_cache:
+            self.open_db()
+            self.db_pending.append(
+                (self.get_db_key(key), pickle.dumps(calls), time.time())
+            )
+            if len(self.db_pending) >= 1024:
+                self.flush()
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+
+call_cache = CallCache(call_cache_max_len)
+
+
+def copy_mutable(x):
+    if isinstance(x, list):
+        return [copy_mutable(y) for y in x]
+    if isinstance(x, dict):
+        return {k: copy_mutable(v) for k, v in x.items()}
+    return x
+
+
+# Lists and dicts in args are copied, so callers cannot change the cached calls
+# Cached args are already evaluated, so LazyList only keeps the interface of
+# lazy_args and does not save any work
+def yield_cached_calls(calls, lazy_args):
+    for func_name, args, env in calls:
+        if any(isinstance(x, (list, dict)) for x in args):
+            args = tuple(copy_mutable(x) for x in args)
+        if lazy_args:
+            args = LazyList(list(args))
+        yield func_name, args, env
+
+
+# env is a tuple of the tracked functions at the time of the call,
+# unless all of the cache, the fast path and the iterative walk are disabled,
+# then it is a list that changes during the walk
+# The call cache and the fast path evaluate all args, so lazy_args only defers
+# the evaluation when both are disabled, or when the code needs ANTLR and the
+# cache is disabled
+def walk_functions(code, *, lazy_args=False, tracked_env=None):
+    if tracked_env is None:
+        tracked_env = set()
+
+    if not use_call_cache:
+        calls = walk_functions_fast_path(code, tracked_env) if use_fast_path else None
+        if calls is None:
+            yield from walk_functions_uncached(code, lazy_args, tracked_env)
+        else:
+            yield from yield_cached_calls(calls, lazy_args)
+        return
+
+    key = (code, frozenset(tracked_env))
+    calls = call_cache.get(key)
+    if calls is None and use_fast_path:
+        calls = walk_functions_fast_path(code, tracked_env)
+        if calls is not None:
+            call_cache.put(key, calls)
+    if calls is None:
+        calls = []
+        try:
+            for func_name, args, env in walk_functions_uncached(
+                code, False, tracked_env
+            ):
+                calls.append((func_name, args, tuple(env)))
+        except Exception:
+            # Yield the calls before the error, like the uncached generator
+            yield from yield_cached_calls(calls, lazy_args)
+            raise
+        call_cache.put(key, calls)
+
+    yield from yield_cached_calls(calls, lazy_args)
+
+
 def test():
     code = """
 f1()
@@ -260,5 +780,142 @@ x8 = f8()
         print(x)
 
 
+def test_call_cache_copy():
+    code = "f({1, {k = 'v'}})"
+    for _, args, _ in walk_functions(code):
+        args[0].append(2)
+        args[0][1]["k"] = "x"
+    for _, args, _ in walk_functions(code):
+        assert args[0] == [1.0, {"k": "v"}], args
+
+
+def get_scenario_codes(filenames):
+    from nova_script_parser import parse_nodes
+
+    codes = set()
+    for filename in filenames:
+        with open(filename, encoding="utf-8") as f:
+            nodes = parse_nodes(f.read())
+        for node in nodes:
+            for block in (node.headEagerBlock, node.tailEagerBlock):
+                if block:
+                    codes.add(block.content)
+            for entry in node.dialogueEntries:
+                for block in entry.codeBlocks:
+                    codes.add(block.content)
+                codes.add("\n".join(block.content for block in entry.codeBlocks))
+    return codes
+
+
+def test_boolean_literals():
+    code = "say(ergong, 'x', 0, false)\nf{k = true}"
+    expected = [("say", ("ergong", "x", 0.0, False), ()), ("f", ({"k": True},), ())]
+    assert walk_functions_fast_path(code, set()) == expected
+    calls = [
+        (func_name, args, tuple(env))
+        for func_name, args, env in walk_functions_uncached(code, False, set())
+    ]
+    assert calls == expected, calls
+
+
+# Compare the fast path with ANTLR on all code in scenarios and in a generated
+# corpus, and fail on any mismatch
+def test_fast_path(corpus_entries=20000):
+    import glob
+    import tempfile
+
+    from generate_sample_script import write_corpus
+
+    tracked_env = {"anim", "anim_hold", "named_anim_hold"}
+    codes = get_scenario_codes(
+        glob.glob("../../Assets/Resources/**/Scenarios/*.txt", recursive=True)
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_corpus(tmp_dir, corpus_entries, 4, seed=0)
+        codes |= get_scenario_codes(
+            glob.glob(os.path.join(tmp_dir, "**", "Scenarios", "*.txt"), recursive=True)
+        )
+
+    fast_count = 0
+    mismatch_count = 0
+    for code in sorted(codes):
+        calls = walk_functions_fast_path(code, tracked_env)
+        if calls is None:
+            continue
+        fast_count += 1
+
+        expected = [
+            (func_name, args, tuple(env))
+            for func_name, args, env in walk_functions_uncached(
+                code, False, tracked_env
+            )
+        ]
+        if repr(calls) != repr(expected):
+            mismatch_count += 1
+            print("Mismatch:")
+            print(code)
+            print(calls)
+            print(expected)
+
+    print(f"Fast path: {fast_count} / {len(codes)} code blocks")
+    assert mismatch_count == 0, f"{mismatch_count} mismatches"
+
+
+# Compare the recursive and the iterative walks on deeply nested anim_hold
+def benchmark_walk(depth=200, repeat=10):
+    import sys
+    import timeit
+
+    code = "x0()\n"
+    for i in range(depth):
+        code += f"a{i}:f{i}(x{i}, {{1, 2}}):g{i}(y{i}):anim_hold(function()\n"
+    code += "z()\n"
+    code += "end)\n" * depth
+
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, depth * 100))
+    try:
+        chunk = parse_chunk(code)
+        stats = chunk.block().stat()
+        tracked_env = {"anim_hold"}
+
+        def walk_recursive():
+            for stat in stats:
+                for _ in walk_functions_node(stat, [], False, tracked_env):
+                    pass
+
+        def walk_iterative():
+            for stat in stats:
+                for _ in walk_functions_node_iterative(stat, False, tracked_env):
+                    pass
+
+        expected = [
+            (func_name, args, tuple(env))
+            for stat in stats
+            for func_name, args, env in walk_functions_node(
+                stat, [], False, tracked_env
+            )
+        ]
+        actual = [
+            x
+            for stat in stats
+            for x in walk_functions_node_iterative(stat, False, tracked_env)
+        ]
+        assert repr(actual) == repr(expected)
+
+        t_recursive = min(timeit.repeat(walk_recursive, number=1, repeat=repeat))
+        t_iterative = min(timeit.repeat(walk_iterative, number=1, repeat=repeat))
+    finally:
+        sys.setrecursionlimit(old_limit)
+
+    print(f"Depth {depth}, {len(expected)} calls")
+    print(f"Recursive: {t_recursive * 1000:.2f} ms")
+    print(f"Iterative: {t_iterative * 1000:.2f} ms")
+
+
 if __name__ == "__main__":
     test()
+    test_call_cache_copy()
+    test_boolean_literals()
+    test_fast_path()
+    benchmark_walk()
@@ -1,20 +1,208 @@
 #!/usr/bin/env python3
 
+# Merge the scenario files included by template.txt into scenario.txt
+# scenario.txt is only rewritten when the template or an included file changed,
+# so its mtime can be used by the caches of other scripts
+# A source map is saved in .cache to map the line numbers in scenario.txt back to
+# the included files
+
+import hashlib
+import json
 import os
+from bisect import bisect_right
+
+import profiling
 
 in_dir = "../../Assets/Resources/Scenarios/"
 template_filename = "template.txt"
 out_filename = "scenario.txt"
+source_map_filename = ".cache/scenario_source_map.json"
+manifest_filename = ".cache/merge_manifest.json"
+manifest_version = "1"
+copy_buffer_size = 1024 * 1024
 
-with open(template_filename, "r", encoding="utf-8") as f_template:
-    with open(out_filename, "w", encoding="utf-8", newline="\n") as f_out:
-        for line in f_template:
+
+# Yields (line_num, line, include_filename), where include_filename is None if
+# the line is not @include
+def iter_template(template_filename=template_filename, in_dir=in_dir):
+    with open(template_filename, "r", encoding="utf-8") as f_template:
+        for line_num, line in enumerate(f_template, 1):
             if line.startswith("@include"):
                 include_filename = os.path.join(in_dir, line.strip().split()[1])
                 if not os.path.exists(include_filename):
                     print("File not found:", include_filename)
                     continue
-                with open(include_filename, "r", encoding="utf-8") as f_include:
-                    f_out.write(f_include.read())
+                yield line_num, line, include_filename
             else:
+                yield line_num, line, None
+
+
+def get_file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(copy_buffer_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_file_stat(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_manifest():
+    try:
+        with open(manifest_filename, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != manifest_version:
+        return None
+    return manifest
+
+
+def save_manifest(manifest):
+    dirname = os.path.dirname(manifest_filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(manifest_filename, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+# Returns {filename: [size, mtime_ns, hash]} of the inputs
+# Files with the same size and mtime as in the old manifest are not hashed again
+# Files removed after reading the template are not in the result
+def get_input_states(filenames, old_inputs):
+    inputs = {}
+    for filename in filenames:
+        stat = get_file_stat(filename)
+        if stat is None:
+            print("File not found:", filename)
+            continue
+        old = old_inputs.get(filename)
+        if old is not None and old[:2] == stat:
+            inputs[filename] = old
+        else:
+            inputs[filename] = stat + [get_file_hash(filename)]
+    return inputs
+
+
+# Copies f_in to f_out in chunks, and returns the number of newlines
+def copy_text(f_in, f_out):
+    newline_count = 0
+    while True:
+        chunk = f_in.read(copy_buffer_size)
+        if not chunk:
+            break
+        f_out.write(chunk)
+        newline_count += chunk.count("\n")
+    return newline_count
+
+
+# The source map is a list of [line in scenario.txt, filename, line in filename],
+# one for each segment copied from the template or an included file, and line
+# numbers start from 1
+def write_merged(template_filename, template_lines, out_filename):
+    source_map = []
+    newline_count = 0
+    last_template_line_num = None
+    tmp_filename = out_filename + ".tmp"
+    with open(tmp_filename, "w", encoding="utf-8", newline="\n") as f_out:
+        for line_num, line, include_filename in template_lines:
+            if include_filename is None:
+                # Consecutive template lines are in one segment
+                if last_template_line_num != line_num - 1:
+                    source_map.append([newline_count + 1, template_filename, line_num])
+                last_template_line_num = line_num
                 f_out.write(line)
+                newline_count += line.count("\n")
+            else:
+                last_template_line_num = None
+                source_map.append([newline_count + 1, include_filename, 1])
+                with open(include_filename, "r", encoding="utf-8") as f_include:
+                    newline_count += copy_text(f_include, f_out)
+    os.replace(tmp_filename, out_filename)
+    return source_map
+
+
+@profiling.profiled("merge")
+def merge(
+    template_filename=template_filename,
+    in_dir=in_dir,
+    out_filename=out_filename,
+    source_map_filename=source_map_filename,
+):
+    template_lines = list(iter_template(template_filename, in_dir))
+    filenames = [template_filename] + [x for _, _, x in template_lines if x is not None]
+
+    manifest = load_manifest()
+    if manifest is None or manifest["out_filename"] != out_filename:
+        old_inputs = {}
+    else:
+        old_inputs = manifest["inputs"]
+    inputs = get_input_states(filenames, old_inputs)
+    if len(inputs) < len(filenames):
+        # Skip the removed files like iter_template, so the output is rebuilt
+        # without them
+        template_lines = [x for x in template_lines if x[2] is None or x[2] in inputs]
+        filenames = [x for x in filenames if x in inputs]
+
+    if (
+        manifest is not None
+        and manifest["out_filename"] == out_filename
+        and manifest["source_map_filename"] == source_map_filename
+        and manifest["filenames"] == filenames
+        and all(inputs[x][2] == old_inputs[x][2] for x in filenames)
+        and manifest["output"] == get_file_stat(out_filename)
+        and manifest["source_map"] == get_file_stat(source_map_filename)
+    ):
+        # Nothing changed, only update the stats of inputs that were touched
+        if inputs != old_inputs:
+            manifest["inputs"] = inputs
+            save_manifest(manifest)
+        return False
+
+    source_map = write_merged(template_filename, template_lines, out_filename)
+    dirname = os.path.dirname(source_map_filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(source_map_filename, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(source_map, f, ensure_ascii=False)
+
+    save_manifest(
+        {
+            "version": manifest_version,
+            "out_filename": out_filename,
+            "source_map_filename": source_map_filename,
+            "filenames": filenames,
+            "inputs": inputs,
+            "output": get_file_stat(out_filename),
+            "source_map": get_file_stat(source_map_filename),
+        }
+    )
+    return True
+
+
+def load_source_map(filename=source_map_filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Returns (filename, line_num) of the line in scenario.txt
+def map_line(source_map, line_num):
+    idx = bisect_right([x[0] for x in source_map], line_num) - 1
+    if idx < 0:
+        raise ValueError(f"Line {line_num} is not in the source map")
+    merged_line_num, filename, source_line_num = source_map[idx]
+    return filename, source_line_num + line_num - merged_line_num
+
+
+if __name__ == "__main__":
+    profiling.init()
+    merge()
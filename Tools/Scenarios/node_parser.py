@@ -0,0 +1,575 @@
+# Pure Python port of Nova.Parser in Assets/Nova/Sources/Core/ScriptParsing/Parser/
+# The results should be the same as NodeParser.ParseNodes, including line numbers and error messages
+# Attribute names follow the C# classes, so the results can be used in place of the CLR objects
+
+import re
+from enum import Enum
+
+
+class BlockType(Enum):
+    EagerExecution = 0
+    LazyExecution = 1
+    Text = 2
+    Separator = 3
+
+
+class ParserException(Exception):
+    pass
+
+
+class ParsedBlock:
+    __slots__ = ["line", "type", "content", "attributes"]
+
+    def __init__(self, line, type, content, attributes):
+        self.line = line
+        self.type = type
+        if content is not None:
+            content = content.replace("\r", "")
+        self.content = content
+        self.attributes = attributes
+
+
+class ParsedDialogueEntry:
+    __slots__ = ["line", "characterName", "displayName", "dialogue", "codeBlocks"]
+
+    def __init__(self, line, characterName, displayName, dialogue, codeBlocks):
+        self.line = line
+        self.characterName = characterName
+        self.displayName = displayName
+        self.dialogue = dialogue
+        self.codeBlocks = codeBlocks
+
+
+class ParsedNode:
+    __slots__ = ["name", "dialogueEntries", "headEagerBlock", "tailEagerBlock"]
+
+    def __init__(self, name, dialogueEntries, headEagerBlock, tailEagerBlock):
+        self.name = name
+        self.dialogueEntries = dialogueEntries
+        self.headEagerBlock = headEagerBlock
+        self.tailEagerBlock = tailEagerBlock
+
+
+# Tokens that need special handling in a code block
+# <| is included because it swallows the | in <|>
+code_token_pattern = re.compile(r"<\||\|>|--|'|\"|\[\[")
+# Same as char.IsWhiteSpace in C#, except for the new line
+white_space_pattern = re.compile(r"[^\S\n\x1c-\x1f]*")
+single_quoted_patterns = {
+    "'": re.compile(r"(?:[^'\\\n]|\\[^\n])*"),
+    '"': re.compile(r'(?:[^"\\\n]|\\[^\n])*'),
+}
+block_comment_start_pattern = re.compile(r"\[(=*)\[")
+
+name_dialogue_pattern = re.compile(
+    r"(?P<name>[^/：:]*)(//(?P<hidden>[^：:]*))?(：：|::)(?P<dialogue>.*)", re.DOTALL
+)
+node_label_pattern = re.compile(r"label\s*\(?'(?P<name>[^']*)'")
+
+
+class Scanner:
+    def __init__(self, text):
+        self.text = text
+        self.index = 0
+        # Line numbers are counted incrementally, because blocks are visited in order
+        self.line_index = 1
+        self.line = 1
+
+    def get_line(self, index):
+        # Same as Tokenizer in C#, a new line char is counted in the next line
+        if index < self.line_index:
+            return 1 + self.text.count("\n", 1, index + 1)
+        self.line += self.text.count("\n", self.line_index, index + 1)
+        self.line_index = index + 1
+        return self.line
+
+    def get_column(self, index):
+        last_new_line = self.text.rfind("\n", 1, index + 1)
+        if last_new_line < 0:
+            return index + 1
+        return index - last_new_line + 1
+
+    def error(self, index, message):
+        line = 1 + self.text.count("\n", 1, index + 1) if index > 0 else 1
+        column = self.get_column(index)
+        return ParserException(f"Line {line}, Column {column}: {message}")
+
+    def peek_char(self, offset=0):
+        idx = self.index + offset
+        if idx >= len(self.text):
+            return "\0"
+        return self.text[idx]
+
+    def peek_token_type(self, index=None):
+        text = self.text
+        if index is None:
+            index = self.index
+        if index >= len(text):
+            return "EndOfFile"
+
+        c = text[index]
+        if c == "\n":
+            return "NewLine"
+        if white_space_pattern.match(text, index).end() > index:
+            return "WhiteSpace"
+        if c == "@":
+            return "At"
+        if c == ",":
+            return "Comma"
+        if c == "=":
+            return "Equal"
+        if c == "'" or c == '"':
+            return "Quote"
+
+        c2 = text[index + 1] if index + 1 < len(text) else "\0"
+        if c == "[" and c2 == "[":
+            return "Quote"
+        if c == "[":
+            return "AttrStart"
+        if c == "]":
+            return "AttrEnd"
+        if c == "<" and c2 == "|":
+            return "BlockStart"
+        if c == "|" and c2 == ">":
+            return "BlockEnd"
+        if c == "-" and c2 == "-":
+            return "CommentStart"
+        return "Character"
+
+    def skip_white_space(self):
+        self.index = white_space_pattern.match(self.text, self.index).end()
+
+    def expect(self, token_type, display):
+        if self.peek_token_type() != token_type:
+            raise self.error(self.index, f"Expect {display}")
+
+    # Index is at the quote char
+    def skip_quoted_single_line(self):
+        quote_index = self.index
+        text = self.text
+        end = (
+            single_quoted_patterns[text[quote_index]].match(text, quote_index + 1).end()
+        )
+        if end < len(text) and text[end] == "\\":
+            end += 1
+        if end >= len(text):
+            raise self.error(quote_index, "Unpaired quote")
+        self.index = end + 1
+
+    def take_quoted_multiline(self, offset):
+        # Lua multiline string does not interpret escape sequence
+        length = 0
+        last_is_right_square_bracket = False
+        last_is_left_square_bracket = False
+        while self.peek_char(offset + length) != "\0":
+            c = self.peek_char(offset + length)
+            if last_is_left_square_bracket and c == "[":
+                nested = self.take_quoted_multiline(offset + length + 1)
+                length += nested
+                c = self.peek_char(offset + length)
+            elif last_is_right_square_bracket and c == "]":
+                break
+
+            last_is_left_square_bracket = c == "["
+            last_is_right_square_bracket = c == "]"
+            length += 1
+
+        if not last_is_right_square_bracket and self.peek_char(offset + length) == "]":
+            raise self.error(self.index - 2, "Unpaired multiline string")
+
+        return length + 1
+
+    # Index is at the quote token
+    def skip_quoted(self, allow_multiline=True):
+        c = self.text[self.index]
+        if c == "'" or c == '"':
+            self.skip_quoted_single_line()
+        elif allow_multiline and c == "[":
+            self.index += 2
+            self.index += self.take_quoted_multiline(0)
+        else:
+            raise self.error(self.index, "Should not happen")
+
+    # Index is after --
+    def skip_comment(self, comment_index):
+        text = self.text
+        m = block_comment_start_pattern.match(text, self.index)
+        if not m:
+            new_line_index = text.find("\n", self.index)
+            self.index = new_line_index if new_line_index >= 0 else len(text)
+            return
+
+        end_pattern = "]" + m.group(1) + "]"
+        end_pattern_index = text.find(end_pattern, self.index)
+        if end_pattern_index < 0:
+            raise self.error(comment_index, "Unpaired block comment")
+        self.index = end_pattern_index + len(end_pattern)
+
+
+def parse_code_block(scanner, line, block_type, attributes):
+    scanner.expect("BlockStart", "<|")
+    text = scanner.text
+    start_token_index = scanner.index
+    start_index = start_token_index + 2
+    scanner.index = start_index
+    end_index = start_index
+    match_found = False
+    while True:
+        m = code_token_pattern.search(text, scanner.index)
+        if not m:
+            if scanner.index < len(text):
+                end_index = len(text)
+            scanner.index = len(text)
+            break
+
+        token_index = m.start()
+        if token_index > scanner.index:
+            end_index = token_index
+
+        token = m.group()
+        if token == "|>":
+            scanner.index = m.end()
+            match_found = True
+            break
+        elif token == "<|":
+            scanner.index = m.end()
+            end_index = scanner.index
+        elif token == "--":
+            scanner.index = m.end()
+            scanner.skip_comment(token_index)
+        else:
+            scanner.index = token_index
+            scanner.skip_quoted()
+
+    content = text[start_index:end_index]
+
+    if not match_found:
+        raise scanner.error(start_token_index, "Unpaired block start <|")
+
+    scanner.skip_white_space()
+
+    token_type = scanner.peek_token_type()
+    if token_type != "NewLine" and token_type != "EndOfFile":
+        raise scanner.error(scanner.index, "Expect new line or end of file after |>")
+    scanner.index += 1
+
+    return ParsedBlock(line, block_type, content, attributes)
+
+
+def parse_eager_execution_block(scanner, line):
+    scanner.expect("At", "@")
+    scanner.index += 1
+    token_type = scanner.peek_token_type()
+    if token_type == "AttrStart":
+        return parse_code_block_with_attributes(scanner, line, BlockType.EagerExecution)
+
+    if token_type == "BlockStart":
+        return parse_code_block(scanner, line, BlockType.EagerExecution, None)
+
+    raise scanner.error(scanner.index, f"Except [ or <| after @, found {token_type}")
+
+
+def expect_identifier_or_string(scanner):
+    token_type = scanner.peek_token_type()
+    start_index = scanner.index
+    if token_type == "Character":
+        while scanner.peek_token_type() == "Character":
+            scanner.index += 1
+        return scanner.text[start_index : scanner.index]
+
+    if token_type == "Quote":
+        scanner.skip_quoted(False)
+        return scanner.text[start_index : scanner.index]
+
+    raise scanner.error(
+        scanner.index, f"Expect identifier or string, found {token_type}"
+    )
+
+
+escape_chars = {
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+}
+
+
+def escape_string(s):
+    out = []
+    escaped = False
+    for c in s:
+        next_escaped = not escaped and c == "\\"
+        if escaped:
+            out.append(escape_chars.get(c, c))
+        elif c != "\\":
+            out.append(c)
+        escaped = next_escaped
+    return "".join(out)
+
+
+def unquote(s):
+    if not s:
+        return s
+
+    first = s[0]
+    if len(s) >= 2 and (first == "'" or first == '"') and first == s[-1]:
+        return escape_string(s[1:-1])
+
+    return s
+
+
+def parse_code_block_with_attributes(scanner, line, block_type):
+    scanner.expect("AttrStart", "[")
+    scanner.index += 1
+    attributes = {}
+
+    while scanner.peek_token_type() != "EndOfFile":
+        scanner.skip_white_space()
+        if scanner.peek_token_type() == "AttrEnd":
+            scanner.index += 1
+            break
+
+        key = expect_identifier_or_string(scanner)
+        value = None
+
+        scanner.skip_white_space()
+        if scanner.peek_token_type() == "Equal":
+            scanner.index += 1
+            scanner.skip_white_space()
+            value = expect_identifier_or_string(scanner)
+
+        scanner.skip_white_space()
+        token_type = scanner.peek_token_type()
+        if token_type == "Comma" or token_type == "AttrEnd":
+            scanner.index += 1
+        else:
+            raise scanner.error(scanner.index, "Expect , or ]")
+
+        key = unquote(key.strip())
+        if key in attributes:
+            raise scanner.error(
+                scanner.index,
+                f"An item with the same key has already been added: {key}",
+            )
+        attributes[key] = None if value is None else unquote(value.strip())
+
+        if token_type == "AttrEnd":
+            break
+
+    return parse_code_block(scanner, line, block_type, attributes)
+
+
+def parse_text_block(scanner, line, start_index):
+    text = scanner.text
+    end_index = text.find("\n", scanner.index)
+    if end_index < 0:
+        end_index = len(text)
+    content = text[start_index:end_index]
+
+    # eat up the last new line
+    scanner.index = end_index + 1
+
+    return ParsedBlock(line, BlockType.Text, content, None)
+
+
+def parse_block(scanner):
+    start_index = scanner.index
+    scanner.skip_white_space()
+    index = scanner.index
+    line = scanner.get_line(index)
+    token_type = scanner.peek_token_type()
+
+    if token_type == "NewLine" or token_type == "EndOfFile":
+        content = scanner.text[start_index:index]
+        scanner.index += 1
+        return ParsedBlock(line, BlockType.Separator, content, None)
+
+    if token_type == "At":
+        return parse_eager_execution_block(scanner, line)
+
+    if token_type == "AttrStart":
+        return parse_code_block_with_attributes(scanner, line, BlockType.LazyExecution)
+
+    if token_type == "BlockStart":
+        return parse_code_block(scanner, line, BlockType.LazyExecution, None)
+
+    return parse_text_block(scanner, line, start_index)
+
+
+def iter_blocks(text):
+    scanner = Scanner(text)
+    last_is_separator = True
+    pending_separator = None
+    while scanner.index < len(text):
+        block = parse_block(scanner)
+        # Merge consecutive separators, and remove the leading and the trailing ones
+        if block.type == BlockType.Separator:
+            if not last_is_separator:
+                pending_separator = block
+            last_is_separator = True
+            continue
+
+        if pending_separator is not None:
+            yield pending_separator
+            pending_separator = None
+        last_is_separator = False
+        yield block
+
+
+def parse_blocks(text):
+    return list(iter_blocks(text))
+
+
+# Split blocks at separators and eager execution blocks. Each chunk contain at least one block
+def iter_chunks(text):
+    chunk = []
+    for block in iter_blocks(text):
+        if block.type == BlockType.Separator:
+            if chunk:
+                yield chunk
+                chunk = []
+        elif block.type == BlockType.EagerExecution:
+            if chunk:
+                yield chunk
+            yield [block]
+            chunk = []
+        else:
+            chunk.append(block)
+
+    if chunk:
+        yield chunk
+
+
+def parse_chunks(text):
+    return list(iter_chunks(text))
+
+
+# There can be multiple text blocks in a chunk. They are concatenated into one, separated by new lines
+def get_text(chunk):
+    return "\n".join(block.content for block in chunk if block.type == BlockType.Text)
+
+
+# Update hidden_names in place
+def parse_name_dialogue(text, hidden_names):
+    # Coarse test for performance
+    if "：：" not in text and "::" not in text:
+        return "", "", text
+
+    m = name_dialogue_pattern.match(text)
+    if m:
+        display_name = m.group("name")
+        hidden_name = m.group("hidden") or ""
+        dialogue = m.group("dialogue")
+    else:
+        display_name = ""
+        hidden_name = ""
+        dialogue = text
+
+    if hidden_names is None:
+        return display_name, hidden_name, dialogue
+
+    if not hidden_name:
+        if display_name:
+            hidden_name = hidden_names.get(display_name, display_name)
+    else:
+        if display_name:
+            hidden_names[display_name] = hidden_name
+
+    return display_name, hidden_name, dialogue
+
+
+def try_get_node_name(code):
+    m = node_label_pattern.search(code)
+    return m.group("name") if m else None
+
+
+def iter_nodes_from_chunks(chunks):
+    node_name = None
+    dialogue_entries = []
+    head_eager_block = None
+    hidden_names = {}
+
+    for chunk in chunks:
+        first_block = chunk[0]
+        if first_block.type == BlockType.EagerExecution:
+            new_node_name = try_get_node_name(first_block.content)
+            if not new_node_name:
+                # first_block is tail eager block
+                if not node_name:
+                    raise ParserException(
+                        f"Nova: Unmatched tail eager block at line {first_block.line}:\n{first_block.content}"
+                    )
+
+                yield ParsedNode(
+                    node_name, dialogue_entries, head_eager_block, first_block
+                )
+                node_name = None
+                dialogue_entries = []
+                head_eager_block = None
+                hidden_names.clear()
+            else:
+                # first_block is head eager block
+                if node_name:
+                    raise ParserException(
+                        f"Nova: Unmatched head eager block at line {first_block.line}:\n{first_block.content}"
+                    )
+
+                node_name = new_node_name
+                head_eager_block = first_block
+        else:
+            text = get_text(chunk)
+            display_name, character_name, dialogue = parse_name_dialogue(
+                text, hidden_names
+            )
+            code_blocks = [
+                block for block in chunk if block.type == BlockType.LazyExecution
+            ]
+            dialogue_entries.append(
+                ParsedDialogueEntry(
+                    first_block.line,
+                    character_name,
+                    display_name,
+                    dialogue,
+                    code_blocks,
+                )
+            )
+
+
+def shift_block_lines(block, delta):
+    if block is None:
+        return None
+    return ParsedBlock(block.line + delta, block.type, block.content, block.attributes)
+
+
+def shift_node_lines(node, delta):
+    if delta == 0:
+        return node
+
+    dialogue_entries = [
+        ParsedDialogueEntry(
+            entry.line + delta,
+            entry.characterName,
+            entry.displayName,
+            entry.dialogue,
+            [shift_block_lines(block, delta) for block in entry.codeBlocks],
+        )
+        for entry in node.dialogueEntries
+    ]
+    return ParsedNode(
+        node.name,
+        dialogue_entries,
+        shift_block_lines(node.headEagerBlock, delta),
+        shift_block_lines(node.tailEagerBlock, delta),
+    )
+
+
+def iter_nodes(text):
+    return iter_nodes_from_chunks(iter_chunks(text))
+
+
+def parse_nodes(text):
+    # Parse all chunks first, so errors are raised in the same order as C#
+    return list(iter_nodes_from_chunks(parse_chunks(text)))
@@ -1,12 +1,64 @@
 # TODO: proper way to split chapters
 
+import hashlib
 import os
+import pickle
 import re
+from collections import OrderedDict, deque
 
-import clr
+import node_parser
+import profiling
+from compact_entries import compact_chapters
+from disk_cache import DiskCache, hash_key
 
+# Set to True to use Nova.Parser.dll compiled by Unity, which requires pythonnet
+use_clr = False
 nova_parser_dll_path = "../../Library/ScriptAssemblies/Nova.Parser.dll"
-clr.AddReference(os.path.abspath(nova_parser_dll_path))
+clr_loaded = False
+
+# Parsed chapters are cached on disk, keyed by the hash of the text
+use_parse_cache = True
+parse_cache_version = "1"
+parse_cache_max_size = 256 * 1024 * 1024
+parse_cache = DiskCache("chapters", parse_cache_max_size)
+
+# When the whole text is not in the cache, only reparse the nodes that changed
+# Like ScriptLoader.GetNodeHash, nodes are identified by the hash of their text
+use_incremental_parse = True
+node_memory_cache_max_len = 16384
+node_memory_cache = OrderedDict()
+node_disk_cache = DiskCache(
+    "nodes", parse_cache_max_size, dumps=pickle.dumps, loads=pickle.loads
+)
+node_head_pattern = re.compile(r"^[^\S\n]*@", re.MULTILINE)
+
+
+def load_clr():
+    global clr_loaded
+    if clr_loaded:
+        return
+
+    import clr
+
+    clr.AddReference(os.path.abspath(nova_parser_dll_path))
+    clr_loaded = True
+
+
+def get_block_type():
+    if use_clr:
+        load_clr()
+        from Nova.Parser import BlockType
+
+        return BlockType
+    else:
+        return node_parser.BlockType
+
+
+def get_attr_values(attrs):
+    if use_clr:
+        return attrs.Values
+    else:
+        return attrs.values()
 
 
 def is_chapter(head_eager_code):
@@ -20,30 +72,38 @@ def is_start(head_eager_code):
 
 
 def parse_nodes(text):
-    from Nova.Parser import NodeParser
+    if use_clr:
+        load_clr()
+        from Nova.Parser import NodeParser
 
-    return NodeParser.ParseNodes(text)
+        return NodeParser.ParseNodes(text)
+    elif use_incremental_parse:
+        return parse_nodes_incremental(text)
+    else:
+        return node_parser.parse_nodes(text)
+
+
+def join_code_blocks(code_blocks, code_attribute=None):
+    return "\n".join(
+        [
+            block.content
+            for block in code_blocks
+            if code_attribute is None
+            or (
+                block.attributes is not None
+                and code_attribute in get_attr_values(block.attributes)
+            )
+        ]
+    )
 
 
-# DEPRECATED
-def parse_chapters(f, code_attribute=None):
-    nodes = parse_nodes(f.read())
+def nodes_to_chapters(nodes, code_attribute=None):
     return [
         (
             node.name,
             [
                 (
-                    "\n".join(
-                        [
-                            block.content
-                            for block in entry.codeBlocks
-                            if code_attribute is None
-                            or (
-                                block.attributes is not None
-                                and code_attribute in block.attributes.Values
-                            )
-                        ]
-                    ),
+                    join_code_blocks(entry.codeBlocks, code_attribute),
                     entry.characterName,
                     entry.dialogue,
                     entry.line,
@@ -57,6 +117,229 @@ def parse_chapters(f, code_attribute=None):
     ]
 
 
+class IncrementalParseFailed(Exception):
+    pass
+
+
+# Split text at the head eager blocks of nodes
+# Returns the text before the first node, and a list of (start index, node text)
+def split_node_texts(text):
+    starts = []
+    for m in node_head_pattern.finditer(text):
+        block_end = text.find("|>", m.end())
+        if block_end < 0:
+            break
+        if node_parser.node_label_pattern.search(text, m.end(), block_end):
+            starts.append(m.start())
+
+    if not starts:
+        return text, []
+
+    ends = starts[1:] + [len(text)]
+    return text[: starts[0]], [
+        (start, text[start:end]) for start, end in zip(starts, ends)
+    ]
+
+
+def parse_node_text(node_text):
+    try:
+        chunks = node_parser.parse_chunks(node_text)
+    except node_parser.ParserException:
+        raise IncrementalParseFailed()
+
+    # A node text should contain exactly a head eager block, some dialogue entries,
+    # and a tail eager block. Otherwise let the full parser handle it
+    eager_chunk_ids = [
+        i
+        for i, chunk in enumerate(chunks)
+        if chunk[0].type == node_parser.BlockType.EagerExecution
+    ]
+    if eager_chunk_ids != [0, len(chunks) - 1] or len(chunks) < 2:
+        raise IncrementalParseFailed()
+
+    try:
+        nodes = list(node_parser.iter_nodes_from_chunks(chunks))
+    except node_parser.ParserException:
+        raise IncrementalParseFailed()
+    if len(nodes) != 1:
+        raise IncrementalParseFailed()
+
+    return nodes[0]
+
+
+def get_cached_node(node_hash, line_offset):
+    key = (node_hash, line_offset)
+    node = node_memory_cache.get(key)
+    if node is not None:
+        node_memory_cache.move_to_end(key)
+    return node
+
+
+def put_cached_node(node_hash, line_offset, node):
+    node_memory_cache[(node_hash, line_offset)] = node
+    while len(node_memory_cache) > node_memory_cache_max_len:
+        node_memory_cache.popitem(last=False)
+
+
+# The version is in the key, so nodes parsed by an old node_parser are not used
+def get_node_text_hash(node_text):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(parse_cache_version.encode("utf-8"))
+    h.update(b"\xff")
+    h.update(node_text.encode("utf-8"))
+    return h.hexdigest()
+
+
+# Line offset of each node text returned by split_node_texts
+def iter_line_offsets(text, node_texts):
+    line_offset = 0
+    last_start = 1
+    for start, _ in node_texts:
+        # Same as Tokenizer in C#, the first char is not counted in line numbers
+        line_offset += text.count("\n", last_start, start)
+        last_start = max(start, 1)
+        yield line_offset
+
+
+def parse_node_text_cached(node_text, line_offset):
+    node_hash = get_node_text_hash(node_text)
+
+    node = get_cached_node(node_hash, line_offset)
+    if node is not None:
+        return node
+
+    # Line numbers in the cached node without offset are relative to the node text
+    node = get_cached_node(node_hash, 0)
+    if node is None:
+        node = node_disk_cache.get(node_hash)
+        if node is None:
+            node = parse_node_text(node_text)
+            node_disk_cache.put(node_hash, node)
+        put_cached_node(node_hash, 0, node)
+
+    node = node_parser.shift_node_lines(node, line_offset)
+    put_cached_node(node_hash, line_offset, node)
+    return node
+
+
+def parse_nodes_incremental(text):
+    prefix, node_texts = split_node_texts(text)
+    if prefix.strip() or not node_texts:
+        return node_parser.parse_nodes(text)
+
+    nodes = []
+    try:
+        for (_, node_text), line_offset in zip(
+            node_texts, iter_line_offsets(text, node_texts)
+        ):
+            nodes.append(parse_node_text_cached(node_text, line_offset))
+    except IncrementalParseFailed:
+        return node_parser.parse_nodes(text)
+
+    return nodes
+
+
+# DEPRECATED
+# If compact is True, entries of each chapter are returned as CompactEntries,
+# which iterate like the list of tuples but use much less memory
+@profiling.profiled("parse_chapters")
+def parse_chapters(f, code_attribute=None, compact=False):
+    text = f.read()
+    if not use_parse_cache:
+        chapters = parse_chapters_uncached(text, code_attribute)
+    else:
+        key = hash_key(parse_cache_version, text, code_attribute)
+        chapters = parse_cache.get(key)
+        if chapters is None:
+            chapters = parse_chapters_uncached(text, code_attribute)
+            parse_cache.put(key, chapters)
+
+    if compact:
+        with profiling.stage("compact_chapters"):
+            chapters = compact_chapters(chapters)
+    return chapters
+
+
+def parse_chapters_uncached(text, code_attribute):
+    with profiling.stage("parse_nodes"):
+        nodes = parse_nodes(text)
+    with profiling.stage("nodes_to_chapters"):
+        return nodes_to_chapters(nodes, code_attribute)
+
+
+# Code blocks are joined when code is first accessed
+# It can be unpacked like the tuples in parse_chapters, which also joins code blocks
+class ChapterEntry:
+    __slots__ = [
+        "code_blocks",
+        "code_attribute",
+        "_code",
+        "chara_name",
+        "dialogue",
+        "line",
+    ]
+
+    def __init__(self, code_blocks, code_attribute, chara_name, dialogue, line):
+        self.code_blocks = code_blocks
+        self.code_attribute = code_attribute
+        self._code = None
+        self.chara_name = chara_name
+        self.dialogue = dialogue
+        self.line = line
+
+    @property
+    def code(self):
+        if self._code is None:
+            self._code = join_code_blocks(self.code_blocks, self.code_attribute)
+            self.code_blocks = None
+        return self._code
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, key):
+        return (self.code, self.chara_name, self.dialogue, self.line)[key]
+
+    def __iter__(self):
+        yield self.code
+        yield self.chara_name
+        yield self.dialogue
+        yield self.line
+
+
+def iter_entries(node, code_attribute=None):
+    for entry in node.dialogueEntries:
+        yield ChapterEntry(
+            entry.codeBlocks,
+            code_attribute,
+            entry.characterName,
+            entry.dialogue,
+            entry.line,
+        )
+
+
+def iter_chapters_from_nodes(nodes, code_attribute=None):
+    for node in nodes:
+        yield (
+            node.name,
+            iter_entries(node, code_attribute),
+            node.headEagerBlock.content,
+            node.tailEagerBlock.content,
+        )
+
+
+# Streaming variant of parse_chapters
+# Nodes are parsed one at a time, and entries are generated when iterated
+# Errors in the script are raised when the parser reaches them
+def iter_chapters(f, code_attribute=None):
+    text = f.read()
+    if use_clr:
+        nodes = parse_nodes(text)
+    else:
+        nodes = node_parser.iter_nodes(text)
+    return iter_chapters_from_nodes(nodes, code_attribute)
+
+
 def format_attrs(attrs):
     if not attrs:
         return ""
@@ -66,9 +349,7 @@ def format_attrs(attrs):
 
 
 def format_code_block(block):
-    from Nova.Parser import BlockType
-
-    at = "@" if block.type == BlockType.EagerExecution else ""
+    at = "@" if block.type == get_block_type().EagerExecution else ""
     attrs = format_attrs(block.attributes)
     s = f"{at}{attrs}<|{block.content}|>"
     return s
@@ -84,48 +365,168 @@ def format_name_dialogue(chara_name, disp_name, dialogue):
         return dialogue
 
 
+rich_tag_pattern = re.compile(r"<([^<=>]*)(=[^<>]*)?>")
+todo_start = "（TODO："
+spaces_pattern = re.compile(" +")
+
+
+# Removes <tag=...> and </tag> in a single pass
+# Open tags are matched with close tags of the same name in first-in-first-out order,
+# and each matched pair is removed
+# A tag in keep_rich is kept with everything up to the first close tag of the same
+# name after it, and open tags in that range are not matched, but close tags there
+# can still match open tags before the kept tag
+# For well-nested tags without keep_rich, the result is the same as repeatedly
+# removing <tag=...>...</tag> with a regex until nothing changes. With keep_rich or
+# for crossed tags it may differ, e.g. with keep_rich=['b'],
+# '<i><b><i></i><i></i></b></i>' gives '<b><i><i></i></b></i>', while the regex gives
+# '<b><i></b></i>'
+def remove_rich_tags(s, keep_rich=None):
+    tags = list(rich_tag_pattern.finditer(s))
+    if not tags:
+        return s
+
+    # Indices of close tags of each name, for finding the end of kept tags
+    close_ids = {}
+    for i, m in enumerate(tags):
+        name = m.group(1)
+        if name.startswith("/") and m.group(2) is None:
+            close_ids.setdefault(name[1:], []).append(i)
+    if not close_ids:
+        return s
+    close_pointers = dict.fromkeys(close_ids, 0)
+
+    open_queues = {}
+    removed = [False] * len(tags)
+    kept_until = -1
+    for i, m in enumerate(tags):
+        name = m.group(1)
+        if name.startswith("/") and m.group(2) is None:
+            queue = open_queues.get(name[1:])
+            if queue:
+                j = queue.popleft()
+                removed[j] = True
+                removed[i] = True
+            continue
+
+        # Open tags inside a kept tag are never matched
+        if i < kept_until or name not in close_ids:
+            continue
+
+        if keep_rich and name in keep_rich:
+            ids = close_ids[name]
+            k = close_pointers[name]
+            while k < len(ids) and ids[k] < i:
+                k += 1
+            close_pointers[name] = k
+            if k < len(ids):
+                kept_until = ids[k]
+        else:
+            queue = open_queues.get(name)
+            if queue is None:
+                queue = open_queues[name] = deque()
+            queue.append(i)
+
+    out = []
+    last_end = 0
+    for m, is_removed in zip(tags, removed):
+        if is_removed:
+            out.append(s[last_end : m.start()])
+            last_end = m.end()
+    out.append(s[last_end:])
+    return "".join(out)
+
+
+# Returns the index after the closing parenthesis, or -1 if not matched
+# Same as the regex ([^（）]*（[^）]*）)*[^）]*）
+def match_todo_body(s, start):
+    group_end = -1
+    next_open = s.find("（", start)
+    next_close = -1
+    pos = start
+    while True:
+        if next_close < pos:
+            next_close = s.find("）", pos)
+            if next_close < 0:
+                return group_end
+        if 0 <= next_open < pos:
+            next_open = s.find("（", pos)
+        if next_open < 0 or next_close < next_open:
+            return next_close + 1
+        group_end = next_close + 1
+        pos = group_end
+
+
+def remove_todos(s, keep_todo=None):
+    if todo_start not in s:
+        return s
+
+    out = []
+    last_end = 0
+    search_start = 0
+    while True:
+        todo_idx = s.find(todo_start, search_start)
+        if todo_idx < 0:
+            break
+
+        body_start = todo_idx + len(todo_start)
+        end = -1
+        tag_end = s.find("：", body_start)
+        if tag_end >= 0:
+            end = match_todo_body(s, tag_end + 1)
+            tag = s[body_start:tag_end]
+        if end < 0:
+            end = match_todo_body(s, body_start)
+            tag = s[body_start : end - 1]
+        if end < 0:
+            search_start = todo_idx + 1
+            continue
+
+        start = todo_idx
+        if start > last_end and s[start - 1] == "\n":
+            start -= 1
+        if start > last_end and s[start - 1] == "\r":
+            start -= 1
+
+        if not keep_todo or tag not in keep_todo:
+            out.append(s[last_end:start])
+            last_end = end
+        search_start = end
+
+    out.append(s[last_end:])
+    return "".join(out)
+
+
 def normalize_dialogue(
     s, remove_rich=True, keep_rich=None, remove_todo=True, keep_todo=None
 ):
     if not s:
         return s
 
-    if remove_rich:
-
-        def func(m):
-            if keep_rich and m.group(1) in keep_rich:
-                return m.group(0)
-            else:
-                return m.group(3)
-
-        while True:
-            s_new = re.compile(r"<([^=>]*)(=[^>]*)?>(.*?)</\1>", re.DOTALL).sub(func, s)
-            if s_new == s:
-                break
-            s = s_new
+    if remove_rich and "<" in s:
+        s = remove_rich_tags(s, keep_rich)
 
     if remove_todo:
+        s = remove_todos(s, keep_todo)
 
-        def func(m):
-            if m.group(1):
-                tag = m.group(1)[:-1]
-            else:
-                tag = m.group(2)
-            if keep_todo and tag in keep_todo:
-                return m.group(0)
-            else:
-                return ""
-
-        s = re.compile(
-            r"\r?\n?（TODO：([^：]*：)?(([^（）]*（[^）]*）)*[^）]*)）", re.DOTALL
-        ).sub(func, s)
-
-    s = re.compile(" +").sub(" ", s)
+    if "  " in s:
+        s = spaces_pattern.sub(" ", s)
     s = s.strip()
 
     return s
 
 
+def normalize_dialogues(
+    dialogues, remove_rich=True, keep_rich=None, remove_todo=True, keep_todo=None
+):
+    if keep_rich:
+        keep_rich = frozenset(keep_rich)
+    if keep_todo:
+        keep_todo = frozenset(keep_todo)
+    for s in dialogues:
+        yield normalize_dialogue(s, remove_rich, keep_rich, remove_todo, keep_todo)
+
+
 def test_roundtrip():
     in_filename = "scenario.txt"
 
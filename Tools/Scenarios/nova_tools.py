@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Long-running tools for writers
+# `nova_tools.py watch` keeps the parsers and caches warm, polls the scenario
+# directories, and lints only the nodes that changed on each save
+
+import argparse
+import glob
+import os
+import time
+
+import profiling
+from lint import LintVisitor
+from list_bg import BgListVisitor
+from list_bgm import BgmListVisitor
+from list_pos import PosVisitor
+from lua_parser import walk_functions_uncached
+from nova_script_parser import (
+    IncrementalParseFailed,
+    get_node_text_hash,
+    iter_line_offsets,
+    nodes_to_chapters,
+    parse_node_text_cached,
+    parse_nodes,
+    split_node_texts,
+)
+from scenario_loader import get_include_filenames
+from scenario_visitor import run_visitors
+
+in_dir = "../../Assets/Resources/Scenarios/"
+localized_dirs = "../../Assets/Resources/LocalizedResources/*/Scenarios/"
+poll_interval = 0.2
+
+
+def is_localized(filename):
+    return "LocalizedResources" in os.path.normpath(filename).split(os.sep)
+
+
+def scan_files():
+    stats = {}
+    for pattern in [in_dir, localized_dirs]:
+        for filename in glob.glob(os.path.join(pattern, "*.txt")):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stats[filename] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+
+# Returns the changed nodes and the hashes of all nodes
+# If the text cannot be split into nodes, all nodes are returned
+def get_changed_nodes(text, old_hashes):
+    prefix, node_texts = split_node_texts(text)
+    if prefix.strip() or not node_texts:
+        return parse_nodes(text), set()
+
+    nodes = []
+    hashes = set()
+    try:
+        for (_, node_text), line_offset in zip(
+            node_texts, iter_line_offsets(text, node_texts)
+        ):
+            node_hash = get_node_text_hash(node_text)
+            hashes.add(node_hash)
+            if node_hash not in old_hashes:
+                nodes.append(parse_node_text_cached(node_text, line_offset))
+    except IncrementalParseFailed:
+        return parse_nodes(text), set()
+
+    return nodes, hashes
+
+
+def lint_nodes(filename, nodes):
+    visitor = LintVisitor(check_dialogues=not is_localized(filename))
+    run_visitors(nodes_to_chapters(nodes), [visitor])
+
+
+def run_reports():
+    chapters = []
+    for filename in get_include_filenames():
+        with open(filename, "r", encoding="utf-8") as f:
+            chapters += nodes_to_chapters(parse_nodes(f.read()))
+    run_visitors(chapters, [BgListVisitor(), BgmListVisitor(), PosVisitor()])
+
+
+def warm_up():
+    # Load ANTLR, which is skipped by the fast path for simple code
+    for _ in walk_functions_uncached("x = f()", False, set()):
+        pass
+
+
+def watch(args):
+    warm_up()
+
+    file_stats = {}
+    file_node_hashes = {}
+    first_scan = True
+    print(f"Watching {in_dir} and {localized_dirs}")
+    while True:
+        stats = scan_files()
+        changed = False
+        for filename in sorted(stats):
+            if file_stats.get(filename) == stats[filename]:
+                continue
+
+            start_time = time.perf_counter()
+            try:
+                with open(filename, "r", encoding="utf-8") as f:
+                    text = f.read()
+                nodes, node_hashes = get_changed_nodes(
+                    text, file_node_hashes.get(filename, set())
+                )
+            except Exception as e:
+                print(filename)
+                print(f"Error when parsing: {e}")
+                print()
+                # Retry when the file changes again
+                file_stats[filename] = stats[filename]
+                continue
+
+            file_stats[filename] = stats[filename]
+            file_node_hashes[filename] = node_hashes
+            if first_scan and not args.lint_all:
+                continue
+
+            changed = True
+            print(filename)
+            if nodes:
+                lint_nodes(filename, nodes)
+            print(
+                f"{len(nodes)} nodes linted in {time.perf_counter() - start_time:.3f}s"
+            )
+            print()
+
+        for filename in list(file_stats):
+            if filename not in stats:
+                del file_stats[filename]
+                file_node_hashes.pop(filename, None)
+
+        if changed and args.reports:
+            run_reports()
+            print()
+
+        first_scan = False
+        time.sleep(args.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_watch = subparsers.add_parser(
+        "watch", help="lint changed nodes when scenario files are saved"
+    )
+    parser_watch.add_argument(
+        "--interval", type=float, default=poll_interval, help="polling interval in s"
+    )
+    parser_watch.add_argument(
+        "--lint-all", action="store_true", help="lint all files at startup"
+    )
+    parser_watch.add_argument(
+        "--reports",
+        action="store_true",
+        help="also run list_bg, list_bgm and list_pos on changes",
+    )
+
+    args = parser.parse_args()
+    try:
+        if args.command == "watch":
+            watch(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    profiling.init()
+    main()
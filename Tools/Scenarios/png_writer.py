@@ -0,0 +1,186 @@
+# Streaming writers of 8-bit RGB PNG images, which only need the rows being
+# written in memory
+#   PngWriter writes one image row by row
+#   TilePyramidWriter writes tiles of the image at several zoom levels, like
+#   Deep Zoom, so a viewer can load only the visible region
+
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+compress_level = 1
+# Compressed data is written in IDAT chunks of about this size
+idat_size = 64 * 1024
+tile_size = 256
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+
+def write_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+class PngWriter:
+    def __init__(self, f, width, height):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.row_count = 0
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending = []
+        self.pending_size = 0
+
+        f.write(png_signature)
+        # Bit depth 8, color type 2 (RGB), default compression, filter and no interlace
+        write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def add_compressed(self, data):
+        if not data:
+            return
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= idat_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            write_chunk(self.f, b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    # rows is a uint8 array of shape (num_rows, width, 3)
+    def write_rows(self, rows):
+        num_rows = rows.shape[0]
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expect rows of width {self.width}, got {rows.shape}")
+        if self.row_count + num_rows > self.height:
+            raise ValueError(f"Too many rows, height is {self.height}")
+
+        # Each row starts with filter type 0 (none)
+        data = np.zeros((num_rows, 1 + self.width * 3), dtype=np.uint8)
+        data[:, 1:] = rows.reshape(num_rows, -1)
+        self.add_compressed(self.compressor.compress(data.tobytes()))
+        self.row_count += num_rows
+
+    def close(self):
+        if self.row_count != self.height:
+            raise ValueError(f"Expect {self.height} rows, got {self.row_count}")
+        self.add_compressed(self.compressor.flush())
+        self.flush()
+        write_chunk(self.f, b"IEND", b"")
+
+
+def write_png(filename, img):
+    with open(filename, "wb") as f:
+        writer = PngWriter(f, img.shape[1], img.shape[0])
+        writer.write_rows(img)
+        writer.close()
+
+
+# Halves the width and height by averaging 2x2 blocks, and the last row or column
+# is repeated if the size is odd
+def downsample(img):
+    if img.shape[0] % 2:
+        img = np.concatenate([img, img[-1:]], axis=0)
+    if img.shape[1] % 2:
+        img = np.concatenate([img, img[:, -1:]], axis=1)
+    img = img.astype(np.uint16)
+    img = img[0::2, 0::2] + img[0::2, 1::2] + img[1::2, 0::2] + img[1::2, 1::2]
+    return ((img + 2) // 4).astype(np.uint8)
+
+
+# Level 0 is the full image, and each next level halves the size, until the image
+# fits in one tile
+# Tiles are saved to out_dir/<level>/<col>_<row>.png, and the sizes of levels are
+# saved to out_dir/pyramid.json
+class TilePyramidWriter:
+    def __init__(self, out_dir, width, height, tile_size=tile_size):
+        self.out_dir = out_dir
+        self.tile_size = tile_size
+
+        self.levels = []
+        while True:
+            self.levels.append({"width": width, "height": height})
+            if width <= tile_size and height <= tile_size:
+                break
+            width = (width + 1) // 2
+            height = (height + 1) // 2
+
+        # Rows of each level not written to tiles yet, and the index of the next
+        # row of tiles
+        self.buffers = [[] for _ in self.levels]
+        self.buffer_rows = [0] * len(self.levels)
+        self.tile_rows = [0] * len(self.levels)
+        # The last row of each level that is not downsampled yet, because rows
+        # are downsampled in pairs
+        self.odd_rows = [None] * len(self.levels)
+
+        for level in range(len(self.levels)):
+            os.makedirs(os.path.join(out_dir, str(level)), exist_ok=True)
+
+    def write_rows(self, rows):
+        self.add_rows(0, rows)
+
+    def add_rows(self, level, rows):
+        if level + 1 < len(self.levels):
+            # Rows are downsampled in pairs, so an odd row is kept for later
+            pending = rows
+            if self.odd_rows[level] is not None:
+                pending = np.concatenate([self.odd_rows[level], pending], axis=0)
+                self.odd_rows[level] = None
+            if pending.shape[0] % 2:
+                self.odd_rows[level] = pending[-1:]
+                pending = pending[:-1]
+            if pending.shape[0]:
+                self.add_rows(level + 1, downsample(pending))
+
+        self.buffers[level].append(rows)
+        self.buffer_rows[level] += rows.shape[0]
+        if self.buffer_rows[level] < self.tile_size:
+            return
+
+        buffer = np.concatenate(self.buffers[level], axis=0)
+        num_rows = buffer.shape[0] // self.tile_size * self.tile_size
+        for y in range(0, num_rows, self.tile_size):
+            self.write_tile_row(level, buffer[y : y + self.tile_size])
+        self.buffers[level] = [buffer[num_rows:]]
+        self.buffer_rows[level] -= num_rows
+
+    def write_tile_row(self, level, tile_row):
+        for col, x in enumerate(range(0, tile_row.shape[1], self.tile_size)):
+            filename = os.path.join(
+                self.out_dir, str(level), f"{col}_{self.tile_rows[level]}.png"
+            )
+            write_png(
+                filename, np.ascontiguousarray(tile_row[:, x : x + self.tile_size])
+            )
+        self.tile_rows[level] += 1
+
+    def close(self):
+        # Levels are finished in order, because the odd row of a level is added to
+        # the next level
+        for level in range(len(self.levels)):
+            if self.buffer_rows[level]:
+                self.write_tile_row(level, np.concatenate(self.buffers[level], axis=0))
+                self.buffers[level] = []
+                self.buffer_rows[level] = 0
+
+            odd_row = self.odd_rows[level]
+            if odd_row is not None:
+                self.odd_rows[level] = None
+                # The last row of an odd height is repeated when downsampling
+                self.add_rows(level + 1, downsample(odd_row))
+
+        with open(
+            os.path.join(self.out_dir, "pyramid.json"),
+            "w",
+            encoding="utf-8",
+            newline="\n",
+        ) as f:
+            json.dump({"tile_size": self.tile_size, "levels": self.levels}, f, indent=2)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+# Plan the preload and unpreload calls of images, to avoid loading large images
+# when they are shown
+#
+# DialogueEntryPreprocessor.cs already adds preload(obj, 'resource') preload_steps
+# entries before show, trans and other preload patterns, but only in the same
+# node, so the images shown in the first entries of a node are loaded with no or
+# short lead. The planner simulates the entries of each node and adds preloads in
+# the predecessor nodes, following jump_to and branch, until each image has
+# lookahead entries of lead, while the decoded textures shown and preloaded fit
+# in the budget
+#
+# A preload is released in the next node only if all paths into that node hold
+# it, otherwise before the jump, because start nodes can be entered from the
+# chapter menu and a node can be entered from other branches. Every plan is
+# replayed on the routes from the start nodes before it is suggested, and the
+# preload calls already in the scenario count as lead
+#
+# The result is a report of the suggested preload and unpreload calls ranked by
+# the estimated stall, which is the decoded size of the image loaded with no lead
+
+import profiling
+from asset_index import (
+    AssetRefVisitor,
+    get_image_bytes,
+    load_poses,
+    objects,
+    scan_assets,
+)
+from lua_parser import walk_functions
+from nova_script_parser import is_start
+from scenario_loader import load_files
+from scenario_visitor import run_visitors
+
+in_dir = "../../Assets/Resources/Scenarios/"
+template_filename = "template.txt"
+
+# Entries of lead wanted for each image
+lookahead = 5
+# Same as PreloadSteps in DialogueEntryPreprocessor.cs
+preload_steps = 5
+# Decoded textures shown and preloaded at each entry
+budget = 256 * 1024 * 1024
+image_kinds = {"bg", "fg", "cg", "standing"}
+preload_func_names = {"preload", "unpreload"}
+max_routes = 1000
+
+
+# Returns the names of the nodes after the node, from jump_to and branch in the
+# tail eager code
+def get_successors(tail_eager_code):
+    successors = []
+    if not tail_eager_code:
+        return successors
+    for func_name, args, _ in walk_functions(tail_eager_code):
+        if func_name == "jump_to":
+            successors.append(args[0])
+        elif func_name == "branch":
+            successors += [x["dest"] for x in args[0] if "dest" in x]
+    return successors
+
+
+class PlanNode:
+    def __init__(self, name, filename, successors, is_start):
+        self.name = name
+        self.filename = filename
+        self.successors = successors
+        # Start nodes can be entered without their predecessors
+        self.is_start = is_start
+        self.predecessors = []
+        self.line_nums = []
+        # List of (index, func_name, obj_name, resource_name, paths), and
+        # resource_name is None for hide
+        self.events = []
+        # {obj_name: paths} shown at the end of the node
+        self.end_state = {}
+        # Bytes of textures shown and preloaded after each entry
+        self.shown = []
+        self.pending = []
+
+
+class Load:
+    __slots__ = ["node", "index", "obj_name", "resource_name", "paths", "size"]
+
+    def __init__(self, node, index, obj_name, resource_name, paths, size):
+        self.node = node
+        self.index = index
+        self.obj_name = obj_name
+        self.resource_name = resource_name
+        # Paths of the images not shown before
+        self.paths = paths
+        self.size = size
+
+
+class Plan:
+    def __init__(self, load, lead):
+        self.load = load
+        # Lead of the automatic and explicit preloads
+        self.existing_lead = lead
+        self.lead = lead
+        # Lists of (node, index)
+        self.preloads = []
+        self.unpreloads = []
+        # True if the lead is shortened to fit in the budget
+        self.limited = False
+        # True if a placement is dropped because the replay fails
+        self.unsafe = False
+
+
+class PlanVisitor(AssetRefVisitor):
+    func_names = AssetRefVisitor.func_names + ["hide"]
+
+    def __init__(self, poses):
+        super().__init__(poses)
+        # {node_name: PlanNode}, in the order of the scenario
+        self.nodes = {}
+        self.func_name = None
+        self.paths = []
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        super().begin_chapter(chapter_name, head_eager_code, tail_eager_code)
+        self.node = PlanNode(
+            chapter_name,
+            self.filename,
+            get_successors(tail_eager_code),
+            is_start(head_eager_code),
+        )
+        self.nodes[chapter_name] = self.node
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        super().begin_entry(code, chara_name, dialogue, line_num)
+        self.node.line_nums.append(line_num)
+
+    def add_ref(self, kind, path):
+        super().add_ref(kind, path)
+        self.paths.append(path)
+
+    def add_resource(self, obj_name, resource_name):
+        self.paths = []
+        super().add_resource(obj_name, resource_name)
+        # Paths from add_ref outside add_resource are not kept
+        paths, self.paths = self.paths, []
+        if objects[obj_name][0] in image_kinds and paths:
+            self.node.events.append(
+                (
+                    len(self.node.line_nums) - 1,
+                    self.func_name,
+                    obj_name,
+                    resource_name,
+                    paths,
+                )
+            )
+
+    def visit_call(self, func_name, args, env):
+        if func_name == "hide":
+            if args and args[0] in objects:
+                self.node.events.append(
+                    (len(self.node.line_nums) - 1, func_name, args[0], None, [])
+                )
+            return
+        self.func_name = func_name
+        super().visit_call(func_name, args, env)
+
+
+# The images shown at the beginning of a node are the ones shown at the end of all
+# its predecessors simulated before
+def get_start_state(node, nodes):
+    states = [
+        nodes[x].end_state
+        for x in node.predecessors
+        if x in nodes and nodes[x].shown is not None
+    ]
+    if not states:
+        return {}
+    return {
+        obj_name: paths
+        for obj_name, paths in states[0].items()
+        if all(x.get(obj_name) == paths for x in states[1:])
+    }
+
+
+def get_size(paths, sizes):
+    return sum(sizes.get(x, 0) for x in paths)
+
+
+# Returns the list of Load in the node, and sets shown and end_state of the node
+def simulate_node(node, start_state, sizes):
+    state = dict(start_state)
+    loads = []
+    event_idx = 0
+    for index in range(len(node.line_nums)):
+        while event_idx < len(node.events) and node.events[event_idx][0] <= index:
+            _, func_name, obj_name, resource_name, paths = node.events[event_idx]
+            event_idx += 1
+            if func_name in preload_func_names:
+                continue
+            if func_name == "hide":
+                state.pop(obj_name, None)
+                continue
+
+            shown_paths = {x for y in state.values() for x in y}
+            new_paths = [x for x in paths if x not in shown_paths]
+            size = get_size(new_paths, sizes)
+            if size:
+                loads.append(
+                    Load(node, index, obj_name, resource_name, new_paths, size)
+                )
+            state[obj_name] = paths
+
+        node.shown.append(get_size({x for y in state.values() for x in y}, sizes))
+    node.end_state = state
+    return loads
+
+
+def simulate(nodes, sizes):
+    for node in nodes.values():
+        node.shown = None
+    for node in nodes.values():
+        for name in node.successors:
+            if name in nodes:
+                nodes[name].predecessors.append(node.name)
+
+    loads = []
+    for node in nodes.values():
+        start_state = get_start_state(node, nodes)
+        node.shown = []
+        loads += simulate_node(node, start_state, sizes)
+        node.pending = [0] * len(node.line_nums)
+
+    # The automatic preloads of DialogueEntryPreprocessor
+    for load in loads:
+        for index in range(max(load.index - preload_steps, 0), load.index):
+            load.node.pending[index] += load.size
+    return loads
+
+
+# Entries of lead given by the preload calls in the scenario, on the path with the
+# least lead, and 0 if a path has no preload within lookahead entries
+def get_explicit_lead(load, nodes):
+    def get_lead(node, stop, lead, visited):
+        for index, func_name, _, _, paths in node.events:
+            if index >= stop:
+                break
+            if func_name == "preload" and all(x in paths for x in load.paths):
+                return lead + stop - index
+
+        lead += stop
+        pred_names = [x for x in node.predecessors if x not in visited]
+        if lead >= lookahead or not pred_names:
+            return 0
+        return min(
+            get_lead(nodes[x], len(nodes[x].line_nums), lead, visited | {x})
+            for x in pred_names
+        )
+
+    return get_lead(load.node, load.index, 0, {load.node.name})
+
+
+# Returns (preloads, unpreloads, ranges) to preload the load with the lead, where
+# ranges are (node, start, stop) of the entries holding the preloaded image, not
+# counting the ones already held by the automatic preload
+def get_placements(load, lead, nodes):
+    node, index = load.node, load.index
+    ranges = []
+    start = max(index - lead, 0)
+    stop = max(index - preload_steps, 0)
+    if start < stop:
+        ranges.append((node, start, stop))
+    if index >= lead:
+        return [(node, start)], [(node, index)], ranges
+
+    # {node_name: start} of the predecessors where the image is preloaded
+    carriers = {}
+
+    def walk(pred_name, need):
+        if pred_name in carriers or pred_name == node.name:
+            return
+        pred = nodes[pred_name]
+        num_entries = len(pred.line_nums)
+        # Already shown at the end of the predecessor
+        if not num_entries or all(
+            any(x in paths for paths in pred.end_state.values()) for x in load.paths
+        ):
+            return
+
+        start = max(num_entries - need, 0)
+        carriers[pred_name] = start
+        ranges.append((pred, start, num_entries))
+        if num_entries < need:
+            for name in pred.predecessors:
+                walk(name, need - num_entries)
+
+    for name in node.predecessors:
+        walk(name, lead - index)
+
+    # A node receives the preloaded image if all paths into it hold the image, and
+    # a carrier holds the image after its last entry only if all its successors
+    # receive it
+    holding = set(carriers)
+
+    def receives(name):
+        succ = nodes[name]
+        return (
+            not succ.is_start
+            and succ.line_nums
+            and succ.predecessors
+            and all(x in holding for x in succ.predecessors)
+        )
+
+    changed = True
+    while changed:
+        changed = False
+        for name in list(holding):
+            if not all(receives(x) for x in nodes[name].successors if x in nodes):
+                holding.remove(name)
+                changed = True
+
+    preloads = []
+    unpreloads = []
+    for name, start in carriers.items():
+        pred = nodes[name]
+        if not receives(name):
+            preloads.append((pred, start))
+        if name not in holding:
+            # Released before the jump
+            unpreloads.append((pred, len(pred.line_nums) - 1))
+            continue
+        # Released at the beginning of the other branches
+        for succ_name in pred.successors:
+            succ = nodes.get(succ_name)
+            if (
+                succ is not None
+                and succ_name not in carriers
+                and succ is not node
+                and (succ, 0) not in unpreloads
+            ):
+                unpreloads.append((succ, 0))
+    if receives(node.name):
+        unpreloads.append((node, index))
+    return preloads, unpreloads, ranges
+
+
+# Returns the lists of node names from each start node until the end, and a node
+# is not visited twice in a route
+def get_routes(nodes, start_names):
+    routes = []
+    stack = [(x,) for x in reversed(start_names)]
+    while stack and len(routes) < max_routes:
+        route = stack.pop()
+        successors = [
+            x for x in nodes[route[-1]].successors if x in nodes and x not in route
+        ]
+        if not successors:
+            routes.append(list(route))
+        for name in reversed(successors):
+            stack.append(route + (name,))
+    if stack:
+        print(f"More than {max_routes} routes, only the first ones are checked")
+    return routes
+
+
+# Replays the preloads and unpreloads on the routes, like the reference count in
+# AssetLoader with no eviction, and returns False if an unpreload is not matched,
+# or the image is still preloaded at the end of the scenario
+def check_placements(preloads, unpreloads, routes, nodes):
+    counts = {}
+    for node, index in preloads:
+        counts[node.name, index] = counts.get((node.name, index), 0) + 1
+    # Preloads are before unpreloads in the same entry
+    unpreload_counts = {}
+    for node, index in unpreloads:
+        key = (node.name, index)
+        unpreload_counts[key] = unpreload_counts.get(key, 0) + 1
+
+    for route in routes:
+        count = 0
+        for name in route:
+            for index in range(len(nodes[name].line_nums)):
+                count += counts.get((name, index), 0)
+                count -= unpreload_counts.get((name, index), 0)
+                if count < 0:
+                    return False
+        # A route that stops at a loop goes on holding the image
+        if count and not any(x in nodes for x in nodes[route[-1]].successors):
+            return False
+    return True
+
+
+def fits(ranges, size):
+    return all(
+        node.shown[i] + node.pending[i] + size <= budget
+        for node, start, stop in ranges
+        for i in range(start, stop)
+    )
+
+
+# Larger images are planned first, so they get the budget before smaller ones
+def plan_preloads(loads, nodes, routes):
+    plans = []
+    for load in sorted(loads, key=lambda x: -x.size):
+        lead = max(min(load.index, preload_steps), get_explicit_lead(load, nodes))
+        plan = Plan(load, lead)
+        for lead in range(lookahead, plan.lead, -1):
+            preloads, unpreloads, ranges = get_placements(load, lead, nodes)
+            if not preloads:
+                continue
+            if not check_placements(preloads, unpreloads, routes, nodes):
+                plan.unsafe = True
+                continue
+            if fits(ranges, load.size):
+                for node, start, stop in ranges:
+                    for i in range(start, stop):
+                        node.pending[i] += load.size
+                plan.lead = lead
+                plan.preloads = preloads
+                plan.unpreloads = unpreloads
+                break
+            plan.limited = True
+        plans.append(plan)
+    return plans
+
+
+def get_stall(plan):
+    return plan.load.size if plan.existing_lead == 0 else 0
+
+
+def format_resource_name(resource_name):
+    if isinstance(resource_name, list):
+        resource_name = "+".join(resource_name)
+    return f"'{resource_name}'"
+
+
+def format_entry(node, index):
+    return f"{node.filename}:{node.line_nums[index]}: {node.name}[{index}]"
+
+
+def format_mib(size):
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+def main():
+    visitor = PlanVisitor(load_poses())
+    for filename, chapters in load_files(template_filename, in_dir):
+        visitor.filename = filename
+        run_visitors(chapters, [visitor])
+    nodes = visitor.nodes
+
+    sizes = {
+        path: get_image_bytes(filename)
+        for path, (kind, filename) in scan_assets().items()
+        if kind in image_kinds
+    }
+    loads = simulate(nodes, sizes)
+    start_names = [name for name, node in nodes.items() if node.is_start] or [
+        name for name, node in nodes.items() if not node.predecessors
+    ]
+    routes = get_routes(nodes, start_names)
+    plans = plan_preloads(loads, nodes, routes)
+
+    # Stall is the size of the image loaded with no lead by the existing preloads
+    plans = [x for x in plans if x.preloads or x.limited or x.unsafe or x.lead == 0]
+    plans.sort(key=lambda x: (-get_stall(x), -x.load.size))
+
+    stalls = [x for x in plans if x.existing_lead == 0]
+    print(
+        f"Stalls with existing preloads: {len(stalls)}, "
+        f"{format_mib(sum(x.load.size for x in stalls))}"
+    )
+    print(f"Lookahead {lookahead} entries, budget {format_mib(budget)}")
+    print()
+
+    for plan in plans:
+        load = plan.load
+        stall = get_stall(plan)
+        obj_name = load.obj_name
+        resource_name = format_resource_name(load.resource_name)
+        print(
+            f"{format_mib(stall)} {format_entry(load.node, load.index)} "
+            f"{obj_name} {resource_name} {format_mib(load.size)}, "
+            f"lead {plan.existing_lead} -> {plan.lead}"
+            + (" (limited by budget)" if plan.limited else "")
+            + (" (no safe placement)" if plan.unsafe and not plan.preloads else "")
+        )
+        for node, index in plan.preloads:
+            print(
+                f"    {format_entry(node, index)} preload({obj_name}, {resource_name})"
+            )
+        for node, index in plan.unpreloads:
+            print(
+                f"    {format_entry(node, index)} "
+                f"unpreload({obj_name}, {resource_name})"
+            )
+    if plans:
+        print()
+
+    print("Peak texture memory per node:")
+    for node in nodes.values():
+        if node.line_nums:
+            peak = max(x + y for x, y in zip(node.shown, node.pending))
+            print(f"{node.name} {format_mib(peak)}")
+
+
+if __name__ == "__main__":
+    profiling.init()
+    main()
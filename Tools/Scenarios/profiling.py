@@ -0,0 +1,243 @@
+# Per-stage timing and memory instrumentation for the scripts in Tools/Scenarios
+# Run any script with --profile or --profile=trace.json to print a summary of
+# wall time, CPU time, call counts and peak memory of each stage, and cache hit
+# rates, and save a trace that can be opened in chrome://tracing or Perfetto
+#
+# Stages in worker processes are not recorded
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+enabled = False
+trace_filename = "profile_trace.json"
+# tracemalloc slows down the scripts by several times, but it is the only way to
+# get the peak memory of each stage
+trace_memory = True
+
+# name -> [count, wall time, CPU time, peak memory]
+stage_stats = {}
+# Open stages, each is [name, start wall time, start CPU time, peak memory]
+stage_stack = []
+trace_events = []
+start_time = None
+
+
+def init(argv=None):
+    global enabled, trace_filename, start_time
+
+    if argv is None:
+        argv = sys.argv
+    # Remove --profile so that it does not confuse the argument parser of the script
+    for i, arg in enumerate(argv):
+        if arg == "--profile":
+            break
+        if arg.startswith("--profile="):
+            trace_filename = arg[len("--profile=") :]
+            break
+    else:
+        return
+    del argv[i]
+
+    enabled = True
+    start_time = time.perf_counter()
+    if trace_memory:
+        tracemalloc.start()
+    begin_stage(os.path.basename(argv[0]) or "main")
+    atexit.register(finish)
+
+
+def get_peak_memory():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    return 0
+
+
+def begin_stage(name):
+    # The peak memory of the parent stage is saved before tracemalloc is reset
+    if stage_stack:
+        parent = stage_stack[-1]
+        parent[3] = max(parent[3], get_peak_memory())
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    stage_stack.append([name, time.perf_counter(), time.process_time(), 0])
+
+
+def end_stage():
+    end_wall = time.perf_counter()
+    end_cpu = time.process_time()
+    name, start_wall, start_cpu, peak = stage_stack.pop()
+    peak = max(peak, get_peak_memory())
+    if stage_stack:
+        parent = stage_stack[-1]
+        parent[3] = max(parent[3], peak)
+
+    add_stats(name, end_wall - start_wall, end_cpu - start_cpu, peak)
+    trace_events.append(
+        {
+            "name": name,
+            "ph": "X",
+            "ts": (start_wall - start_time) * 1e6,
+            "dur": (end_wall - start_wall) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {
+                "cpu_ms": (end_cpu - start_cpu) * 1000,
+                "peak_memory": peak,
+            },
+        }
+    )
+
+
+def add_stats(name, wall, cpu, peak=0, count=1):
+    stats = stage_stats.get(name)
+    if stats is None:
+        stage_stats[name] = [count, wall, cpu, peak]
+    else:
+        stats[0] += count
+        stats[1] += wall
+        stats[2] += cpu
+        stats[3] = max(stats[3], peak)
+
+
+class stage:
+    def __init__(self, name):
+        self.name = name
+        self.active = False
+
+    def __enter__(self):
+        self.active = enabled
+        if self.active:
+            begin_stage(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.active:
+            end_stage()
+        return False
+
+
+# Decorator to record each call of the function as a stage
+def profiled(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            begin_stage(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end_stage()
+
+        return wrapper
+
+    return decorator
+
+
+# Wraps an iterator and adds the time spent in it to the stage
+# It is for small steps called many times, so they are only summarized and not
+# in the trace, and peak memory is not recorded
+def timed_iter(name, it):
+    wall = 0
+    cpu = 0
+    try:
+        while True:
+            start_wall = time.perf_counter()
+            start_cpu = time.process_time()
+            try:
+                x = next(it)
+            finally:
+                wall += time.perf_counter() - start_wall
+                cpu += time.process_time() - start_cpu
+            yield x
+    except StopIteration:
+        return
+    finally:
+        add_stats(name, wall, cpu)
+
+
+# Returns {name: {"hits": ..., "misses": ...}} of the caches in loaded modules
+def get_cache_stats():
+    out = {}
+
+    nova_script_parser = sys.modules.get("nova_script_parser")
+    if nova_script_parser is not None:
+        for name in ["parse_cache", "node_disk_cache"]:
+            cache = getattr(nova_script_parser, name)
+            out[name] = {"hits": cache.hits, "misses": cache.misses}
+
+    lua_parser = sys.modules.get("lua_parser")
+    if lua_parser is not None:
+        out["call_cache"] = lua_parser.call_cache.stats()
+
+    return out
+
+
+def format_size(x):
+    if x < 1024:
+        return f"{x} B"
+    for unit in ["KiB", "MiB", "GiB"]:
+        x /= 1024
+        if x < 1024:
+            break
+    return f"{x:.1f} {unit}"
+
+
+def print_summary(cache_stats):
+    print()
+    print(
+        f"{'stage':32} {'count':>8} {'wall (ms)':>12} {'CPU (ms)':>12} {'peak mem':>12}"
+    )
+    for name, (count, wall, cpu, peak) in sorted(
+        stage_stats.items(), key=lambda x: -x[1][1]
+    ):
+        peak_str = format_size(peak) if peak else "-"
+        print(
+            f"{name:32} {count:8} {wall * 1000:12.2f} {cpu * 1000:12.2f} "
+            f"{peak_str:>12}"
+        )
+
+    if cache_stats:
+        print()
+        print(f"{'cache':32} {'hits':>8} {'misses':>8} {'hit rate':>10}")
+        for name, stats in cache_stats.items():
+            hits = stats["hits"] + stats.get("disk_hits", 0)
+            total = hits + stats["misses"]
+            hit_rate = f"{hits / total:.1%}" if total else "-"
+            print(f"{name:32} {hits:8} {stats['misses']:8} {hit_rate:>10}")
+
+
+def save_trace(cache_stats):
+    trace = {
+        "traceEvents": trace_events,
+        "displayTimeUnit": "ms",
+        "otherData": {
+            "argv": sys.argv,
+            "caches": cache_stats,
+        },
+    }
+    with open(trace_filename, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(trace, f)
+    print(f"Trace saved to {trace_filename}")
+
+
+def finish():
+    global enabled
+
+    if not enabled:
+        return
+    while stage_stack:
+        end_stage()
+    enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    cache_stats = get_cache_stats()
+    print_summary(cache_stats)
+    save_trace(cache_stats)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# Run all reports with one parse and one walk of the scenario
+
+import profiling
+import split_chara
+from lint import LintVisitor
+from list_bg import BgListVisitor
+from list_bgm import BgmListVisitor
+from list_pos import PosVisitor
+from nova_script_parser import parse_chapters
+from scenario_visitor import run_visitors
+from visualize import TapeVisitor
+
+in_filename = "scenario.txt"
+
+
+def main():
+    with open(in_filename, "r", encoding="utf-8") as f:
+        chapters = parse_chapters(f, compact=True)
+
+    auto_voice_visitor = split_chara.AutoVoiceVisitor()
+    visitors = [
+        LintVisitor(),
+        BgListVisitor(),
+        BgmListVisitor(),
+        PosVisitor(),
+        TapeVisitor(),
+        auto_voice_visitor,
+    ]
+    run_visitors(chapters, visitors)
+    split_chara.print_stats(split_chara.write_all(auto_voice_visitor))
+
+
+if __name__ == "__main__":
+    from utils import run_merge
+
+    profiling.init()
+    run_merge()
+    main()
@@ -0,0 +1,82 @@
+# Load the scenario files included by template.txt without merging them
+# Each file is parsed in a process pool, and line numbers are relative to the file
+
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+from compact_entries import compact_chapters
+from merge import iter_template
+from nova_script_parser import parse_chapters
+
+in_dir = "../../Assets/Resources/Scenarios/"
+template_filename = "template.txt"
+# None means the number of CPUs
+n_workers = None
+
+
+def get_include_filenames(template_filename=template_filename, in_dir=in_dir):
+    return [x for _, _, x in iter_template(template_filename, in_dir) if x is not None]
+
+
+def parse_file(filename, code_attribute=None):
+    with open(filename, "r", encoding="utf-8") as f:
+        return parse_chapters(f, code_attribute)
+
+
+# Returns the files included by the template in template order, then the other
+# .txt files in in_dir and its subdirectories, which are also loaded by the game
+# with Resources.LoadAll
+def get_all_filenames(template_filename=template_filename, in_dir=in_dir):
+    filenames = get_include_filenames(template_filename, in_dir)
+    included = {os.path.normpath(x) for x in filenames}
+    for filename in sorted(
+        glob.glob(os.path.join(in_dir, "**", "*.txt"), recursive=True)
+    ):
+        if os.path.normpath(filename) not in included:
+            filenames.append(filename)
+    return filenames
+
+
+# Returns a list of (filename, chapters) in template order
+# If all_files is True, the files not included by the template are also loaded
+@profiling.profiled("load_files")
+def load_files(
+    template_filename=template_filename,
+    in_dir=in_dir,
+    code_attribute=None,
+    all_files=False,
+):
+    if all_files:
+        filenames = get_all_filenames(template_filename, in_dir)
+    else:
+        filenames = get_include_filenames(template_filename, in_dir)
+    workers = min(n_workers or os.cpu_count() or 1, len(filenames))
+
+    if workers <= 1:
+        results = [parse_file(x, code_attribute) for x in filenames]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(
+                executor.map(parse_file, filenames, [code_attribute] * len(filenames))
+            )
+
+    return list(zip(filenames, results))
+
+
+# Returns the chapters of all files like parse_chapters on the merged scenario,
+# but line numbers are relative to each file
+def load_chapters(
+    template_filename=template_filename,
+    in_dir=in_dir,
+    code_attribute=None,
+    compact=False,
+):
+    chapters = []
+    for _, file_chapters in load_files(template_filename, in_dir, code_attribute):
+        chapters += file_chapters
+
+    if compact:
+        chapters = compact_chapters(chapters)
+    return chapters
@@ -0,0 +1,150 @@
+# Single-pass analysis of the scenario
+# Each visitor declares the functions it cares about, then the driver walks each
+# code block once and dispatches the calls to only the interested visitors
+
+import profiling
+from lua_parser import walk_functions
+
+
+class Visitor:
+    # Names of functions passed to visit_call, or None for all functions
+    func_names = ()
+    # If True, action(f, ...) is passed as f(...)
+    unwrap_action = True
+    # Passed to walk_functions, and only these names are in env of visit_call
+    tracked_env = frozenset()
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        pass
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        pass
+
+    def visit_call(self, func_name, args, env):
+        pass
+
+    # Called when the code cannot be parsed, after the calls before the error
+    def visit_error(self, e):
+        pass
+
+    def end_entry(self, code, chara_name, dialogue, line_num):
+        pass
+
+    def end_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        pass
+
+    def end(self):
+        pass
+
+
+def add_handler(dispatch, key, handler):
+    if key in dispatch:
+        dispatch[key].append(handler)
+    else:
+        dispatch[key] = [handler]
+
+
+def filter_env(env, tracked_env):
+    return tuple(x for x in env if x in tracked_env)
+
+
+@profiling.profiled("run_visitors")
+def run_visitors(chapters, visitors):
+    tracked_env = set()
+    for visitor in visitors:
+        tracked_env |= visitor.tracked_env
+
+    # Handlers are (visit_call, tracked_env or None if env needs no filtering)
+    # Keys are the raw function names, or the unwrapped names with unwrap_action,
+    # and None for the visitors of all functions
+    raw_dispatch = {}
+    unwrapped_dispatch = {}
+    call_visitors = []
+    for visitor in visitors:
+        if visitor.func_names is not None and not visitor.func_names:
+            continue
+        call_visitors.append(visitor)
+
+        if visitor.tracked_env == tracked_env:
+            handler = (visitor.visit_call, None)
+        else:
+            handler = (visitor.visit_call, visitor.tracked_env)
+
+        dispatch = unwrapped_dispatch if visitor.unwrap_action else raw_dispatch
+        if visitor.func_names is None:
+            add_handler(dispatch, None, handler)
+        else:
+            for func_name in visitor.func_names:
+                add_handler(dispatch, func_name, handler)
+
+    raw_all = raw_dispatch.get(None, [])
+    unwrapped_all = unwrapped_dispatch.get(None, [])
+
+    for chapter_name, entries, head_eager_code, tail_eager_code in chapters:
+        for visitor in visitors:
+            visitor.begin_chapter(chapter_name, head_eager_code, tail_eager_code)
+
+        for code, chara_name, dialogue, line_num in entries:
+            for visitor in visitors:
+                visitor.begin_entry(code, chara_name, dialogue, line_num)
+
+            if code and call_visitors:
+                calls = walk_functions(code, tracked_env=tracked_env)
+                if profiling.enabled:
+                    calls = profiling.timed_iter("walk_functions", calls)
+                while True:
+                    # Errors in visitors are not caught
+                    try:
+                        func_name, args, env = next(calls)
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        for visitor in call_visitors:
+                            visitor.visit_error(e)
+                        break
+
+                    handlers = raw_dispatch.get(func_name, raw_all)
+                    if raw_all and handlers is not raw_all:
+                        handlers = handlers + raw_all
+                    for visit_call, visitor_env in handlers:
+                        if visitor_env is None:
+                            visit_call(func_name, args, env)
+                        elif not visitor_env:
+                            visit_call(func_name, args, ())
+                        else:
+                            visit_call(func_name, args, filter_env(env, visitor_env))
+
+                    if not unwrapped_dispatch:
+                        continue
+                    if func_name == "action":
+                        func_name = args[0]
+                        args = args[1:]
+                    handlers = unwrapped_dispatch.get(func_name, unwrapped_all)
+                    if unwrapped_all and handlers is not unwrapped_all:
+                        handlers = handlers + unwrapped_all
+                    for visit_call, visitor_env in handlers:
+                        if visitor_env is None:
+                            visit_call(func_name, args, env)
+                        elif not visitor_env:
+                            visit_call(func_name, args, ())
+                        else:
+                            visit_call(func_name, args, filter_env(env, visitor_env))
+
+            for visitor in visitors:
+                visitor.end_entry(code, chara_name, dialogue, line_num)
+
+        for visitor in visitors:
+            visitor.end_chapter(chapter_name, head_eager_code, tail_eager_code)
+
+    for visitor in visitors:
+        with profiling.stage(f"{type(visitor).__name__}.end"):
+            visitor.end()
+
+
+# Prints chapter names as progress
+class ChapterNamePrinter(Visitor):
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        print(chapter_name)
+
+    def end(self):
+        print()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import profiling
 from nova_script_parser import parse_chapters
 
 in_filename = "scenario.txt"
@@ -31,5 +32,6 @@ def main():
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
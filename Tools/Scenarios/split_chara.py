@@ -1,162 +1,388 @@
 #!/usr/bin/env python3
 
+import multiprocessing
+import os
+from collections import defaultdict
+
 import numpy as np
-from joblib import Parallel, delayed
+import profiling
+from auto_voice import AutoVoiceEngine
 from lua_parser import walk_functions
 from nova_script_parser import is_chapter, normalize_dialogue, parse_chapters
+from scenario_visitor import Visitor, run_visitors
 
 in_filename = "scenario.txt"
 known_chara_names = ["李竹内", "王二宫", "张浅野", "孙西本", "陈高天"]
 other_filename = "其他"
-n_jobs = 8
 parse_auto_voice = True
+# Voice markers are computed by name: auto voice states are kept for any
+# character name and reset in each node, and each character in A&B has its own
+# auto voice
+# If True, markers are the voices computed by AutoVoiceEngine like in the game,
+# which only knows the characters in auto_voice_charas and voice_folders
+use_engine_markers = False
+# The files of characters are written in a process pool, and None means the number
+# of CPUs
+n_workers = None
+# Entries shared with the workers by fork, without pickling
+split_data = None
+
+
+def print_chara_stats(name, dialogue_counts):
+    n_dialogue = sum(dialogue_counts)
+    n_chapters = len(dialogue_counts)
+    if dialogue_counts:
+        mean = np.mean(dialogue_counts)
+        std = np.std(dialogue_counts)
+    else:
+        mean = 0
+        std = 0
+    print(name, n_dialogue, n_chapters, f"{mean:.3g}", f"{std:.3g}", dialogue_counts)
+
+
+# Stores the entries with the voice markers of their characters in one walk, so
+# the file of each character can be written without walking the code again
+class AutoVoiceVisitor(Visitor):
+    def __init__(self):
+        # Only used for the errors if use_engine_markers is False
+        self.engine = AutoVoiceEngine()
+        self.engine.filename = in_filename
+        if parse_auto_voice:
+            self.func_names = self.engine.func_names
+
+        # (chapter_name, label, start, stop) of each chapter, where label is the
+        # name of the last chapter beginning with is_chapter, used in the stats
+        self.chapters = []
+        self.label = None
+        self.chara_names = []
+        # Normalized dialogues, and empty for entries without character
+        self.dialogues = []
+        # Each item is {chara_name: idx_marker} of the entry
+        self.markers = []
+        # chara_name -> indices of entries
+        self.chara_entries = defaultdict(list)
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        if self.label is None or is_chapter(head_eager_code):
+            self.label = chapter_name
+        self.chapters.append([chapter_name, self.label, len(self.chara_names), None])
+        if parse_auto_voice:
+            self.engine.begin_chapter(chapter_name, head_eager_code, tail_eager_code)
+        # Auto voice states by character name, reset in each node
+        self.auto_voice_status = {}
+        self.auto_voice_id = {}
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        if parse_auto_voice:
+            self.engine.begin_entry(code, chara_name, dialogue, line_num)
+            self.voice_count = len(self.engine.voices)
+        self.auto_voice_overridden = False
+        self.say_filename = ""
+
+    def visit_call(self, func_name, args, env):
+        self.engine.visit_call(func_name, args, env)
 
+        if func_name == "auto_voice_on":
+            index = args[1]
+            if isinstance(index, list):
+                index = index[1]
+            self.auto_voice_status[args[0]] = True
+            self.auto_voice_id[args[0]] = int(index)
+        elif func_name == "auto_voice_off":
+            self.auto_voice_status[args[0]] = False
+        elif func_name == "auto_voice_skip":
+            self.auto_voice_overridden = True
+        elif func_name == "say":
+            # Unlike auto_voice.lua, say always overrides the auto voice
+            self.auto_voice_overridden = True
+            self.say_filename = args[1]
 
-def parse_chara(chapters, file_chara_name):
-    if file_chara_name == other_filename:
-        parse_others(chapters)
-        return None, None
+    # Each character of the entry is marked with the index of its own auto voice,
+    # or the audio name of say
+    def get_name_markers(self, chara_name):
+        markers = {}
+        for name in dict.fromkeys(chara_name.split("&")):
+            if self.auto_voice_status.get(name) and not self.auto_voice_overridden:
+                markers[name] = f"{self.auto_voice_id[name] % 1000:03d} "
+                self.auto_voice_id[name] += 1
+            elif self.say_filename:
+                markers[name] = self.say_filename + " "
+        return markers
 
+    # The auto voice of the entry is marked with its index, and the voice of say
+    # is marked with its audio name for all characters of the entry
+    def get_engine_markers(self, chara_name):
+        markers = {}
+        for voice in self.engine.voices[self.voice_count :]:
+            if voice.auto:
+                markers[chara_name] = f"{voice.index % 1000:03d} "
+            else:
+                marker = voice.audio_name + " "
+                for name in chara_name.split("&"):
+                    markers.setdefault(name, marker)
+        return markers
+
+    def end_entry(self, code, chara_name, dialogue, line_num):
+        idx = len(self.chara_names)
+        markers = {}
+        if parse_auto_voice:
+            self.engine.end_entry(code, chara_name, dialogue, line_num)
+        if chara_name:
+            dialogue = normalize_dialogue(dialogue)
+            for name in set(chara_name.split("&")):
+                self.chara_entries[name].append(idx)
+            if parse_auto_voice:
+                if use_engine_markers:
+                    markers = self.get_engine_markers(chara_name)
+                else:
+                    markers = self.get_name_markers(chara_name)
+        else:
+            dialogue = ""
+
+        self.chara_names.append(chara_name)
+        self.dialogues.append(dialogue)
+        self.markers.append(markers)
+
+    def end_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        self.chapters[-1][3] = len(self.chara_names)
+
+
+# Writes the file of one character from split_data
+# Returns (dialogue_counts, logs), where logs are (chapter index, line) to print
+# when the chapter begins
+def write_chara(file_chara_name):
+    data = split_data
     out_filename = in_filename.replace(".txt", f"_{file_chara_name}.txt")
+    entry_indices = data.chara_entries.get(file_chara_name, [])
+    dialogue_set = set()
+    dialogue_counts = []
+    logs = []
+    pos = 0
     with open(out_filename, "w", encoding="utf-8", newline="\n") as f:
-        first_chapter = True
-        dialogue_set = set()
-        dialogue_counts = []
-        dialogue_count = 0
-        last_chapter_name = None
-        for chapter_name, entries, head_eager_code, _ in chapters:
-            if last_chapter_name is None:
-                last_chapter_name = chapter_name
-            if dialogue_count > 0:
-                print(file_chara_name, last_chapter_name, dialogue_count)
-                dialogue_counts.append(dialogue_count)
-                dialogue_count = 0
-            if is_chapter(head_eager_code):
-                last_chapter_name = chapter_name
+        for chapter_idx, (chapter_name, label, start, stop) in enumerate(data.chapters):
+            dialogue_count = 0
+            while pos < len(entry_indices) and entry_indices[pos] < stop:
+                idx = entry_indices[pos]
+                pos += 1
 
-            # print(file_chara_name, chapter_name)
+                if dialogue_count == 0:
+                    if dialogue_counts:
+                        f.write("\n")
+                    f.write(chapter_name + "\n\n")
+                dialogue_count += 1
 
-            first_line = True
-            auto_voice_status = False
-            auto_voice_id = 0
-            auto_voice_overridden = False
-            say_filename = ""
-            for code, chara_name, dialogue, _ in entries:
+                dialogue = data.dialogues[idx]
                 if parse_auto_voice:
-                    for func_name, args, _ in walk_functions(code):
-                        if func_name == "action":
-                            func_name = args[0]
-                            args = args[1:]
-
-                        if func_name == "auto_voice_on" and args[0] == file_chara_name:
-                            auto_voice_status = True
-                            auto_voice_id = int(args[1])
-                        elif (
-                            func_name == "auto_voice_off" and args[0] == file_chara_name
-                        ):
-                            auto_voice_status = False
-                        elif func_name == "auto_voice_skip":
-                            auto_voice_overridden = True
-                        elif func_name == "say":
-                            auto_voice_overridden = True
-                            say_filename = args[1]
-
-                if any(x == file_chara_name for x in chara_name.split("&")):
-                    dialogue_count += 1
-
-                    if first_line:
-                        first_line = False
-                        if first_chapter:
-                            first_chapter = False
-                        else:
-                            f.write("\n")
-                        f.write(chapter_name + "\n\n")
-
-                    dialogue = normalize_dialogue(dialogue)
-
-                    if parse_auto_voice:
-                        if auto_voice_status and not auto_voice_overridden:
-                            idx_marker = f"{auto_voice_id % 1000:03d} "
-                            auto_voice_id += 1
-                        else:
-                            if say_filename:
-                                idx_marker = say_filename + " "
-                            else:
-                                idx_marker = ""
-
-                        if dialogue in dialogue_set:
-                            dup_marker = "D "
-                        else:
-                            dialogue_set.add(dialogue)
-                            dup_marker = ""
+                    idx_marker = data.markers[idx].get(file_chara_name, "")
+                    if dialogue in dialogue_set:
+                        dup_marker = "D "
                     else:
-                        idx_marker = ""
+                        dialogue_set.add(dialogue)
                         dup_marker = ""
+                else:
+                    idx_marker = ""
+                    dup_marker = ""
+                f.write(f"{idx_marker}{dup_marker}{dialogue}\n")
 
-                    f.write(f"{idx_marker}{dup_marker}{dialogue}\n")
-
-                auto_voice_overridden = False
-                say_filename = ""
-
-        if dialogue_count > 0:
-            print(file_chara_name, last_chapter_name, dialogue_count)
-            dialogue_counts.append(dialogue_count)
+            if dialogue_count > 0:
+                # Printed when the next chapter begins
+                logs.append(
+                    (chapter_idx + 1, f"{file_chara_name} {label} {dialogue_count}")
+                )
+                dialogue_counts.append(dialogue_count)
 
-    return file_chara_name, sorted(dialogue_counts)
+    dialogue_counts.sort()
+    return dialogue_counts, logs
 
 
-def parse_others(chapters):
+def write_others():
+    data = split_data
     out_filename = in_filename.replace(".txt", f"_{other_filename}.txt")
+    known_chara_name_set = set(known_chara_names)
+    first_chapter = True
     with open(out_filename, "w", encoding="utf-8", newline="\n") as f:
-        first_chapter = True
-        for chapter_name, entries, _, _ in chapters:
-            # print(other_filename, chapter_name)
-
+        for chapter_name, _, start, stop in data.chapters:
             first_line = True
-            for _, chara_name, dialogue, _ in entries:
-                if chara_name and any(
-                    x not in known_chara_names for x in chara_name.split("&")
+            for idx in range(start, stop):
+                chara_name = data.chara_names[idx]
+                if not chara_name or all(
+                    x in known_chara_name_set for x in chara_name.split("&")
                 ):
-                    if first_line:
-                        first_line = False
-                        if first_chapter:
-                            first_chapter = False
-                        else:
-                            f.write("\n")
-                        f.write(chapter_name + "\n\n")
-                    dialogue = normalize_dialogue(dialogue)
-                    f.write(f"{chara_name}：{dialogue}\n")
+                    continue
+
+                if first_line:
+                    first_line = False
+                    if first_chapter:
+                        first_chapter = False
+                    else:
+                        f.write("\n")
+                    f.write(chapter_name + "\n\n")
+                f.write(f"{chara_name}：{data.dialogues[idx]}\n")
+
+
+def write_file(file_chara_name):
+    if file_chara_name is None:
+        return write_others()
+    return write_chara(file_chara_name)
+
+
+# Writes the files of characters from an AutoVoiceVisitor that has walked the
+# scenario, in workers that share the entries by fork, or in this process if fork
+# is not available
+# Returns {chara_name: dialogue_counts}
+def write_all(data):
+    global split_data
+
+    for filename, line_num, message in data.engine.errors:
+        print(f"{filename}:{line_num}: {message}")
+
+    split_data = data
+
+    file_chara_names = known_chara_names + [None]
+    workers = min(n_workers or os.cpu_count() or 1, len(file_chara_names))
+    try:
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                results = pool.map(write_file, file_chara_names, chunksize=1)
+        else:
+            results = [write_file(x) for x in file_chara_names]
+    finally:
+        split_data = None
+
+    # Print in the order of chapters, then characters
+    logs = []
+    for chara_idx, (_, chara_logs) in enumerate(results[:-1]):
+        logs += [(chapter_idx, chara_idx, line) for chapter_idx, line in chara_logs]
+    for _, _, line in sorted(logs):
+        print(line)
+
+    return {
+        name: dialogue_counts
+        for name, (dialogue_counts, _) in zip(known_chara_names, results)
+    }
+
+
+# Walks the code once for all characters, then writes the files
+def split_all(chapters):
+    data = AutoVoiceVisitor()
+    run_visitors(chapters, [data])
+    return write_all(data)
+
+
+def print_stats(chara_dialogue_counts):
+    for name, dialogue_counts in chara_dialogue_counts.items():
+        print_chara_stats(name, dialogue_counts)
 
 
 def main():
     with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
-
-    stats = Parallel(n_jobs)(
-        delayed(parse_chara)(chapters, file_chara_name)
-        for file_chara_name in known_chara_names + [other_filename]
-    )
-
-    for name, dialogue_counts in stats:
-        if name is None:
-            continue
-
-        dialogue_counts = [x for x in dialogue_counts]
-        n_dialogue = sum(dialogue_counts)
-        n_chapters = len(dialogue_counts)
-        if dialogue_counts:
-            mean = np.mean(dialogue_counts)
-            std = np.std(dialogue_counts)
-        else:
-            mean = 0
-            std = 0
-        print(
-            name, n_dialogue, n_chapters, f"{mean:.3g}", f"{std:.3g}", dialogue_counts
-        )
+        chapters = parse_chapters(f, compact=True)
+
+    print_stats(split_all(chapters))
+
+
+# Writes the file of one character with its own walk of the code, like
+# split_chara before the single walk, as the reference of test_split_all
+def write_chara_reference(chapters, file_chara_name, out_filename):
+    dialogue_set = set()
+    dialogue_counts = []
+    with open(out_filename, "w", encoding="utf-8", newline="\n") as f:
+        for chapter_name, entries, _, _ in chapters:
+            dialogue_count = 0
+            auto_voice_status = False
+            auto_voice_id = 0
+            for code, chara_name, dialogue, _ in entries:
+                auto_voice_overridden = False
+                say_filename = ""
+                for func_name, args, _ in walk_functions(code) if code else []:
+                    if func_name == "action":
+                        func_name = args[0]
+                        args = args[1:]
+                    if func_name == "auto_voice_on" and args[0] == file_chara_name:
+                        index = args[1]
+                        if isinstance(index, list):
+                            index = index[1]
+                        auto_voice_status = True
+                        auto_voice_id = int(index)
+                    elif func_name == "auto_voice_off" and args[0] == file_chara_name:
+                        auto_voice_status = False
+                    elif func_name == "auto_voice_skip":
+                        auto_voice_overridden = True
+                    elif func_name == "say":
+                        auto_voice_overridden = True
+                        say_filename = args[1]
+
+                if file_chara_name not in chara_name.split("&"):
+                    continue
+                if dialogue_count == 0:
+                    if dialogue_counts:
+                        f.write("\n")
+                    f.write(chapter_name + "\n\n")
+                dialogue_count += 1
+
+                if auto_voice_status and not auto_voice_overridden:
+                    idx_marker = f"{auto_voice_id % 1000:03d} "
+                    auto_voice_id += 1
+                elif say_filename:
+                    idx_marker = say_filename + " "
+                else:
+                    idx_marker = ""
+                dialogue = normalize_dialogue(dialogue)
+                if dialogue in dialogue_set:
+                    dup_marker = "D "
+                else:
+                    dialogue_set.add(dialogue)
+                    dup_marker = ""
+                f.write(f"{idx_marker}{dup_marker}{dialogue}\n")
+
+            if dialogue_count > 0:
+                dialogue_counts.append(dialogue_count)
+    return sorted(dialogue_counts)
+
+
+# The files written by split_all must be the same as the ones written by a walk
+# for each character, on a generated corpus
+def test_split_all(corpus_entries=20000):
+    import contextlib
+    import filecmp
+    import io
+    import tempfile
+
+    from generate_sample_script import write_corpus
+    from scenario_loader import get_include_filenames
+
+    global in_filename
+
+    old_in_filename = in_filename
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_corpus(tmp_dir, corpus_entries, 4, seed=0)
+        texts = []
+        for filename in get_include_filenames(
+            os.path.join(tmp_dir, "template.txt"), os.path.join(tmp_dir, "Scenarios")
+        ):
+            with open(filename, "r", encoding="utf-8") as f:
+                texts.append(f.read())
+        chapters = parse_chapters(io.StringIO("\n".join(texts)), compact=True)
+
+        os.makedirs(os.path.join(tmp_dir, "split"))
+        in_filename = os.path.join(tmp_dir, "split", "scenario.txt")
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                chara_dialogue_counts = split_all(chapters)
+        finally:
+            in_filename = old_in_filename
+
+        for name in known_chara_names:
+            filename = os.path.join(tmp_dir, "split", f"scenario_{name}.txt")
+            ref_filename = os.path.join(tmp_dir, f"scenario_{name}.txt")
+            dialogue_counts = write_chara_reference(chapters, name, ref_filename)
+            assert filecmp.cmp(filename, ref_filename, shallow=False), name
+            assert chara_dialogue_counts[name] == dialogue_counts, name
 
 
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
@@ -2,21 +2,21 @@
 
 from collections import Counter
 
-from nova_script_parser import normalize_dialogue, parse_chapters
+import profiling
+from nova_script_parser import iter_chapters, normalize_dialogues
 
 in_filename = "scenario.txt"
 
 
 def main():
     with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+        chapters = iter_chapters(f)
 
     counter = Counter()
     for chapter_name, entries, _, _ in chapters:
         print(chapter_name)
 
-        for _, _, dialogue, _ in entries:
-            dialogue = normalize_dialogue(dialogue)
+        for dialogue in normalize_dialogues(entry.dialogue for entry in entries):
             if dialogue:
                 counter[len(dialogue)] += 1
     print()
@@ -28,5 +28,6 @@ def main():
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
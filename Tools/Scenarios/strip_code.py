@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-from nova_script_parser import normalize_dialogue, parse_chapters
+import profiling
+from nova_script_parser import iter_chapters, normalize_dialogue
 
 in_filename = "scenario.txt"
 out_filename = "scenario_no_code.txt"
@@ -8,15 +9,16 @@ out_filename = "scenario_no_code.txt"
 
 def main():
     with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+        chapters = iter_chapters(f)
 
     with open(out_filename, "w", encoding="utf-8", newline="\n") as f:
         for chapter_name, entries, _, _ in chapters:
             print(chapter_name)
 
             f.write(chapter_name + "\n\n")
-            for _, chara_name, dialogue, _ in entries:
-                dialogue = normalize_dialogue(dialogue, remove_todo=False)
+            for entry in entries:
+                chara_name = entry.chara_name
+                dialogue = normalize_dialogue(entry.dialogue, remove_todo=False)
                 if dialogue:
                     if chara_name:
                         f.write(f"{chara_name}：{dialogue}\n\n")
@@ -27,5 +29,6 @@ def main():
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import profiling
 from docx import Document
 from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.ns import qn
@@ -74,5 +75,6 @@ def main():
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
@@ -2,6 +2,7 @@
 
 import re
 
+import profiling
 from lua_parser import walk_functions
 from nova_script_parser import normalize_dialogue, parse_chapters
 
@@ -173,6 +174,8 @@ if __name__ == "__main__":
 
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
-    subprocess.run(["xelatex", out_filename])
+    with profiling.stage("xelatex"):
+        subprocess.run(["xelatex", out_filename])
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-from nova_script_parser import normalize_dialogue, parse_chapters
+import profiling
+from nova_script_parser import iter_chapters, normalize_dialogue
 from openpyxl import Workbook
 
 in_filename = "scenario.txt"
@@ -9,16 +10,17 @@ out_filename = "scenario_no_code.xlsx"
 
 def main():
     with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+        chapters = iter_chapters(f)
 
     wb = Workbook()
     for chapter_name, entries, _, _ in chapters:
         print(chapter_name)
 
         ws = wb.create_sheet(chapter_name)
-        for _, chara_name, dialogue, _ in entries:
+        for entry in entries:
+            chara_name = entry.chara_name
             dialogue = normalize_dialogue(
-                dialogue, remove_rich=False, remove_todo=False
+                entry.dialogue, remove_rich=False, remove_todo=False
             )
             if dialogue:
                 if chara_name:
@@ -33,5 +35,6 @@ def main():
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()
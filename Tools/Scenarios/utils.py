@@ -1,6 +1,5 @@
-import subprocess
-import sys
+from merge import merge
 
 
 def run_merge():
-    subprocess.run([sys.executable, "merge.py"])
+    merge()
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
-import imageio
+import contextlib
+import hashlib
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from lua_parser import walk_functions
+import profiling
 from nova_script_parser import is_chapter, parse_chapters
+from png_writer import PngWriter, TilePyramidWriter
+from scenario_visitor import Visitor, run_visitors
 from scipy.stats.qmc import Sobol
-from tqdm import tqdm
 
 in_filename = "scenario.txt"
 out_filename = "scenario.png"
+# Set to a directory to also save a tiled pyramid of the image for the web viewer
+tiles_dir = None
+# The image is rendered and saved in bands of this many rows, so the memory does
+# not grow with the length of the scenario
+band_height = 4096
+# Tapes are built in a process pool, and None means the number of CPUs
+n_workers = None
 
 MONOLOGUE_COLOR = (128, 128, 128)
 BG_NONE_COLOR = (0, 0, 0)
@@ -27,22 +40,49 @@ bg_suffixes = ["blur"]
 
 str_to_color_cache = {}
 sobol = Sobol(d=3, scramble=False)
+sobol_index_bits = 20
 
 
+# The color is the point in the Sobol sequence at the index given by the hash of
+# the name, so it does not depend on the order of names and is the same in all
+# processes and revisions of the scenario
 def str_to_color(s):
     if s in str_to_color_config:
         return str_to_color_config[s]
     if s in str_to_color_cache:
         return str_to_color_cache[s]
 
+    h = hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest()
+    index = int.from_bytes(h, "little") & ((1 << sobol_index_bits) - 1)
+    sobol.reset()
+    sobol.fast_forward(index)
     rgb = sobol.random()[0]
     rgb = (rgb * 128).astype(int) + 64
-    rgb = rgb.tolist()
+    rgb = tuple(rgb.tolist())
     str_to_color_cache[s] = rgb
 
     return rgb
 
 
+# Colors in tapes are stored as indices in the palette
+class Palette:
+    def __init__(self):
+        self.colors = []
+        self.color_to_index = {}
+
+    def get_index(self, color):
+        color = tuple(color)
+        index = self.color_to_index.get(color)
+        if index is None:
+            index = len(self.colors)
+            self.colors.append(color)
+            self.color_to_index[color] = index
+        return index
+
+    def to_array(self):
+        return np.array(self.colors, dtype=np.uint8).reshape(-1, 3)
+
+
 def normalize_bg_name(s):
     tokens = s.split("_")
     while tokens[-1].isnumeric() or tokens[-1] in bg_suffixes:
@@ -51,124 +91,151 @@ def normalize_bg_name(s):
     return out
 
 
-def chapter_to_tape(
-    entries,
-    tape,
-    chara_set,
-    bg_set,
-    timeline_set,
-    bgm_set,
-    bg_color,
-    timeline_color,
-    bgm_color,
-):
-    for code, chara_name, _, _ in tqdm(entries):
-        if chara_name:
-            chara_set.add(chara_name)
-            dialogue_color = str_to_color(chara_name)
+# State of a color column that is not set yet in a tape built in a worker, which
+# is taken from the end of the previous tape
+INHERIT = -1
+
+
+# Builds tapes of palette indices without saving them
+# Each raw tape is an array of shape (num_entries, 4) of dialogue, background,
+# timeline and BGM colors, because whether the background or the timeline is
+# shown depends on both, which may be inherited
+class TapeBuilder(Visitor):
+    func_names = [
+        "show",
+        "trans",
+        "trans2",
+        "trans_fade",
+        "trans_left",
+        "trans_right",
+        "trans_up",
+        "trans_down",
+        "show_loop",
+        "hide",
+        "timeline",
+        "timeline_hide",
+        "play",
+        "fade_in",
+        "stop",
+        "fade_out",
+    ]
+
+    # If inherit is True, the colors at the beginning are INHERIT, otherwise
+    # they are none
+    def __init__(self, inherit=False):
+        self.raw_tapes = []
+        self.tape = array("i")
+        self.palette = Palette()
+        self.chara_set = set()
+        self.bg_set = set()
+        self.timeline_set = set()
+        self.bgm_set = set()
+        self.monologue_color = self.palette.get_index(MONOLOGUE_COLOR)
+        self.bg_none_color = self.palette.get_index(BG_NONE_COLOR)
+        self.bgm_none_color = self.palette.get_index(BGM_NONE_COLOR)
+        if inherit:
+            self.bg_color = INHERIT
+            self.timeline_color = INHERIT
+            self.bgm_color = INHERIT
         else:
-            dialogue_color = MONOLOGUE_COLOR
-
-        if code:
-            for func_name, args, _ in walk_functions(code):
-                if func_name == "action":
-                    func_name = args[0]
-                    args = args[1:]
-
-                if (
-                    func_name
-                    in [
-                        "show",
-                        "trans",
-                        "trans2",
-                        "trans_fade",
-                        "trans_left",
-                        "trans_right",
-                        "trans_up",
-                        "trans_down",
-                    ]
-                    and args[0] == "bg"
-                    and isinstance(args[1], str)
-                    and args[1]
-                ):
-                    bg_name = normalize_bg_name(args[1])
-                    bg_set.add(bg_name)
-                    bg_color = str_to_color(bg_name)
-                elif func_name == "show_loop" and args[0] == "bg":
-                    bg_name = normalize_bg_name(args[1][0])
-                    bg_set.add(bg_name)
-                    bg_color = str_to_color(bg_name)
-                elif func_name == "hide" and args[0] == "bg":
-                    bg_color = BG_NONE_COLOR
-
-                elif func_name == "timeline":
-                    timeline_name = args[0]
-                    timeline_set.add(timeline_name)
-                    timeline_color = str_to_color(timeline_name)
-                elif func_name == "timeline_hide":
-                    timeline_color = BG_NONE_COLOR
-
-                elif func_name in ["play", "fade_in"] and args[0] == "bgm":
-                    bgm_name = args[1]
-                    bgm_set.add(bgm_name)
-                    bgm_color = str_to_color(bgm_name)
-                elif func_name in ["stop", "fade_out"] and args and args[0] == "bgm":
-                    bgm_color = BGM_NONE_COLOR
-
-        if bg_color != BG_NONE_COLOR:
-            _bg_color = bg_color
+            self.bg_color = self.bg_none_color
+            self.timeline_color = self.bg_none_color
+            self.bgm_color = self.bgm_none_color
+
+    def get_color(self, s):
+        return self.palette.get_index(str_to_color(s))
+
+    def end_tape(self):
+        if self.tape:
+            self.raw_tapes.append(
+                np.frombuffer(self.tape, dtype=np.int32).reshape(-1, 4)
+            )
+            self.tape = array("i")
+
+    def begin_chapter(self, chapter_name, head_eager_code, tail_eager_code):
+        if self.tape and is_chapter(head_eager_code):
+            self.end_tape()
+
+    def begin_entry(self, code, chara_name, dialogue, line_num):
+        if chara_name:
+            self.chara_set.add(chara_name)
+            self.dialogue_color = self.get_color(chara_name)
         else:
-            _bg_color = timeline_color
-        tape.append((dialogue_color, _bg_color, bgm_color))
+            self.dialogue_color = self.monologue_color
 
-    return bg_color, timeline_color, bgm_color
+    def visit_call(self, func_name, args, env):
+        if (
+            func_name
+            in [
+                "show",
+                "trans",
+                "trans2",
+                "trans_fade",
+                "trans_left",
+                "trans_right",
+                "trans_up",
+                "trans_down",
+            ]
+            and args[0] == "bg"
+            and isinstance(args[1], str)
+            and args[1]
+        ):
+            bg_name = normalize_bg_name(args[1])
+            self.bg_set.add(bg_name)
+            self.bg_color = self.get_color(bg_name)
+        elif func_name == "show_loop" and args[0] == "bg":
+            bg_name = normalize_bg_name(args[1][0])
+            self.bg_set.add(bg_name)
+            self.bg_color = self.get_color(bg_name)
+        elif func_name == "hide" and args[0] == "bg":
+            self.bg_color = self.bg_none_color
 
+        elif func_name == "timeline":
+            timeline_name = args[0]
+            self.timeline_set.add(timeline_name)
+            self.timeline_color = self.get_color(timeline_name)
+        elif func_name == "timeline_hide":
+            self.timeline_color = self.bg_none_color
 
-def tapes_to_img(tapes):
-    tape_width = dialogue_width + bg_width + bgm_width
-    img_height = max(len(tape) for tape in tapes)
-    img = np.zeros((img_height, len(tapes) * tape_width, 3), dtype=np.uint8)
-    for tape_idx, tape in enumerate(tapes):
-        img_tape = img[:, tape_idx * tape_width : (tape_idx + 1) * tape_width :, :]
-        for idx, (dialogue_color, bg_color, bgm_color) in enumerate(tape):
-            img_tape[idx, :dialogue_width, :] = dialogue_color
-            img_tape[idx, dialogue_width : dialogue_width + bg_width, :] = bg_color
-            img_tape[idx, dialogue_width + bg_width :, :] = bgm_color
-    return img
+        elif func_name in ["play", "fade_in"] and args[0] == "bgm":
+            bgm_name = args[1]
+            self.bgm_set.add(bgm_name)
+            self.bgm_color = self.get_color(bgm_name)
+        elif func_name in ["stop", "fade_out"] and args and args[0] == "bgm":
+            self.bgm_color = self.bgm_none_color
 
+    def end_entry(self, code, chara_name, dialogue, line_num):
+        self.tape.extend(
+            (self.dialogue_color, self.bg_color, self.timeline_color, self.bgm_color)
+        )
 
-def main():
-    with open(in_filename, "r", encoding="utf-8") as f:
-        chapters = parse_chapters(f)
+    def end(self):
+        self.end_tape()
 
+    def get_tapes(self):
+        return resolve_tapes(self.raw_tapes, self.bg_none_color, self.bgm_none_color)
+
+
+# Replaces INHERIT in raw tapes with the colors at the end of the previous tape,
+# and returns tapes of shape (num_entries, 3) of dialogue, background and BGM
+# colors, where the background is the timeline if there is no background
+def resolve_tapes(raw_tapes, bg_none_color, bgm_none_color):
+    state = [bg_none_color, bg_none_color, bgm_none_color]
     tapes = []
-    tape = []
-    chara_set = set()
-    bg_set = set()
-    timeline_set = set()
-    bgm_set = set()
-    bg_color = BG_NONE_COLOR
-    timeline_color = BG_NONE_COLOR
-    bgm_color = BGM_NONE_COLOR
-    for chapter_name, entries, head_eager_code, _ in chapters:
-        print(chapter_name)
-        if tape and is_chapter(head_eager_code):
-            tapes.append(tape)
-            tape = []
-        bg_color, timeline_color, bgm_color = chapter_to_tape(
-            entries,
-            tape,
-            chara_set,
-            bg_set,
-            timeline_set,
-            bgm_set,
-            bg_color,
-            timeline_color,
-            bgm_color,
-        )
-    print()
-    tapes.append(tape)
+    for raw_tape in raw_tapes:
+        raw_tape = raw_tape.copy()
+        for col in range(1, 4):
+            column = raw_tape[:, col]
+            column[column == INHERIT] = state[col - 1]
+            state[col - 1] = column[-1]
+
+        bg = np.where(raw_tape[:, 1] != bg_none_color, raw_tape[:, 1], raw_tape[:, 2])
+        tape = np.stack([raw_tape[:, 0], bg, raw_tape[:, 3]], axis=1)
+        tapes.append(tape.astype(np.uint32))
+    return tapes
 
+
+def print_names(chara_set, bg_set, timeline_set, bgm_set):
     print("Characters:")
     for x in sorted(chara_set):
         print(x, str_to_color(x))
@@ -186,12 +253,183 @@ def main():
         print(x, str_to_color(x))
     print()
 
-    img = tapes_to_img(tapes)
-    imageio.imsave(out_filename, img, compress_level=1)
+
+class TapeVisitor(TapeBuilder):
+    # If out_filename or tiles_dir is None, the image or the tiles are not saved
+    def __init__(self, out_filename=out_filename, tiles_dir=tiles_dir):
+        super().__init__()
+        self.out_filename = out_filename
+        self.tiles_dir = tiles_dir
+
+    def end(self):
+        super().end()
+        print_names(self.chara_set, self.bg_set, self.timeline_set, self.bgm_set)
+        if self.out_filename or self.tiles_dir:
+            with profiling.stage("save_image"):
+                save_img(
+                    self.get_tapes(),
+                    self.palette.to_array(),
+                    self.out_filename,
+                    self.tiles_dir,
+                )
+
+
+def get_img_size(tapes):
+    tape_width = dialogue_width + bg_width + bgm_width
+    return len(tapes) * tape_width, max(len(tape) for tape in tapes)
+
+
+# Renders the rows from start to stop
+# Rows below the end of a tape are black
+def tapes_to_img(tapes, palette, start=0, stop=None):
+    img_width, img_height = get_img_size(tapes)
+    if stop is None:
+        stop = img_height
+    num_rows = stop - start
+
+    # The last color in the lookup table is for padding
+    lut = np.concatenate([palette, np.zeros((1, 3), dtype=np.uint8)])
+    index_dtype = np.min_scalar_type(len(lut))
+    indices = np.full((num_rows, len(tapes), 3), len(palette), dtype=index_dtype)
+    for tape_idx, tape in enumerate(tapes):
+        tape = tape[start:stop]
+        indices[: len(tape), tape_idx, :] = tape
+
+    # Gather the colors once for each tape and entry, then repeat them to the
+    # widths of the columns, which is faster than gathering each pixel
+    colors = lut[indices]
+    img = np.repeat(colors, [dialogue_width, bg_width, bgm_width], axis=2)
+    return img.reshape(num_rows, img_width, 3)
+
+
+# The PNG and the tiles are written band by band, so only one band of the image
+# is in memory
+def save_img(tapes, palette, out_filename=out_filename, tiles_dir=tiles_dir):
+    img_width, img_height = get_img_size(tapes)
+    with contextlib.ExitStack() as stack:
+        writers = []
+        if out_filename:
+            f = stack.enter_context(open(out_filename, "wb"))
+            writers.append(PngWriter(f, img_width, img_height))
+        if tiles_dir:
+            writers.append(TilePyramidWriter(tiles_dir, img_width, img_height))
+
+        for start in range(0, img_height, band_height):
+            with profiling.stage("tapes_to_img"):
+                rows = tapes_to_img(
+                    tapes, palette, start, min(start + band_height, img_height)
+                )
+            for writer in writers:
+                writer.write_rows(rows)
+
+        for writer in writers:
+            writer.close()
+
+
+# Splits chapters where a new tape begins, like TapeBuilder
+def split_tape_chapters(chapters):
+    groups = []
+    group = []
+    has_entries = False
+    for chapter in chapters:
+        _, entries, head_eager_code, _ = chapter
+        if has_entries and is_chapter(head_eager_code):
+            groups.append(group)
+            group = []
+            has_entries = False
+        group.append(chapter)
+        has_entries = has_entries or len(entries) > 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+# Builds the raw tape of chapters in a worker, with colors inherited from the
+# previous chapters
+# Returns (raw tapes, palette colors, (chara_set, bg_set, timeline_set, bgm_set))
+def chapter_to_tape(chapters):
+    builder = TapeBuilder(inherit=True)
+    run_visitors(chapters, [builder])
+    return (
+        builder.raw_tapes,
+        builder.palette.colors,
+        (builder.chara_set, builder.bg_set, builder.timeline_set, builder.bgm_set),
+    )
+
+
+# Only the code and the character name are used to build tapes, so other fields
+# are not sent to workers, and compact entries are not pickled with the whole
+# scenario
+def strip_chapters(chapters):
+    return [
+        (
+            chapter_name,
+            [
+                (code, chara_name, "", line_num)
+                for code, chara_name, _, line_num in entries
+            ],
+            head_eager_code,
+            tail_eager_code,
+        )
+        for chapter_name, entries, head_eager_code, tail_eager_code in chapters
+    ]
+
+
+# Builds the tapes of chapters in a process pool, and merges the palettes of workers
+# Returns (tapes, palette, (chara_set, bg_set, timeline_set, bgm_set))
+def build_tapes(chapters):
+    groups = split_tape_chapters(chapters)
+    workers = min(n_workers or os.cpu_count() or 1, len(groups))
+
+    if workers <= 1:
+        results = map(chapter_to_tape, groups)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(workers)
+        results = executor.map(chapter_to_tape, map(strip_chapters, groups))
+
+    palette = Palette()
+    bg_none_color = palette.get_index(BG_NONE_COLOR)
+    bgm_none_color = palette.get_index(BGM_NONE_COLOR)
+    raw_tapes = []
+    name_sets = (set(), set(), set(), set())
+    try:
+        for group, (group_raw_tapes, colors, group_name_sets) in zip(groups, results):
+            for chapter_name, _, _, _ in group:
+                print(chapter_name)
+
+            # Map the palette indices of the worker to the merged palette, and the
+            # last item is for INHERIT
+            remap = np.array(
+                [palette.get_index(color) for color in colors] + [INHERIT],
+                dtype=np.int32,
+            )
+            raw_tapes += [remap[raw_tape] for raw_tape in group_raw_tapes]
+            for name_set, group_name_set in zip(name_sets, group_name_sets):
+                name_set |= group_name_set
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print()
+
+    tapes = resolve_tapes(raw_tapes, bg_none_color, bgm_none_color)
+    return tapes, palette, name_sets
+
+
+def main():
+    with open(in_filename, "r", encoding="utf-8") as f:
+        chapters = parse_chapters(f, compact=True)
+
+    with profiling.stage("build_tapes"):
+        tapes, palette, name_sets = build_tapes(chapters)
+    print_names(*name_sets)
+    with profiling.stage("save_image"):
+        save_img(tapes, palette.to_array(), out_filename, tiles_dir)
 
 
 if __name__ == "__main__":
     from utils import run_merge
 
+    profiling.init()
     run_merge()
     main()